@@ -0,0 +1,191 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio, logging
+from utils import AsyncTimeout, get_time
+from krpc import KRPCError
+from dht import DHT, DHT_Search
+
+# asyncio interface of a DHT node - the lookups are async generators running on the event loop
+# (without a thread per lookup), while the node itself with its routing table, KRPC peers and
+# reply handlers keeps running in its own threads. The results of the KRPC queries are passed
+# to the event loop by AsyncResult callbacks.
+
+async def wait_result(async_result, timeout = None):
+	""" Wait up to timeout seconds for the result of the AsyncResult - returns True if the result is available """
+	if not async_result.has_result():
+		loop = asyncio.get_event_loop()
+		future = loop.create_future()
+		def set_done(future):
+			if not future.done(): # the wait may have timed out already
+				future.set_result(None)
+		def notify(async_result): # called by the KRPC thread
+			try:
+				loop.call_soon_threadsafe(set_done, future)
+			except RuntimeError: # event loop is closed
+				pass
+		async_result.add_callback(notify)
+		await asyncio.wait([future], timeout = timeout)
+	return async_result.has_result()
+
+async def get_result(async_result, timeout = None):
+	""" Awaitable version of AsyncResult.get_result """
+	await wait_result(async_result, timeout)
+	return async_result.get_result(0)
+
+
+class AsyncDHT(object):
+	def __init__(self, dht):
+		""" asyncio facade of the given DHT node """
+		self._dht = dht
+
+	def get_dht(self):
+		return self._dht
+
+	async def shutdown(self):
+		await asyncio.get_event_loop().run_in_executor(None, self._dht.shutdown)
+
+	async def dht_ping(self, connection, timeout = 5):
+		dht = self._dht
+		try:
+			result = await get_result(dht.ping(connection, dht._get_identity(dht._node.id, connection).id), timeout)
+			if result.get(b'r', {}).get(b'id'):
+				dht._get_router(connection).register_node(connection, result[b'r'][b'id'], result.get(b'v'))
+			return result.get(b'r', {})
+		except (AsyncTimeout, KRPCError):
+			pass
+
+	def dht_find_node(self, search_id, timeout = 5, retries = 2):
+		""" Async generator of the connections of the nodes with the given id """
+		return self._iter_krpc_search(self._dht.find_node, self._dht._process_find_node(search_id),
+			search_id, timeout, retries, b'find_node')
+
+	def dht_get_peers(self, info_hash, timeout = 5, retries = 2):
+		""" Async generator of the peers of the given info hash - the tokens for dht_announce_peer are stored """
+		return self._iter_krpc_search(self._dht.get_peers, self._dht._process_get_peers(info_hash),
+			info_hash, timeout, retries, b'get_peers')
+
+	async def dht_announce_peer(self, info_hash, implied_port = 1, timeout = 5):
+		""" Announce the info hash to all nodes that supplied a token (see dht_get_peers) at the same time
+			- returns the list of (connection, reply) of the nodes which confirmed the announcement """
+		async_result_list = list(self._dht.dht_announce_peer(info_hash, implied_port))
+		t_end = get_time() + timeout
+		result = []
+		for async_result in async_result_list:
+			try:
+				reply = await get_result(async_result, max(0, t_end - get_time()))
+				result.append((async_result.get_source(), reply.get(b'r', {})))
+			except (AsyncTimeout, KRPCError):
+				async_result.discard_result()
+		return result
+
+	# Private members #################################################
+
+	async def _iter_krpc_search(self, query_fun, process_fun, search_value, timeout, retries, method):
+		dht = self._dht
+		search = DHT_Search(dht, query_fun, process_fun, search_value, timeout, retries)
+		t_start = get_time()
+		try:
+			while not dht._threads.shutdown_in_progress():
+				node_result_list = search.start_round()
+				if node_result_list == None:
+					break
+				if not node_result_list: # all close nodes are busy with other lookups
+					await asyncio.sleep(search.busy_wait)
+				for (t_end, node, async_result) in node_result_list:
+					await wait_result(async_result, max(0, t_end - get_time()))
+					for tmp in search.process_result(node, async_result, 0):
+						yield tmp
+		finally:
+			search.finish()
+			dht._lookup_rounds[method].observe(search.round_count)
+			dht._lookup_latency[method].observe(get_time() - t_start)
+
+
+async def start_dht(*args, **kwargs):
+	""" Start a DHT node (with the arguments of the DHT constructor) without blocking the event loop
+		during the bootstrap - returns its AsyncDHT """
+	dht = await asyncio.get_event_loop().run_in_executor(None, lambda: DHT(*args, **kwargs))
+	return AsyncDHT(dht)
+
+
+if __name__ == '__main__':
+	import io, os, sys, threading
+	from lookuptrace import LookupRecorder, iter_lookup_traces
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	logging.getLogger('DHT_Router').setLevel(logging.CRITICAL)
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	lookups = int((sys.argv[1:] or [1000])[0])
+
+	async def consume(async_iterable):
+		return [result async for result in async_iterable]
+
+	async def main():
+		bootstrap_connection = ('127.0.0.1', 10201)
+		nodes = [await start_dht(('127.0.0.1', 10201), bootstrap_connection, {'bootstrap_lookup': False})]
+		nodes.extend(await asyncio.gather(*[start_dht(('127.0.0.1', port), bootstrap_connection)
+			for port in range(10202, 10206)]))
+		try:
+			log.critical('ping: node2 -> node1 = %r' % (await nodes[1].dht_ping(bootstrap_connection)))
+			for node in nodes: # let every node know every other node
+				for other in nodes:
+					await node.dht_ping(other.get_dht().get_external_connection())
+			info_hash = os.urandom(20)
+			await consume(nodes[1].dht_get_peers(info_hash, timeout = 1)) # collect tokens
+			announced = await nodes[1].dht_announce_peer(info_hash)
+			log.critical('announce_peer: node2 -> %d nodes' % len(announced))
+			peers = await consume(nodes[2].dht_get_peers(info_hash, timeout = 1))
+			log.critical('get_peers: node3 -> info_hash = %r' % peers)
+			assert(('127.0.0.1', 10202) in peers)
+			target = nodes[3].get_dht().get_identities()[0]
+			found = await consume(nodes[4].dht_find_node(target, timeout = 1))
+			log.critical('find_node: node5 -> id(node4) = %r' % found)
+			assert(('127.0.0.1', 10204) in found)
+			# Concurrent lookups of random ids - all running on the event loop
+			threads = threading.active_count()
+			trace_fp = io.StringIO()
+			for node in nodes:
+				node.get_dht().set_lookup_recorder(LookupRecorder(trace_fp))
+			t_start = get_time()
+			results = await asyncio.gather(*[consume(nodes[i % len(nodes)].dht_find_node(os.urandom(20), timeout = 1, retries = 1))
+				for i in range(lookups)])
+			log.critical('%d concurrent lookups finished after %.2fs - threads: %d before, %d after' % (
+				len(results), get_time() - t_start, threads, threading.active_count()))
+			assert(threading.active_count() <= threads)
+			# Rounds in which all close nodes were busy are not counted
+			trace_fp.seek(0)
+			records = list(iter_lookup_traces(trace_fp))
+			assert(len(records) == lookups)
+			assert(all(record['rounds'] == max([0] + [query['round'] for query in record['queries']]) for record in records))
+			log.critical('busy nodes skipped: %d' % sum(record['busy'] for record in records))
+		finally:
+			await asyncio.gather(*[node.shutdown() for node in nodes])
+
+	loop = asyncio.new_event_loop()
+	try:
+		loop.run_until_complete(main())
+	finally:
+		loop.close()
@@ -0,0 +1,448 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os, sys, time, random, logging, json, platform
+from bencode import bencode, BencodeTemplate, bdecode, BTFailure
+
+# Settings of the benchmark runs - the command line options --quick, --warmup=N and --repetitions=N change them
+bench_setup = {'min_time': 0.2, 'warmup': 1, 'repetitions': 3,
+	'router_sizes': [1000, 100000, 1000000], 'swarm_size': 500, 'swarm_lookups': 20}
+
+def measure(fun, *args, **kwargs):
+	""" Return the timings of fun(*args) - the number of calls is calibrated to run for at least min_time,
+		followed by warm-up and timed repetitions. The time per operation (each call performs
+		kwargs.get('ops', 1) operations) is given for the best and the median repetition. """
+	ops = kwargs.get('ops', 1)
+	def run(number):
+		t_start = time.time()
+		for idx in range(number):
+			fun(*args)
+		return time.time() - t_start
+	number = 1
+	while run(number) < bench_setup['min_time']:
+		number *= 2
+	for repetition in range(bench_setup['warmup']):
+		run(number)
+	durations = sorted(run(number) for repetition in range(max(1, bench_setup['repetitions'])))
+	return {'time': durations[0] / (number * ops), 'median': durations[len(durations) // 2] / (number * ops),
+		'ops': number * ops, 'repetitions': len(durations)}
+
+# Test payloads ###################################################
+
+def get_krpc_payloads():
+	rnd = random.Random(42)
+	def rnd_bytes(n):
+		return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+	return {
+		'ping_query': bencode({b'y': b'q', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'q': b'ping',
+			b'a': {b'id': rnd_bytes(20)}}),
+		'find_node_response': bencode({b'y': b'r', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'ip': rnd_bytes(6),
+			b'r': {b'id': rnd_bytes(20), b'nodes': rnd_bytes(26 * 8)}}),
+		'get_peers_response': bencode({b'y': b'r', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'ip': rnd_bytes(6),
+			b'r': {b'id': rnd_bytes(20), b'token': rnd_bytes(20), b'values': [rnd_bytes(6) for x in range(50)]}}),
+	}
+
+def get_metainfo_payload(pieces = 200000, files = 1000):
+	rnd = random.Random(42)
+	info = {b'name': b'benchmark', b'piece length': 2**18, b'pieces': os.urandom(20 * pieces),
+		b'files': [{b'length': rnd.randint(1, 2**30), b'path': [b'dir%d' % (x % 10), b'file%d.bin' % x]}
+			for x in range(files)]}
+	return bencode({b'announce': b'http://localhost:6969/announce', b'creation date': 1400000000, b'info': info})
+
+# Recursive decoder used until the iterative bdecode_proc - kept as reference
+def bdecode_reference(msg):
+	def bdecode_proc(msg, pos):
+		t = msg[pos]
+		if t == ord('i'):
+			pos += 1
+			pos_end = msg.index(b'e', pos)
+			return (int(msg[pos:pos_end]), pos_end + 1)
+		elif t >= ord('0') and t <= ord('9'):
+			sep = msg.index(b':', pos)
+			n = int(msg[pos:sep])
+			sep += 1
+			return (bytes(msg[sep:sep + n]), sep + n)
+		elif t == ord('d'):
+			result = {}
+			pos += 1
+			while msg[pos] != ord('e'):
+				k, pos = bdecode_proc(msg, pos)
+				result[k], pos = bdecode_proc(msg, pos)
+			return (result, pos + 1)
+		elif t == ord('l'):
+			result = []
+			pos += 1
+			while msg[pos] != ord('e'):
+				v, pos = bdecode_proc(msg, pos)
+				result.append(v)
+			return (result, pos + 1)
+		raise BTFailure('invalid bencoded data (invalid token)!')
+	return bdecode_proc(bytearray(msg), 0)[0]
+
+# Compact node / peer decoders used until the struct based codec - kept as reference
+def decode_nodes_reference(nodes):
+	import struct
+	from utils import decode_connection
+	try:
+		while nodes:
+			node_id = struct.unpack('20s', nodes[:20])[0]
+			node_connection = decode_connection(nodes[20:26])
+			if node_connection[1] >= 1024:
+				yield (node_id, node_connection)
+			nodes = nodes[26:]
+	except Exception:
+		pass
+
+def decode_connections_reference(data):
+	from utils import decode_connection
+	while len(data) >= 6:
+		c = decode_connection(data[0:6])
+		if c[1] >= 1024:
+			yield c
+		data = data[6:]
+
+def encode_nodes_reference(nodes):
+	from utils import encode_connection
+	result = b''
+	for node in nodes:
+		result += bytes(bytearray(node.id).rjust(20, b'\0')) + encode_connection(node.connection)
+	return result
+
+# Benchmarks ######################################################
+
+def bench_bdecode():
+	payloads = get_krpc_payloads()
+	payloads['metainfo'] = get_metainfo_payload()
+	result = {}
+	for name, payload in sorted(payloads.items()):
+		assert(bdecode(payload) == bdecode_reference(payload))
+		result['bdecode_reference.' + name] = measure(bdecode_reference, payload)
+		result['bdecode.' + name] = measure(bdecode, payload)
+		result['bdecode_zero_copy.' + name] = measure(lambda payload: bdecode(payload, zero_copy = True), payload)
+	return result
+
+def bench_krpc_message():
+	from krpc import KRPCMessage
+	def use_message(rec): # envelope and payload as accessed by the dispatch and the handlers
+		return (rec[b'y'], rec[b't'], rec.get(b'ip'), rec.get(b'r', rec.get(b'a'))[b'id'])
+	result = {}
+	for name, payload in sorted(get_krpc_payloads().items()):
+		assert(use_message(bdecode(payload)) == use_message(KRPCMessage(payload)))
+		result['krpc_message_bdecode.' + name] = measure(lambda payload: use_message(bdecode(payload)), payload)
+		result['krpc_message.' + name] = measure(lambda payload: use_message(KRPCMessage(payload)), payload)
+	return result
+
+def bench_krpc_encode():
+	rnd = random.Random(42)
+	def rnd_bytes(n):
+		return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+	messages = {
+		'ping_query': ({b'y': b'q', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'q': b'ping', b'a': {'id': rnd_bytes(20)}},
+			[(b't',), (b'a', 'id')]),
+		'ping_response': ({b'y': b'r', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'ip': rnd_bytes(6), b'r': {'id': rnd_bytes(20)}},
+			[(b't',), (b'ip',), (b'r', 'id')]),
+		'find_node_response': ({b'y': b'r', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'ip': rnd_bytes(6),
+			b'r': {'id': rnd_bytes(20), 'nodes': rnd_bytes(26 * 8)}}, [(b't',), (b'ip',), (b'r', 'id'), (b'r', 'nodes')]),
+		'get_peers_response': ({b'y': b'r', b't': b'\x01\x02', b'v': b'XK\x00\x01', b'ip': rnd_bytes(6),
+			b'r': {'id': rnd_bytes(20), 'token': rnd_bytes(20), 'values': [rnd_bytes(6) for x in range(50)]}},
+			[(b't',), (b'ip',), (b'r', 'id'), (b'r', 'token'), (b'r', 'values')]),
+	}
+	result = {}
+	for name, (msg, fields) in sorted(messages.items()):
+		template = BencodeTemplate(msg, fields)
+		assert(template.encode(msg) == bencode(msg))
+		result['bencode.' + name] = measure(bencode, msg)
+		result['bencode_template.' + name] = measure(template.encode, msg)
+	return result
+
+def bench_metainfo():
+	import hashlib
+	from metainfo import Metainfo
+	payload = get_metainfo_payload()
+	def get_info_hash_reference(payload):
+		return hashlib.sha1(bencode(bdecode(payload)[b'info'])).digest()
+	def get_info_hash(payload):
+		return Metainfo(payload).get_info_hash()
+	assert(get_info_hash_reference(payload) == get_info_hash(payload))
+	return {'info_hash_reference.metainfo': measure(get_info_hash_reference, payload),
+		'info_hash.metainfo': measure(get_info_hash, payload)}
+
+def bench_compact_nodes():
+	from utils import encode_nodes, decode_nodes, decode_connections, encode_nodes6, decode_nodes6
+	rnd = random.Random(42)
+	class Node(object):
+		def __init__(self):
+			self.id = bytes(bytearray(rnd.getrandbits(8) for x in range(20)))
+			self.connection = ('10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+				rnd.randint(1024, 65535))
+	result = {}
+	for count in [8, 200, 10000]:
+		nodes = [Node() for x in range(count)]
+		nodes_data = encode_nodes(nodes)
+		peers_data = b''.join(node_data[20:] for node_data in [nodes_data[x:x + 26] for x in range(0, len(nodes_data), 26)])
+		assert(nodes_data == encode_nodes_reference(nodes))
+		assert(list(decode_nodes(nodes_data)) == list(decode_nodes_reference(nodes_data)))
+		assert(list(decode_connections(peers_data)) == list(decode_connections_reference(peers_data)))
+		nodes6 = [Node() for x in range(count)]
+		for node in nodes6:
+			node.connection = ('2001:db8::' + node.connection[0].replace('.', ':'), node.connection[1])
+		assert(list(decode_nodes6(encode_nodes6(nodes6))) == [(node.id, node.connection) for node in nodes6])
+		result['encode_nodes_reference.%d' % count] = measure(encode_nodes_reference, nodes)
+		result['encode_nodes.%d' % count] = measure(encode_nodes, nodes)
+		result['decode_nodes_reference.%d' % count] = measure(lambda: list(decode_nodes_reference(nodes_data)))
+		result['decode_nodes.%d' % count] = measure(lambda: list(decode_nodes(nodes_data)))
+		result['decode_nodes_packed.%d' % count] = measure(lambda: list(decode_nodes(nodes_data, packed = True)))
+		result['decode_connections_reference.%d' % count] = measure(lambda: list(decode_connections_reference(peers_data)))
+		result['decode_connections.%d' % count] = measure(lambda: list(decode_connections(peers_data)))
+		result['decode_connections_packed.%d' % count] = measure(lambda: list(decode_connections(peers_data, packed = True)))
+	return result
+
+def bench_node_id():
+	from crc32c import crc32c
+	from dht import bep42_id, valid_id, DHT_Node
+	rnd = random.Random(42)
+	def rnd_bytes(n):
+		return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+	(connection, connection6) = (('93.184.216.34', 6881), ('2001:db8::1', 6881))
+	(node_id, node_id6) = (bep42_id(rnd_bytes(20), connection), bep42_id(rnd_bytes(20), connection6))
+	assert(valid_id(node_id, connection) and valid_id(node_id6, connection6))
+	node = DHT_Node(connection, node_id)
+	result = {}
+	for size in [4, 8, 1024]:
+		result['crc32c.%d' % size] = measure(crc32c, bytearray(rnd_bytes(size)))
+	result['valid_id.ipv4'] = measure(valid_id, node_id, connection)
+	result['valid_id.ipv6'] = measure(valid_id, node_id6, connection6)
+	result['valid_id_cached.ipv4'] = measure(node.is_valid)
+	return result
+
+def bench_router():
+	import itertools
+	from dht import DHT_Router, decode_id
+	result = {}
+	for count in bench_setup['router_sizes']:
+		rnd = random.Random(42)
+		def rnd_bytes(n):
+			return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+		def rnd_connection():
+			return ('10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)), rnd.randint(1024, 65535))
+		router = DHT_Router('benchmark', {'report_t': -1, 'limit_t': -1, 'redeem_t': -1})
+		try:
+			for node_id in sorted(rnd_bytes(20) for x in range(count)): # sorted ids are appended to the id index
+				router.register_node(rnd_connection(), node_id)
+			known = itertools.cycle([(node.connection, node.id) for node in rnd.sample(router.get_nodes(sorter = None), min(count, 1000))])
+			new = itertools.cycle([(rnd_connection(), rnd_bytes(20)) for x in range(1000)])
+			targets = [decode_id(rnd_bytes(20)) for x in range(100)]
+			for target in targets[:10]:
+				assert(router.get_close_nodes(target, 8) == router.get_nodes(8, sorter = lambda n: n.id_cmp ^ target))
+			targets = itertools.cycle(targets)
+			def get_nodes():
+				target = next(targets)
+				return router.get_nodes(8, sorter = lambda n: n.id_cmp ^ target)
+			result['router_register_known.%d' % count] = measure(lambda: router.register_node(*next(known)))
+			result['router_register_new.%d' % count] = measure(lambda: router.remove_node(router.register_node(*next(new)), force = True))
+			result['router_get_nodes.%d' % count] = measure(get_nodes)
+			result['router_get_close_nodes.%d' % count] = measure(lambda: router.get_close_nodes(next(targets), 8))
+		finally:
+			router.shutdown()
+	return result
+
+def bench_router_contention():
+	""" Latency of the reply path (register_node + get_close_nodes) while another thread runs the
+		maintenance reads (get_state_count, get_nodes) and batches of writes on the same router -
+		the time the reply path waits for the router lock is measured with a wrapper around the lock """
+	import threading
+	from dht import DHT_Router, decode_id
+	class TimedLock(object):
+		def __init__(self, lock):
+			(self._lock, self.wait) = (lock, {})
+		def acquire(self, blocking = True):
+			t_start = time.time()
+			result = self._lock.acquire(blocking)
+			name = threading.current_thread().name
+			self.wait[name] = self.wait.get(name, 0) + time.time() - t_start
+			return result
+		def release(self):
+			self._lock.release()
+		__enter__ = acquire
+		def __exit__(self, exc_type, exc_value, traceback):
+			self.release()
+	count = bench_setup['router_sizes'][min(1, len(bench_setup['router_sizes']) - 1)]
+	rnd = random.Random(42)
+	def rnd_bytes(n):
+		return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+	def rnd_connection():
+		return ('10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)), rnd.randint(1024, 65535))
+	router = DHT_Router('benchmark', {'report_t': -1, 'limit_t': -1, 'redeem_t': -1})
+	try:
+		for node_id in sorted(rnd_bytes(20) for x in range(count)):
+			router.register_node(rnd_connection(), node_id)
+		router._nodes_lock = TimedLock(router._nodes_lock)
+		known = [(node.connection, node.id) for node in rnd.sample(router.get_nodes(sorter = None), 1000)]
+		new = [(rnd_connection(), rnd_bytes(20)) for x in range(100)]
+		targets = [decode_id(rnd_bytes(20)) for x in range(1000)]
+		stop = threading.Event()
+		def maintenance():
+			while not stop.is_set():
+				router.get_state_count()
+				router.get_nodes(100, sorter = lambda n: n.last_response)
+				for (connection, node_id) in new:
+					router.remove_node(router.register_node(connection, node_id), force = True)
+		thread = threading.Thread(name = 'maintenance', target = maintenance)
+		thread.start()
+		latency = []
+		t_end = time.time() + 10 * bench_setup['min_time']
+		try:
+			while time.time() < t_end:
+				for idx in range(100):
+					t_start = time.time()
+					router.register_node(*known[idx])
+					router.get_close_nodes(targets[idx], 8)
+					latency.append(time.time() - t_start)
+		finally:
+			stop.set()
+			thread.join()
+		latency.sort()
+		name = threading.current_thread().name
+		return {'router_contention_reply.%d' % count: {'time': sum(latency) / len(latency), 'median': latency[len(latency) // 2],
+			'p99': latency[int(0.99 * len(latency))], 'max': latency[-1], 'ops': len(latency),
+			'lock_wait': router._nodes_lock.wait.get(name, 0) / len(latency)}}
+	finally:
+		router.shutdown()
+
+def bench_krpc_loopback():
+	from krpc import KRPCPeer
+	node_id = os.urandom(20)
+	server_connection = ('127.0.0.1', 11111)
+	server = KRPCPeer(server_connection, handle_query = lambda send_krpc_response, rec, source_connection:
+		send_krpc_response(message = {'id': node_id}))
+	client = KRPCPeer(('127.0.0.1', 11112), handle_query = None)
+	def ping():
+		client.send_krpc_query(server_connection, 'ping', id = node_id).get_result(5)
+	def ping_pipelined(n):
+		for query in [client.send_krpc_query(server_connection, 'ping', id = node_id) for x in range(n)]:
+			query.get_result(5)
+	try:
+		return {'krpc_loopback_ping': measure(ping), 'krpc_loopback_ping_pipelined.100': measure(ping_pipelined, 100, ops = 100)}
+	finally:
+		client.shutdown()
+		server.shutdown()
+
+def bench_lookup():
+	from simnet import SimNetwork, create_swarm, fill_routing_tables
+	random.seed(42)
+	network = SimNetwork(latency = (0.01, 0.1), seed = 42)
+	with network:
+		nodes = create_swarm(network, bench_setup['swarm_size'], join_lookup = False)
+		fill_routing_tables(network, nodes)
+		lookups = [network.random.sample(nodes, 2) for x in range(bench_setup['swarm_lookups'])]
+		def lookup():
+			for (source, target) in lookups:
+				for result in source.dht_find_node(target.get_identities()[0]):
+					pass
+		sent = network.stats['sent']
+		lookup()
+		packets = (network.stats['sent'] - sent) / float(len(lookups))
+		result = measure(lookup, ops = len(lookups))
+		result['packets'] = packets
+		for dht in nodes:
+			dht.shutdown()
+	return {'dht_lookup.%d' % bench_setup['swarm_size']: result}
+
+def bench_reply_cache():
+	import itertools
+	from capture import ReplayTransport
+	from dht import DHT, bep42_id
+	from utils import encode_uint64
+	rnd = random.Random(42)
+	def rnd_bytes(n):
+		return bytes(bytearray(rnd.getrandbits(8) for x in range(n)))
+	connection = ('127.0.0.1', 16883)
+	dht = DHT(connection, connection, {'bootstrap_lookup': False, 'maintain_t': -1}, transport = ReplayTransport(connection))
+	try:
+		for x in range(1000):
+			node_connection = ('10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)), rnd.randint(1024, 65535))
+			dht._nodes.register_node(node_connection, bep42_id(rnd_bytes(20), node_connection))
+		source = ('10.1.2.3', 6881)
+		(source_id, target) = (bep42_id(rnd_bytes(20), source), rnd_bytes(20))
+		transactions = itertools.count()
+		def find_node(retransmit): # the query is encoded in both cases
+			t = retransmit and b'aa' or encode_uint64(next(transactions))
+			dht._krpc._handle_packet(bencode({b'y': b'q', b't': t, b'q': b'find_node',
+				b'a': {b'id': source_id, b'target': target}}), source)
+		return {'find_node_reply.new': measure(find_node, False), 'find_node_reply.retransmit': measure(find_node, True)}
+	finally:
+		dht.shutdown()
+
+benchmarks = [bench_bdecode, bench_krpc_message, bench_krpc_encode, bench_metainfo, bench_compact_nodes,
+	bench_node_id, bench_router, bench_router_contention, bench_krpc_loopback, bench_reply_cache, bench_lookup]
+
+def run_benchmarks(names = []):
+	""" Run the benchmarks whose name contains one of the given names (default: all) """
+	result = {}
+	for bench in benchmarks:
+		if (not names) or any(name in bench.__name__ for name in names):
+			result.update(bench())
+	return {'python': platform.python_implementation() + ' ' + platform.python_version(),
+		'platform': platform.platform(), 'setup': dict(bench_setup), 'results': result}
+
+def compare_results(results, baseline, threshold = 0.1):
+	""" Return {name: (time, baseline time, relative change)} and the list of names slower by more than threshold """
+	comparison = {}
+	for name, value in results.items():
+		if name in baseline:
+			change = value['time'] / baseline[name]['time'] - 1
+			comparison[name] = (value['time'], baseline[name]['time'], change)
+	return (comparison, sorted(name for name, (t, t_base, change) in comparison.items() if change > threshold))
+
+if __name__ == '__main__':
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	names = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	options = dict((arg[2:].split('=', 1) + [None])[:2] for arg in sys.argv[1:] if arg.startswith('--'))
+	if 'quick' in options:
+		bench_setup.update({'min_time': 0.02, 'warmup': 0, 'repetitions': 1,
+			'router_sizes': [1000, 10000], 'swarm_size': 100, 'swarm_lookups': 5})
+	for key in ['warmup', 'repetitions']:
+		if options.get(key):
+			bench_setup[key] = int(options[key])
+	report = run_benchmarks(names)
+	if options.get('save'): # store results as baseline for later runs
+		with open(options['save'], 'w') as fp:
+			json.dump(report, fp, indent = 1, sort_keys = True)
+	if 'json' in options:
+		sys.stdout.write(json.dumps(report, indent = 1, sort_keys = True) + '\n')
+	else:
+		for name, value in sorted(report['results'].items()):
+			log.critical('%-50s %12.3f us %12d calls/s' % (name, value['time'] * 1e6, 1 / value['time']))
+	if options.get('baseline'):
+		with open(options['baseline']) as fp:
+			baseline = json.load(fp)['results']
+		(comparison, regressions) = compare_results(report['results'], baseline, float(options.get('threshold') or 0.1))
+		for name, (t, t_base, change) in sorted(comparison.items()):
+			log.critical('%-50s %12.3f us %12.3f us %+8.1f%%' % (name, t * 1e6, t_base * 1e6, change * 100))
+		if regressions:
+			log.critical('regressions: %s' % ', '.join(regressions))
+			sys.exit(1)
@@ -58,6 +58,45 @@ def bencode(x):
 	bencode_proc(result, x)
 	return b''.join(result)
 
+class BencodeTemplate(object):
+	""" Pre-encoded form of messages with a fixed structure - only the values at the given
+		field paths (tuples of dictionary keys) vary between messages.
+		encode(x) returns the same bytes as bencode(x) for every x with the structure of
+		the template message, the values of x outside of the fields are not read. """
+	def __init__(self, x, fields):
+		self._parts = [[]] # constant parts before / between / after the fields
+		self._fields = []
+		self._compile(x, (), set(fields))
+		self._parts = [b''.join(part) for part in self._parts]
+		self._head = self._parts[0]
+		self._steps = list(zip(self._fields, self._parts[1:]))
+
+	def encode(self, x):
+		result = [self._head]
+		for (path, part) in self._steps:
+			value = x
+			for key in path:
+				value = value[key]
+			if type(value) == bytes:
+				result.extend((str_to_bytes(str(len(value))), b':', value, part))
+			else:
+				bencode_proc(result, value)
+				result.append(part)
+		return b''.join(result)
+
+	def _compile(self, x, path, fields):
+		if path in fields:
+			self._fields.append(path)
+			self._parts.append([])
+		elif type(x) == dict:
+			self._parts[-1].append(b'd')
+			for k, v in sorted(x.items()):
+				bencode_proc(self._parts[-1], k)
+				self._compile(v, path + (k,), fields)
+			self._parts[-1].append(b'e')
+		else:
+			bencode_proc(self._parts[-1], x)
+
 # Decoding functions ##############################################
 
 bdecode_marker_int = ord('i')
@@ -67,57 +106,233 @@ bdecode_marker_list = ord('l')
 bdecode_marker_dict = ord('d')
 bdecode_marker_end = ord('e')
 
-def bdecode_proc(msg, pos):
-	t = msg[pos]
-	if t == bdecode_marker_int:
-		pos += 1
-		pos_end = msg.index(b'e', pos)
-		return (int(msg[pos:pos_end]), pos_end + 1)
-	elif t >= bdecode_marker_str_min and t <= bdecode_marker_str_max:
-		sep = msg.index(b':', pos)
-		n = int(msg[pos:sep])
-		sep += 1
-		return (bytes(msg[sep:sep + n]), sep + n)
-	elif t == bdecode_marker_dict:
-		result = {}
-		pos += 1
-		while msg[pos] != bdecode_marker_end:
-			k, pos = bdecode_proc(msg, pos)
-			result[k], pos = bdecode_proc(msg, pos)
-		return (result, pos + 1)
-	elif t == bdecode_marker_list:
-		result = []
-		pos += 1
-		while msg[pos] != bdecode_marker_end:
-			v, pos = bdecode_proc(msg, pos)
-			result.append(v)
-		return (result, pos + 1)
-	raise BTFailure("invalid bencoded data (invalid token)! %r" % msg)
+bdecode_max_depth = 512 # default limit for the nesting of lists and dictionaries
+
+def bdecode_buffer(msg):
+	""" Return an object with find() and integer indexing for the given bytes-like object
+		A memoryview covering a whole bytes / bytearray / mmap object is replaced by that object.
+		Other memoryviews (slices, or any view on python 2 where memoryview.obj is missing) are
+		copied, since their offset in the underlying object is not accessible - to decode part
+		of a buffer without copying, pass the buffer itself with pos / end instead of a slice. """
+	if isinstance(msg, memoryview):
+		obj = getattr(msg, 'obj', None) # python 3.3+
+		if (obj is not None) and hasattr(obj, 'find') and (msg.nbytes == len(obj)):
+			return obj
+		msg = msg.tobytes()
+	if sys.version_info[0] < 3 and isinstance(msg, str):
+		return bytearray(msg)
+	return msg
 
-def bdecode_extra(msg):
+def bdecode_proc(msg, pos = 0, max_depth = bdecode_max_depth, zero_copy = False):
+	""" Iteratively decode the value at position pos of msg - returns (value, end position)
+		With zero_copy, byte strings (except dictionary keys) are returned as memoryview
+		slices of msg, which stay valid as long as msg is unchanged. """
+	if zero_copy:
+		view = memoryview(msg)
+	msg_len = len(msg)
+	find = msg.find
+	stack = [] # enclosing (container, key, is_dict) of the current container
+	(container, key, is_dict) = (None, None, False)
+	while True:
+		t = msg[pos]
+		if t >= bdecode_marker_str_min and t <= bdecode_marker_str_max:
+			sep = find(b':', pos)
+			if sep < 0:
+				raise BTFailure('invalid bencoded data (string without separator)')
+			n = int(msg[pos:sep])
+			sep += 1
+			pos = sep + n
+			if pos > msg_len:
+				raise BTFailure('invalid bencoded data (string exceeds data)')
+			if is_dict and (key == None):
+				key = bytes(msg[sep:pos])
+				continue
+			if zero_copy:
+				value = view[sep:pos]
+			else:
+				value = bytes(msg[sep:pos])
+		elif t == bdecode_marker_int:
+			pos_end = find(b'e', pos)
+			if pos_end < 0:
+				raise BTFailure('invalid bencoded data (unterminated integer)')
+			value = int(msg[pos + 1:pos_end])
+			pos = pos_end + 1
+		elif (t == bdecode_marker_dict) or (t == bdecode_marker_list):
+			if len(stack) >= max_depth:
+				raise BTFailure('invalid bencoded data (nesting depth exceeds %d)' % max_depth)
+			stack.append((container, key, is_dict))
+			is_dict = (t == bdecode_marker_dict)
+			if is_dict:
+				container = {}
+			else:
+				container = []
+			key = None
+			pos += 1
+			continue
+		elif (t == bdecode_marker_end) and stack and (key == None):
+			value = container
+			(container, key, is_dict) = stack.pop()
+			pos += 1
+		else:
+			raise BTFailure('invalid bencoded data (invalid token at position %d)' % pos)
+		if is_dict:
+			if key == None:
+				key = value
+				continue
+			container[key] = value
+			key = None
+		elif container is not None:
+			container.append(value)
+		else:
+			return (value, pos)
+
+def bdecode_extra(msg, pos = 0, max_depth = bdecode_max_depth, max_size = None, zero_copy = False):
+	""" Decode the value at position pos of msg - returns (value, end position)
+		msg can be a bytes, bytearray, memoryview or mmap object, see bdecode_buffer about copies """
+	if (max_size != None) and (len(msg) > max_size):
+		raise BTFailure('invalid bencoded data (size exceeds %d bytes)' % max_size)
 	try:
-		result, pos = bdecode_proc(bytearray(msg), 0)
-	except (IndexError, KeyError, ValueError):
-		raise BTFailure("invalid bencoded data! %r" % msg)
-	return (result, pos)
+		return bdecode_proc(bdecode_buffer(msg), pos, max_depth, zero_copy)
+	except (IndexError, KeyError, ValueError, TypeError):
+		raise BTFailure('invalid bencoded data! %r' % msg[:256])
+
+def bdecode_skip(msg, pos = 0, max_depth = bdecode_max_depth):
+	""" Return the end position of the value at position pos of msg without decoding it """
+	find = msg.find
+	depth = 0
+	while True:
+		t = msg[pos]
+		if t >= bdecode_marker_str_min and t <= bdecode_marker_str_max:
+			sep = find(b':', pos)
+			if sep < 0:
+				raise BTFailure('invalid bencoded data (string without separator)')
+			pos = sep + 1 + int(msg[pos:sep])
+		elif t == bdecode_marker_int:
+			pos = find(b'e', pos) + 1
+			if pos <= 0:
+				raise BTFailure('invalid bencoded data (unterminated integer)')
+		elif (t == bdecode_marker_dict) or (t == bdecode_marker_list):
+			depth += 1
+			if depth > max_depth:
+				raise BTFailure('invalid bencoded data (nesting depth exceeds %d)' % max_depth)
+			pos += 1
+			continue
+		elif (t == bdecode_marker_end) and depth:
+			depth -= 1
+			pos += 1
+		else:
+			raise BTFailure('invalid bencoded data (invalid token at position %d)' % pos)
+		if not depth:
+			if pos > len(msg):
+				raise BTFailure('invalid bencoded data (string exceeds data)')
+			return pos
 
-def bdecode(msg):
+def bdecode_dict_spans_extra(msg, pos = 0, max_depth = bdecode_max_depth):
+	""" Return ({key: (start, end)}, end position) for the bencoded dictionary at position pos of msg
+		The values itself are not decoded - eg. bdecode_extra(msg, start) returns the value of a key """
+	msg = bdecode_buffer(msg)
+	result = {}
 	try:
-		result, pos = bdecode_extra(msg)
-	except (IndexError, KeyError, ValueError):
-		raise BTFailure("invalid bencoded data: %r" % msg)
+		if msg[pos] != bdecode_marker_dict:
+			raise BTFailure('invalid bencoded data (dictionary expected)')
+		pos += 1
+		while msg[pos] != bdecode_marker_end:
+			key, start = bdecode_proc(msg, pos, 0)
+			pos = bdecode_skip(msg, start, max_depth)
+			result[key] = (start, pos)
+	except (IndexError, ValueError, TypeError):
+		raise BTFailure('invalid bencoded data! %r' % msg[pos:pos + 256])
+	return (result, pos + 1)
+
+def bdecode_dict_spans(msg, max_depth = bdecode_max_depth):
+	""" Return {key: (start, end)} with the positions of the values in the bencoded dictionary msg """
+	result, pos = bdecode_dict_spans_extra(msg, 0, max_depth)
 	if pos != len(msg):
 		raise BTFailure("invalid bencoded value (data after valid prefix)")
 	return result
 
+def bdecode_dict_with_spans(msg, max_depth = bdecode_max_depth):
+	""" Decode the bencoded dictionary msg - returns (dictionary, {key: (start, end)}) with the positions
+		of the encoded values. Top-level strings are decoded inline, so the common flat dictionaries
+		(eg. the KRPC envelope) take a single pass without a call per value. """
+	msg = bdecode_buffer(msg)
+	(result, spans) = ({}, {})
+	(find, msg_len, pos) = (msg.find, len(msg), 0)
+	try:
+		if msg[pos] != bdecode_marker_dict:
+			raise BTFailure('invalid bencoded data (dictionary expected)')
+		pos += 1
+		while msg[pos] != bdecode_marker_end:
+			if not (bdecode_marker_str_min <= msg[pos] <= bdecode_marker_str_max):
+				raise BTFailure('invalid bencoded data (invalid key at position %d)' % pos)
+			sep = find(b':', pos)
+			if sep < 0:
+				raise BTFailure('invalid bencoded data (string without separator)')
+			start = sep + 1 + int(msg[pos:sep])
+			key = bytes(msg[sep + 1:start])
+			t = msg[start]
+			if t >= bdecode_marker_str_min and t <= bdecode_marker_str_max:
+				sep = find(b':', start)
+				pos = sep + 1 + int(msg[start:sep])
+				if (sep < 0) or (pos > msg_len):
+					raise BTFailure('invalid bencoded data (string exceeds data)')
+				result[key] = bytes(msg[sep + 1:pos])
+			else:
+				(result[key], pos) = bdecode_proc(msg, start, max_depth - 1)
+			spans[key] = (start, pos)
+	except (IndexError, KeyError, ValueError, TypeError):
+		raise BTFailure('invalid bencoded data! %r' % msg[pos:pos + 256])
+	if pos + 1 != msg_len:
+		raise BTFailure("invalid bencoded value (data after valid prefix)")
+	return (result, spans)
+
+def bdecode(msg, max_depth = bdecode_max_depth, max_size = None, zero_copy = False, pos = 0, end = None):
+	""" Decode the value stored in msg[pos:end] without copying msg[pos:end] """
+	if end is None:
+		end = len(msg)
+	if (max_size != None) and (end - pos > max_size):
+		raise BTFailure('invalid bencoded data (size exceeds %d bytes)' % max_size)
+	result, value_end = bdecode_extra(msg, pos, max_depth, None, zero_copy)
+	if value_end != end:
+		raise BTFailure("invalid bencoded value (data after valid prefix)")
+	return result
+
 if __name__ == '__main__':
 	import logging
 	logging.basicConfig()
 	test = {b'k1': 145, b'k2': {b'sk1': list(range(10)), b'sk2': b'0'*60}}
 	for x in range(100):
 		assert(bdecode(bencode(test)) == test)
-	for test_bytes in [b'd5:keyi0ee', b'x3:keyi0ee', b'd3:keyi0ee...']:
+	assert(bdecode(b'l' * 10000 + b'e' * 10000, max_depth = 20000)) # no recursion limit
+	template = BencodeTemplate(test, [(b'k1',), (b'k2', b'sk2')])
+	for value in [0, -12, b'', b'1:x', [b'a', {b'b': 1}], {b'z': b'', b'a': 2}]:
+		test_msg = {b'k1': value, b'k2': {b'sk1': list(range(10)), b'sk2': value}}
+		assert(template.encode(test_msg) == bencode(test_msg))
+	view_test = bdecode(b'd3:keyl5:valueee', zero_copy = True)
+	assert(isinstance(view_test[b'key'][0], memoryview) and (view_test[b'key'][0] == b'value'))
+	framed = bytearray(b'xx' + bencode(test) + b'yy')
+	assert(bdecode(framed, pos = 2, end = len(framed) - 2) == test)
+	assert(bdecode(memoryview(framed)[2:-2]) == test) # copied slice
+	assert(bdecode(memoryview(bencode(test))) == test)
+	view_test = bdecode(framed, zero_copy = True, pos = 2, end = len(framed) - 2)
+	framed[framed.find(b'0' * 60)] = ord('1') # the value is a view of framed, not a copy
+	assert(view_test[b'k2'][b'sk2'].tobytes() == b'1' + b'0' * 59)
+	try:
+		bdecode(framed, pos = 2, end = len(framed) - 3)
+		assert(False)
+	except BTFailure:
+		pass
+	test_msg = {b'a': {b'id': b'x' * 20}, b'ip': b'', b'q': b'ping', b't': b'\x01', b'v': [1, b'2'], b'y': b'q'}
+	(values, spans) = bdecode_dict_with_spans(bencode(test_msg))
+	assert(values == test_msg)
+	assert(all(bencode(test_msg)[start:end] == bencode(test_msg[key]) for (key, (start, end)) in spans.items()))
+	for test_bytes in [b'd5:keyi0ee', b'x3:keyi0ee', b'd3:keyi0ee...', b'l' * 1000 + b'e' * 1000, b'd3:keye', b'5:abc']:
 		try:
 			bdecode(test_bytes)
 		except BTFailure as ex:
 			logging.exception('expected bdecode exception')
+		try:
+			bdecode_dict_with_spans(test_bytes)
+			assert(False)
+		except BTFailure:
+			pass
@@ -0,0 +1,219 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import struct, threading, collections, time, logging
+from utils import encode_connection, decode_connection, get_address_family, get_time, Histogram
+
+# Binary log of KRPC datagrams - a file header followed by one record per datagram:
+#   timestamp (double), direction (0: received, 1: sent), length of the connection, length of the data,
+#   the connection (compact ip / port) and the raw datagram
+capture_magic = b'KRPCCAP\x01'
+capture_record = struct.Struct('!dBBH')
+capture_in = 0
+capture_out = 1
+
+class CaptureWriter(object):
+	def __init__(self, fp):
+		""" Append the KRPC datagrams given to write() to the binary file object fp
+			(eg. KRPCPeer.set_capture(CaptureWriter(open('traffic.cap', 'wb')))) """
+		self._fp = fp
+		self._lock = threading.Lock()
+		self._fp.write(capture_magic)
+		self.packets = 0
+
+	def write(self, direction, connection, data):
+		connection_data = encode_connection(connection)
+		record = capture_record.pack(get_time(), direction, len(connection_data), len(data)) + connection_data + data
+		with self._lock:
+			self._fp.write(record)
+			self.packets += 1
+
+	def close(self):
+		with self._lock:
+			self._fp.close()
+
+
+def iter_capture(fp):
+	""" Iterate over the (timestamp, direction, connection, data) records of a capture file object """
+	if fp.read(len(capture_magic)) != capture_magic:
+		raise ValueError('Not a KRPC capture file')
+	while True:
+		header = fp.read(capture_record.size)
+		if len(header) < capture_record.size: # end of file (or truncated record)
+			return
+		(timestamp, direction, connection_len, data_len) = capture_record.unpack(header)
+		connection_data = fp.read(connection_len)
+		data = fp.read(data_len)
+		if len(data) < data_len:
+			return
+		yield (timestamp, direction, decode_connection(connection_data), data)
+
+
+# Transport for a KRPCPeer / DHT without sockets - the packets given to deliver() are
+# received by the listen thread of the peer. Packets sent to the own connection are looped back
+# (eg. to bootstrap the DHT from itself), all other packets are counted and dropped.
+class ReplayTransport(object):
+	def __init__(self, connection, max_queue = 1000):
+		self.family = get_address_family(connection)
+		self._connection = connection
+		self._queue = collections.deque()
+		self._max_queue = max_queue
+		self._condition = threading.Condition()
+		self._closed = False
+		self._busy = False # a packet is handled by the listen thread
+		self.queue_delay = Histogram((0.0001, 0.001, 0.01, 0.1, 1, 10))
+		self.sent = 0
+
+	def deliver(self, data, source_connection, block = True):
+		""" Queue a packet for the listen thread - blocks while the queue is full (unless block is False) """
+		with self._condition:
+			while block and (len(self._queue) >= self._max_queue) and not self._closed:
+				self._condition.wait(0.1)
+			self._queue.append((time.time(), data, source_connection))
+			self._condition.notify_all()
+
+	def join(self, timeout = None):
+		""" Wait until all queued packets are handled """
+		t_end = (timeout != None) and (time.time() + timeout)
+		with self._condition:
+			while (self._queue or self._busy) and not self._closed:
+				if t_end and (time.time() > t_end):
+					return False
+				self._condition.wait(0.1)
+		return True
+
+	def sendto(self, data, connection):
+		if connection == self._connection:
+			self.deliver(data, connection, block = False)
+		else:
+			self.sent += 1
+
+	def recvfrom(self, timeout = None):
+		with self._condition:
+			self._busy = False # the previous packet was handled
+			self._condition.notify_all()
+			if not self._queue:
+				self._condition.wait(timeout)
+			if self._queue:
+				(t_queued, data, source_connection) = self._queue.popleft()
+				self.queue_delay.observe(time.time() - t_queued)
+				self._busy = True
+				return (data, source_connection)
+
+	def get_queue_size(self):
+		return (len(self._queue), 0)
+
+	def close(self):
+		with self._condition:
+			self._closed = True
+			self._queue.clear()
+			self._condition.notify_all()
+
+
+def replay_capture(records, transport, speed = 1):
+	""" Deliver the received packets of the capture records to the transport - with the original
+		timing divided by speed (speed = None: as fast as they are handled). Returns a dictionary
+		with the number of packets, the duration and the maximal delay behind the schedule. """
+	(t_start, t_first, lag_max, packets) = (time.time(), None, 0, 0)
+	for (timestamp, direction, connection, data) in records:
+		if direction != capture_in:
+			continue
+		if speed:
+			if t_first == None:
+				t_first = timestamp
+			delay = t_start + (timestamp - t_first) / float(speed) - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				lag_max = max(lag_max, -delay)
+		transport.deliver(data, connection)
+		packets += 1
+	transport.join()
+	duration = time.time() - t_start
+	return {'packets': packets, 'duration': duration, 'rate': packets / max(duration, 1e-9), 'lag_max': lag_max}
+
+
+def replay_dht(records, speed = None, connection = ('127.0.0.1', 16881), setup = {}):
+	""" Replay the received packets of the capture records into a new DHT node without sockets -
+		the node bootstraps from itself. Returns the replay statistics (see replay_capture)
+		together with the queue delay histogram of the transport and the metrics of the node. """
+	from dht import DHT
+	transport = ReplayTransport(connection)
+	dht = DHT(connection, connection, dict({'bootstrap_lookup': False, 'maintain_t': -1}, **setup), transport = transport)
+	try:
+		result = replay_capture(records, transport, speed)
+	finally:
+		dht.shutdown()
+	result['queue_delay'] = transport.queue_delay
+	result['metrics'] = dht.get_metrics()
+	return result
+
+
+if __name__ == '__main__':
+	import io, sys, random
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	def show_replay(name, result):
+		log.critical('%s: %d packets in %.2fs (%.0f packets/s, lag %.3fs, queue delay p99 %r) - %d queries handled' % (
+			name, result['packets'], result['duration'], result['rate'], result['lag_max'],
+			result['queue_delay'].get_quantile(0.99), sum(value['count'] for (key, value)
+				in result['metrics'].get_snapshot().items() if key.startswith('dht_query_seconds'))))
+	if len(sys.argv) > 1: # replay the given capture file (speed: 0 = maximum)
+		speed = float((sys.argv[2:] + [0])[0])
+		with open(sys.argv[1], 'rb') as fp:
+			show_replay(sys.argv[1], replay_dht(list(iter_capture(fp)), speed or None))
+		sys.exit(0)
+	# Capture the traffic of a node in a simulated swarm
+	from simnet import SimNetwork, create_swarm, fill_routing_tables
+	random.seed(42)
+	fp = io.BytesIO()
+	with SimNetwork(latency = (0.01, 0.1), seed = 42) as network:
+		nodes = create_swarm(network, 100, join_lookup = False)
+		fill_routing_tables(network, nodes)
+		capture = CaptureWriter(fp)
+		nodes[0].set_capture(capture)
+		for idx in range(20):
+			(source, target) = network.random.sample(nodes, 2)
+			list(source.dht_find_node(target.get_identities()[0]))
+			list(source.dht_get_peers(target.get_identities()[0]))
+		nodes[0].set_capture(None)
+		for dht in nodes:
+			dht.shutdown()
+	records = list(iter_capture(io.BytesIO(fp.getvalue())))
+	assert(len(records) == capture.packets)
+	received = [record for record in records if record[1] == capture_in]
+	log.critical('captured %d packets (%d received, %d bytes) over %.1fs' % (len(records), len(received),
+		len(fp.getvalue()), records[-1][0] - records[0][0]))
+	for speed in [None, 100]:
+		result = replay_dht(records, speed)
+		show_replay('replay (speed %s)' % (speed or 'max'), result)
+		assert(result['packets'] == len(received))
+		assert(result['metrics'].counter('krpc_received_packets_total').get() >= len(received))
+	for test_data in [b'', b'KRPCCAP\x00']:
+		try:
+			list(iter_capture(io.BytesIO(test_data)))
+		except ValueError:
+			log.exception('expected capture exception')
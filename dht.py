@@ -22,20 +22,31 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import os, time, socket, hashlib, hmac, threading, logging, random, inspect
+import os, time, socket, hashlib, hmac, threading, logging, random, binascii, bisect
 from bencode import bencode, bdecode
-from utils import encode_uint32, encode_ip, encode_connection, encode_nodes, AsyncTimeout
-from utils import decode_uint32, decode_ip, decode_connection, decode_nodes, start_thread, ThreadManager
-from krpc import KRPCPeer, KRPCError
+from utils import encode_uint32, encode_uint64, encode_ip, encode_ip6, encode_address, encode_connection, encode_nodes, encode_nodes6
+from utils import decode_uint32, decode_uint64, decode_ip, decode_connection, decode_nodes, decode_nodes6, decode_values
+from utils import AsyncTimeout, iter_async_results, start_thread, ThreadManager, TimedLock, get_scheduler, get_address_family, get_time
+from krpc import KRPCPeer, KRPCError, KRPCQueryError, krpc_error_protocol, krpc_error_method
+from metrics import MetricsRegistry
 
 # BEP #0042 - prefix is based on ip and last byte of the node id - 21 most significant bits must match
-#  * ip = ip address in string format eg. "127.0.0.1"
+#  * ip = ip address in string format eg. "127.0.0.1" or "::1"
 def bep42_prefix(ip, crc32_salt, first_node_bits): # first_node_bits determines the last 3 bits
 	from crc32c import crc32c
-	ip_asint = decode_uint32(encode_ip(ip))
-	value = crc32c(bytearray(encode_uint32((ip_asint & 0x030f3fff) | ((crc32_salt & 0x7) << 29))))
+	if ':' in ip: # IPv6 - only the first 64 bits of the address are used
+		ip_asint = decode_uint64(encode_ip6(ip)[:8])
+		value = crc32c(bytearray(encode_uint64((ip_asint & 0x0103070f1f3f7fff) | ((crc32_salt & 0x7) << 61))))
+	else:
+		ip_asint = decode_uint32(encode_ip(ip))
+		value = crc32c(bytearray(encode_uint32((ip_asint & 0x030f3fff) | ((crc32_salt & 0x7) << 29))))
 	return (value & 0xfffff800) | ((first_node_bits << 8) & 0x00000700)
 
+def bep42_id(node_id, connection):
+	node_id = bytearray(node_id)
+	bep42_value = encode_uint32(bep42_prefix(connection[0], node_id[-1], node_id[0]))
+	return bytes(bytearray(bep42_value[:3]) + node_id[3:])
+
 def valid_id(node_id, connection):
 	node_id = bytearray(node_id)
 	vprefix = bep42_prefix(connection[0], node_id[-1], 0)
@@ -47,38 +58,167 @@ def decode_id(node_id):
 	except:
 		return int(node_id.encode('hex'), 16)
 
+def encode_id(id_cmp):
+	return binascii.unhexlify('%040x' % id_cmp)
+
+def unique_connections(nodes): # keep the first node of each connection
+	(result, seen) = ([], set())
+	for node in nodes:
+		if node.connection not in seen:
+			seen.add(node.connection)
+			result.append(node)
+	return result
+
+# Precompiled dispatch entry of a KRPC reply method - fun(self, send_krpc_reply, arg1, arg2, ...)
+class DHT_QueryHandler(object):
+	def __init__(self, method, fun):
+		self.method = method
+		self.fun = fun
+		code = fun.__code__
+		arg_names = code.co_varnames[2:code.co_argcount] # skip self and send_krpc_reply
+		n_required = len(arg_names) - len(fun.__defaults__ or ())
+		self.args_required = [(arg.encode('ascii'), arg) for arg in arg_names[:n_required]]
+		self.args_optional = [(arg.encode('ascii'), arg) for arg in arg_names[n_required:]]
+
+	def get_kwargs(self, remote_args_dict):
+		result = {}
+		for (arg_bytes, arg) in self.args_required:
+			try:
+				result[arg] = remote_args_dict[arg_bytes]
+			except KeyError:
+				raise KRPCQueryError(krpc_error_protocol, 'Missing argument %s for %s' % (arg, self.method.decode('ascii')))
+		for (arg_bytes, arg) in self.args_optional:
+			if arg_bytes in remote_args_dict:
+				result[arg] = remote_args_dict[arg_bytes]
+		return result
+
+# Decorator to register a reply method in the dispatch table
+def dht_reply_handler(reply_handler, method):
+	def register_reply_handler(fun):
+		reply_handler[method] = DHT_QueryHandler(method, fun)
+		return fun
+	return register_reply_handler
+
+
+# Smoothed round trip time and variance estimation (RFC 6298)
+class RTTEstimator(object):
+	__slots__ = ['srtt', 'rttvar']
+
+	def __init__(self):
+		self.srtt = None
+		self.rttvar = None
+
+	def update(self, rtt):
+		if self.srtt == None:
+			(self.srtt, self.rttvar) = (rtt, rtt / 2.)
+		else:
+			self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+			self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+	def get_timeout(self, max_timeout, min_timeout = 0.25):
+		if self.srtt == None:
+			return max_timeout
+		return min(max_timeout, max(min_timeout, self.srtt + 4 * self.rttvar))
+
+
+# Node states described in BEP #0005
+node_state_good = 'good'
+node_state_questionable = 'questionable'
+node_state_bad = 'bad'
+
 class DHT_Node(object):
+	rtt_unknown = 1.0 # assumed round trip time of unmeasured nodes when ranking nodes
+	good_t = 15 * 60 # nodes stay good for 15min after a response
+	bad_attempts = 2 # nodes become bad after failing to respond to multiple queries in a row
+
 	def __init__(self, connection, id, version = None):
-		self.connection = (socket.gethostbyname(connection[0]), connection[1])
+		if ':' not in connection[0]:
+			connection = (socket.gethostbyname(connection[0]), connection[1])
+		self.connection = connection
 		self.set_id(id)
 		self.version = version
 		self.tokens = {} # tokens to gain write access to self.values
 		self.values = {}
 		self.attempt = 0
 		self.pending = 0
-		self.last_ping = 0
+		self.last_ping = 0 # last query sent to the node
+		self.last_response = 0 # last response received from the node
+		self.last_query = 0 # last query received from the node
+		self.rtt = RTTEstimator()
 
 	def set_id(self, id):
 		self.id = id
 		self.id_cmp = decode_id(id)
+		self._valid = None
+
+	def is_valid(self):
+		""" Return whether the id matches the connection (BEP #0042) - the result is cached """
+		if self._valid == None:
+			self._valid = valid_id(self.id, self.connection)
+		return self._valid
+
+	def get_state(self, now = None):
+		if self.attempt >= self.bad_attempts:
+			return node_state_bad
+		if now == None:
+			now = get_time()
+		if now - self.last_response < self.good_t:
+			return node_state_good
+		if self.last_response and (now - self.last_query < self.good_t):
+			return node_state_good
+		return node_state_questionable
+
+	def get_rtt(self):
+		if self.rtt.srtt == None:
+			return self.rtt_unknown
+		return self.rtt.srtt
 
 	def __repr__(self):
-		return 'id:%s con:%15s:%-5d v:%20s c:%5s last:%.2f' % (hex(self.id_cmp), self.connection[0], self.connection[1],
-			repr(self.version), valid_id(self.id, self.connection), time.time() - self.last_ping)
+		return 'id:%s con:%15s:%-5d v:%20s c:%5s last:%.2f rtt:%.3f' % (hex(self.id_cmp), self.connection[0], self.connection[1],
+			repr(self.version), self.is_valid(), get_time() - self.last_ping, self.get_rtt())
+
+
+# Immutable view of the routing table - the node tuples are shared with the router and with
+# other snapshots, since the writers replace them instead of modifying them
+class DHT_RouterSnapshot(object):
+	def __init__(self, version, nodes, ids, time):
+		self.version = version # number of structural changes of the router
+		self.nodes = nodes # id -> tuple of nodes
+		self.ids = ids # sorted ids
+		self.time = time
 
 
 # Trivial node list implementation
+# Writers (adding / removing nodes) serialize on a lock, while the readers work on the
+# last published snapshot without locking. A new snapshot is published by the first read
+# after snapshot_t seconds or after changes of more than snapshot_frac of the table - the
+# writes in between are copied in a single batch.
 class DHT_Router(object):
-	def __init__(self, name, user_setup = {}):
-		setup = {'report_t': 10, 'limit_t': 30, 'limit_N': 2000, 'redeem_t': 300, 'redeem_frac': 0.05}
+	def __init__(self, name, user_setup = {}, metrics = None, metric_labels = {}):
+		setup = {'report_t': 10, 'limit_t': 30, 'limit_N': 2000, 'redeem_t': 300, 'redeem_frac': 0.05, 'snapshot_t': 0.5, 'snapshot_frac': 0.01}
 		setup.update(user_setup)
 
 		self._log = logging.getLogger(self.__class__.__name__ + '.%s' % name)
 		# This is our (trivial) routing table.
-		self._nodes = {}
-		self._nodes_lock = threading.RLock()
+		self._nodes = {} # id -> tuple of nodes (replaced on each change)
+		self._ids = [] # sorted ids of self._nodes - close nodes are found without scanning the whole table
+		self._version = 0
+		self._snapshot = DHT_RouterSnapshot(0, {}, [], 0)
+		(self._snapshot_t, self._snapshot_frac) = (setup['snapshot_t'], setup['snapshot_frac'])
+		metrics = metrics or MetricsRegistry()
+		self._nodes_lock = TimedLock(metrics.histogram('dht_router_lock_wait_seconds',
+			'Time spent waiting for the routing table write lock', buckets = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1), **metric_labels))
+		self._metric_snapshots = metrics.counter('dht_router_snapshots_total', 'Published routing table snapshots', **metric_labels)
 		self._nodes_protected = set()
 		self._connections_bad = set()
+		metrics.gauge('dht_router_ids', 'Number of ids in the routing table', fun = lambda: len(self._nodes), **metric_labels)
+		metrics.gauge('dht_router_nodes', 'Number of nodes in the routing table',
+			fun = lambda: sum(map(len, list(self._nodes.values()))), **metric_labels)
+		metrics.gauge('dht_router_banned', 'Number of blacklisted connections', fun = lambda: len(self._connections_bad), **metric_labels)
+		metrics.gauge('dht_router_protected', 'Number of protected ids', fun = lambda: len(self._nodes_protected), **metric_labels)
+		for state in [node_state_good, node_state_questionable, node_state_bad]:
+			metrics.gauge('dht_router_node_states', 'Number of nodes in each BEP #0005 state',
+				fun = lambda state = state: self.get_state_count().get(state, 0), **dict(metric_labels, state = state))
 
 		# Start maintainance threads
 		self._threads = ThreadManager(self._log.getChild('maintainance'))
@@ -86,23 +226,29 @@ class DHT_Router(object):
 
 		# - Report status of routing table
 		def _show_status():
-			with self._nodes_lock:
-				self._log.info('Routing table contains %d ids with %d nodes (%d bad, %s protected)' %\
-					(len(self._nodes), sum(map(len, self._nodes.values())),
-					len(self._connections_bad), len(self._nodes_protected)))
-				if self._log.isEnabledFor(logging.DEBUG):
-					for node in self.get_nodes():
-						self._log.debug('\t%r' % node)
+			snapshot = self.get_snapshot()
+			self._log.info('Routing table contains %d ids with %d nodes (%d bad, %s protected)' %\
+				(len(snapshot.nodes), sum(map(len, snapshot.nodes.values())),
+				len(self._connections_bad), len(self._nodes_protected)))
+			if self._log.isEnabledFor(logging.DEBUG):
+				for node in self.get_nodes():
+					self._log.debug('\t%r' % node)
 		self._threads.start_continuous_thread(_show_status, thread_interval = setup['report_t'], thread_waitfirst = True)
-		# - Limit number of active nodes
+		# - Limit number of active nodes - bad nodes are replaced first, then questionable nodes
 		def _limit(maxN):
 			self._log.debug('Starting limitation of nodes')
-			N = len(self.get_nodes())
+			if not self._nodes:
+				return
+			N = len(self.get_nodes(sorter = None))
 			if N > maxN:
-				for node in self.get_nodes(N - maxN,
-						expression = lambda n: n.connection not in self._connections_bad,
-						sorter = lambda x: random.random()):
-					self.remove_node(node, force = True)
+				state_order = {node_state_bad: 0, node_state_questionable: 1, node_state_good: 2}
+				now = get_time()
+				nodes = self.get_nodes(N - maxN,
+					expression = lambda n: n.connection not in self._connections_bad,
+					sorter = lambda n: (state_order[n.get_state(now)], random.random()))
+				with self._nodes_lock: # remove the nodes in a single batch
+					for node in nodes:
+						self.remove_node(node, force = True)
 		self._threads.start_continuous_thread(_limit, thread_interval = setup['limit_t'], maxN = setup['limit_N'], thread_waitfirst = True)
 		# - Redeem random nodes from the blacklist
 		def _redeem_connections(fraction):
@@ -121,9 +267,11 @@ class DHT_Router(object):
 			self._nodes_protected.update(node_id_list)
 
 
-	def good_node(self, node):
-		with self._nodes_lock:
-			node.attempt = 0
+	def good_node(self, node, rtt = None):
+		node.attempt = 0
+		node.last_response = get_time()
+		if rtt != None:
+			node.rtt.update(rtt)
 
 
 	def remove_node(self, node, force = False):
@@ -131,122 +279,432 @@ class DHT_Router(object):
 			node.attempt += 1
 			if node.id in self._nodes:
 				max_attempts = 2
-				if valid_id(node.id, node.connection):
+				if node.is_valid():
 					max_attempts = 5
 				if force or ((node.id not in self._nodes_protected) and (node.attempt > max_attempts)):
 					if not force:
 						self._connections_bad.add(node.connection)
 					def is_not_removed_node(n):
 						return n.connection != node.connection
-					self._nodes[node.id] = list(filter(is_not_removed_node, self._nodes[node.id]))
-					if not self._nodes[node.id]:
+					node_list = tuple(filter(is_not_removed_node, self._nodes[node.id]))
+					if node_list:
+						self._nodes[node.id] = node_list
+					else:
 						self._nodes.pop(node.id)
+						del self._ids[bisect.bisect_left(self._ids, node.id)]
+					self._version += 1
 
 
 	def register_node(self, node_connection, node_id, node_version = None):
+		if node_connection in self._connections_bad:
+			if self._log.isEnabledFor(logging.DEBUG):
+				self._log.debug('rejected bad connection %s' % repr(node_connection))
+			return
+		for node in self._nodes.get(node_id, ()): # known nodes are found without locking
+			if node.connection == node_connection:
+				if not node.version:
+					node.version = node_version
+				return node
 		with self._nodes_lock:
-			if node_connection in self._connections_bad:
-				if self._log.isEnabledFor(logging.DEBUG):
-					self._log.debug('rejected bad connection %s' % repr(node_connection))
-				return
-			for node in self._nodes.get(node_id, []):
+			node_list = self._nodes.get(node_id, ())
+			for node in node_list: # added by another writer in the meantime
 				if node.connection == node_connection:
-					if not node.version:
-						node.version = node_version
 					return node
 			if self._log.isEnabledFor(logging.DEBUG):
 				self._log.debug('added connection %s' % repr(node_connection))
 			node = DHT_Node(node_connection, node_id, node_version)
-			self._nodes.setdefault(node_id, []).append(node)
+			if not node_list:
+				bisect.insort(self._ids, node_id)
+			self._nodes[node_id] = node_list + (node,)
+			self._version += 1
 			return node
 
+	def get_snapshot(self):
+		""" Return the last published snapshot of the routing table - a new snapshot is published if
+			the table has changed by more than snapshot_frac or the snapshot is older than snapshot_t seconds.
+			Readers only wait for the writers to publish the first snapshot. """
+		snapshot = self._snapshot
+		changes = self._version - snapshot.version
+		if changes and ((changes > self._snapshot_frac * len(snapshot.ids)) or (get_time() - snapshot.time >= self._snapshot_t)):
+			if self._nodes_lock.acquire(blocking = not snapshot.ids):
+				try:
+					snapshot = self._publish()
+				finally:
+					self._nodes_lock.release()
+		return snapshot
+
+	def flush(self):
+		""" Publish all changes of the routing table immediately """
+		with self._nodes_lock:
+			return self._publish()
+
+	# Return the number of nodes in each node state
+	def get_state_count(self):
+		result = {}
+		now = get_time()
+		for node_list in self.get_snapshot().nodes.values(): # empty result for an empty table
+			for node in node_list:
+				state = node.get_state(now)
+				result[state] = result.get(state, 0) + 1
+		return result
+
 	# Return nodes matching a filter expression
 	def get_nodes(self, N = None, expression = lambda n: True, sorter = lambda n: n.id_cmp):
-		if len(self._nodes) == 0:
+		snapshot = self.get_snapshot()
+		if len(snapshot.nodes) == 0:
 			raise RuntimeError('No nodes in routing table!')
 		result = []
-		with self._nodes_lock:
-			for id, node_list in self._nodes.items():
-				result.extend(filter(expression, node_list))
-		result.sort(key = sorter)
+		for node_list in snapshot.nodes.values():
+			result.extend(filter(expression, node_list))
+		if sorter:
+			result.sort(key = sorter)
 		if N == None:
 			return result
 		return result[:N]
 
+	# Return the N closest nodes (XOR metric) matching a filter expression - only the nodes
+	# sharing the longest id prefixes with id_cmp are evaluated. With unique, only the closest
+	# node of each connection is returned (remote hosts can run several ids)
+	def get_close_nodes(self, id_cmp, N, expression = lambda n: True, sorter = None, unique = False):
+		if sorter == None:
+			sorter = lambda n: n.id_cmp ^ id_cmp
+		if id_cmp >> 160: # invalid id
+			if unique:
+				return unique_connections(self.get_nodes(None, expression, sorter))[:N]
+			return self.get_nodes(N, expression, sorter)
+		snapshot = self.get_snapshot()
+		if len(snapshot.nodes) == 0:
+			raise RuntimeError('No nodes in routing table!')
+		(ids, nodes) = (snapshot.ids, snapshot.nodes)
+		bits = max(0, 160 - (len(ids) // N).bit_length()) # expected prefix range with N nodes
+		while True:
+			(pos_start, pos_end) = (0, len(ids))
+			if bits < 160:
+				prefix = id_cmp >> bits
+				pos_start = bisect.bisect_left(ids, encode_id(prefix << bits))
+				if (prefix + 1) >> (160 - bits) == 0:
+					pos_end = bisect.bisect_left(ids, encode_id((prefix + 1) << bits), pos_start)
+			result = []
+			for node_id in ids[pos_start:pos_end]:
+				result.extend(filter(expression, nodes[node_id]))
+			found = len(result)
+			if unique:
+				found = len(set(node.connection for node in result))
+			if (found >= N) or (pos_end - pos_start == len(ids)):
+				break
+			bits += 1
+		result.sort(key = sorter)
+		if unique:
+			result = unique_connections(result)
+		return result[:N]
+
+	# Private members #################################################
+
+	def _publish(self): # called with the lock held
+		if self._snapshot.version != self._version:
+			self._snapshot = DHT_RouterSnapshot(self._version, dict(self._nodes), list(self._ids), get_time())
+			self._metric_snapshots.inc()
+		return self._snapshot
+
+
+# State of an iterative lookup on the closest nodes - shared by the blocking lookups of the DHT
+# and the asyncio lookups (see aiodht.py), which only differ in the way they wait for the results.
+# With IPv6 support, the closest nodes of both routing tables are queried in the same rounds
+# and asked for nodes of both address families
+class DHT_Search(object):
+	# wait before the next round while all close nodes are busy with other lookups (with exponential back off)
+	(busy_wait_min, busy_wait_max) = (0.01, 0.2)
+
+	def __init__(self, dht, query_fun, process_fun, search_value, timeout, retries):
+		(self._dht, self._query_fun, self._process_fun) = (dht, query_fun, process_fun)
+		(self._search_value, self._timeout, self._retries) = (search_value, timeout, retries)
+		self._id_cmp = decode_id(search_value)
+		self._sender_id = dht._get_identity(search_value).id
+		self._query_kwargs = {}
+		if dht._nodes6:
+			self._sender_id6 = dht._node6.id
+			self._query_kwargs['want'] = [b'n4', b'n6']
+		(self._returned, self._used_connections, self._discovered_nodes) = (set(), {}, set())
+		self.round_count = 0 # number of query rounds (hops) - rounds without queries are not counted
+		self.busy_wait = 0 # time to wait before the next round (see start_round)
+		self._trace = None # LookupTrace of the lookup (see DHT.set_lookup_recorder)
+		if dht._lookup_recorder:
+			self._trace = dht._lookup_recorder.start_trace(query_fun.__name__, search_value)
+
+	def start_round(self):
+		""" Send the queries of the next round - returns [(t_end, node, async_result), ...] sorted by
+			the timeout of the queries or None if there are no nodes left to query - if the list is empty,
+			since all close nodes are busy, the next round should start after busy_wait seconds """
+		(dht, id_cmp, used_connections) = (self._dht, self._id_cmp, self._used_connections)
+		def above_retries(c):
+			return used_connections[c] > self._retries
+		blacklist_connections = set(filter(above_retries, used_connections))
+		def valid_node(n):
+			return n and (n.connection not in blacklist_connections)
+		self._discovered_nodes = set(filter(valid_node, self._discovered_nodes))
+		def not_blacklisted(n):
+			return n.connection not in blacklist_connections
+		def sort_by_id(n): # prefer fast nodes within the same distance bucket
+			return ((n.id_cmp ^ id_cmp).bit_length(), n.get_rtt())
+		close_nodes = set(dht._nodes.get_close_nodes(id_cmp, 20, not_blacklisted, sort_by_id))
+		if dht._nodes6:
+			try:
+				close_nodes.update(dht._nodes6.get_close_nodes(id_cmp, 20, not_blacklisted, sort_by_id))
+			except RuntimeError: # no IPv6 nodes yet
+				pass
+
+		if not close_nodes.union(self._discovered_nodes):
+			return None
+
+		node_result_list = []
+		round_count = self.round_count + 1
+		def sort_by_distance(n): # deterministic query order
+			return (n.id_cmp ^ id_cmp, n.connection)
+		trace = self._trace
+		for node in sorted(close_nodes.union(self._discovered_nodes), key = sort_by_distance): # submit all queries at the same time
+			if node.pending > 3:
+				if trace:
+					trace.busy()
+				continue
+			if dht._log.isEnabledFor(logging.DEBUG):
+				dht._log.debug('asking %s' % repr(node))
+			t_end = get_time() + dht._get_query_timeout(node, self._timeout)
+			if dht._nodes6 and (get_address_family(node.connection) == socket.AF_INET6):
+				async_result = self._query_fun(node.connection, self._sender_id6, self._search_value, **self._query_kwargs)
+			else:
+				async_result = self._query_fun(node.connection, self._sender_id, self._search_value, **self._query_kwargs)
+			with dht._node_lock:
+				node.pending += 1
+			node_result_list.append((t_end, node, async_result))
+			used_connections[node.connection] = used_connections.get(node.connection, 0) + 1
+			if trace:
+				trace.query(async_result, node, round_count, t_end)
+		if node_result_list:
+			(self.round_count, self.busy_wait) = (round_count, 0)
+		else:
+			self.busy_wait = min(max(2 * self.busy_wait, self.busy_wait_min), self.busy_wait_max)
+		node_result_list.sort(key = lambda entry: entry[0])
+		return node_result_list
+
+	def process_result(self, node, async_result, timeout):
+		""" Wait up to timeout seconds for the result of the query to node - returns the list of new results """
+		dht = self._dht
+		result = dht._eval_dht_response(node, async_result, timeout)
+		with dht._node_lock:
+			node.pending -= 1
+		nodes = dht._register_nodes(result)
+		if self._trace:
+			new_nodes = len(set(filter(None, nodes)).difference(self._discovered_nodes))
+		self._discovered_nodes.update(nodes)
+		new_results = []
+		for tmp in self._process_fun(node, result):
+			if tmp not in self._returned:
+				self._returned.add(tmp)
+				new_results.append(tmp)
+		if self._trace:
+			self._trace.result(async_result, result, nodes, new_nodes, len(new_results))
+		return new_results
+
+	def finish(self):
+		""" Called by the lookup once it is exhausted or closed """
+		if self._trace:
+			self._trace.finish(self.round_count)
+
 
 class DHT(object):
 	def __init__(self, listen_connection, bootstrap_connection = ('router.bittorrent.com', 6881),
-			user_setup = {}, user_router = None):
-		""" Start DHT peer on given (host, port) and bootstrap connection to the DHT """
-		setup = {'discover_t': 180, 'check_t': 30, 'check_N': 10}
+			user_setup = {}, user_router = None, metrics = None, listen_connection6 = None, bootstrap_connection6 = None,
+			transport = None, transport6 = None, metric_labels = {}):
+		""" Start DHT peer on given (host, port) and bootstrap connection(s) to the DHT
+			With listen_connection6, the node also joins the IPv6 DHT (BEP #0032)
+			Statistics are collected in the given (or a new) metrics registry - nodes sharing
+			a registry need different metric_labels, which are added to all metrics of the node
+			The KRPC packets are exchanged over the given transports (default: UDP sockets) """
+		t_start = get_time()
+		setup = {'maintain_t': 30, 'maintain_N': 20, 'refresh_t': 15 * 60, 'rtt_min_timeout': 0.25,
+			'bootstrap_timeout': 5, 'bootstrap_lookup': True, 'cleanup_t': 10, 'identities': 1, 'node_id': None,
+			'reply_cache_N': 1000, 'reply_cache_t': 10}
 		setup.update(user_setup)
+		if not isinstance(bootstrap_connection[0], (tuple, list)):
+			bootstrap_connection = [bootstrap_connection]
+		if not bootstrap_connection6:
+			bootstrap_connection6 = bootstrap_connection
+		elif not isinstance(bootstrap_connection6[0], (tuple, list)):
+			bootstrap_connection6 = [bootstrap_connection6]
 		self._log = logging.getLogger(self.__class__.__name__ + '.%s.%d' % listen_connection)
-		self._log.info('Starting DHT node with bootstrap connection %s:%d' % bootstrap_connection)
+		self._log.info('Starting DHT node with bootstrap connections %s' %
+			', '.join(map(lambda c: '%s:%d' % tuple(c), bootstrap_connection)))
 		listen_connection = (socket.gethostbyname(listen_connection[0]), listen_connection[1])
 		# Generate key for token generation
 		self._token_key = os.urandom(20)
+		self._metrics = metrics or MetricsRegistry()
+		self._tracer = None # StageTracer for sampled packets (see set_tracer)
+		self._lookup_recorder = None # LookupRecorder for the traces of the lookups (see set_lookup_recorder)
 		# Start KRPC server process and Routing table
-		self._krpc = KRPCPeer(listen_connection, self._handle_query)
+		self._krpc = KRPCPeer(listen_connection, self._handle_query, metrics = self._metrics, transport = transport,
+			cleanup_interval = setup['cleanup_t'], reply_cache_size = setup['reply_cache_N'], reply_cache_timeout = setup['reply_cache_t'],
+			metric_labels = metric_labels)
 		if not user_router:
-			user_router = DHT_Router('%s.%d' % listen_connection, setup)
+			user_router = DHT_Router('%s.%d' % listen_connection, setup, metrics = self._metrics, metric_labels = metric_labels)
 		self._nodes = user_router
-		self._node = DHT_Node(listen_connection, os.urandom(20))
+		self._node = DHT_Node(listen_connection, setup['node_id'] or os.urandom(20))
+		# All node ids hosted by this DHT node - the list is replaced (not modified) when adding ids
+		self._identities = [self._node]
+		# IPv6 nodes are kept in a separate routing table and use their own node id (BEP #0032)
+		(self._krpc6, self._nodes6, self._node6) = (None, None, None)
+		if listen_connection6:
+			self._krpc6 = KRPCPeer(listen_connection6, self._handle_query, metrics = self._metrics, transport = transport6,
+				cleanup_interval = setup['cleanup_t'], reply_cache_size = setup['reply_cache_N'], reply_cache_timeout = setup['reply_cache_t'],
+				metric_labels = dict(metric_labels, family = 'ipv6'))
+			self._nodes6 = DHT_Router('[%s].%d' % listen_connection6, setup, metrics = self._metrics,
+				metric_labels = dict(metric_labels, family = 'ipv6'))
+			self._node6 = DHT_Node(listen_connection6, os.urandom(20))
 		self._node_lock = threading.RLock()
-		# Start bootstrap process
+		self._identity_lookups = [] # added identities waiting for their bootstrap lookup
+		# Round trip time estimate over all nodes - used for nodes without own measurement
+		self._rtt = RTTEstimator()
+		self._rtt_min_timeout = setup['rtt_min_timeout']
+		(self._lookup_latency, self._lookup_rounds) = ({}, {})
+		for method in [b'find_node', b'get_peers']:
+			self._lookup_latency[method] = self._metrics.histogram('dht_lookup_seconds',
+				'Duration of iterative DHT lookups', buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100),
+				**dict(metric_labels, method = method.decode('ascii')))
+			self._lookup_rounds[method] = self._metrics.histogram('dht_lookup_rounds',
+				'Number of query rounds (hops) of iterative DHT lookups', buckets = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50),
+				**dict(metric_labels, method = method.decode('ascii')))
+		# Statistics about handled remote queries
+		(self._query_calls, self._query_latency) = ({}, {})
+		for method in self._reply_handler:
+			labels = dict(metric_labels, method = method.decode('ascii'))
+			self._query_calls[method] = self._metrics.counter('dht_queries_total', 'Handled DHT queries', **labels)
+			self._query_latency[method] = self._metrics.histogram('dht_query_seconds', 'Processing time of DHT queries', **labels)
+		# Statistics about threads and the shared scheduler of the periodic jobs
+		scheduler = get_scheduler()
+		self._metrics.gauge('process_threads', 'Number of threads in the process', fun = threading.active_count, **metric_labels)
+		self._metrics.gauge('scheduler_jobs', 'Number of periodic jobs waiting in the scheduler', fun = scheduler.get_job_count,
+			**metric_labels)
+		self._metrics.gauge('scheduler_lag_max_seconds', 'Maximal delay of a periodic job', fun = lambda: scheduler.lag_max,
+			**metric_labels)
+		for quantile in [0.5, 0.99]:
+			self._metrics.gauge('scheduler_lag_seconds', 'Delay of periodic jobs (upper bucket limit)',
+				fun = lambda quantile = quantile: scheduler.lag.get_quantile(quantile) or 0, **dict(metric_labels, quantile = str(quantile)))
+		self._metric_startup = self._metrics.gauge('dht_startup_seconds',
+			'Time from the start of the node until the first response to the bootstrap lookup', **metric_labels)
+		# Start bootstrap process - all bootstrap nodes are pinged at the same time
+		def bootstrap(krpc, router, node, connection_list):
+			node.connection = self._bootstrap(krpc, router, node.id, connection_list, setup['bootstrap_timeout'])
+			# BEP #0042 Enable security extension
+			node.set_id(bep42_id(node.id, node.connection))
+			assert(valid_id(node.id, node.connection))
+			router.protect_nodes([node.id])
 		try:
-			tmp = self.ping(bootstrap_connection, sender_id = self._node.id).get_result(timeout = 1)
+			bootstrap(self._krpc, self._nodes, self._node, bootstrap_connection)
 		except Exception:
+			for (krpc, router) in [(self._krpc, self._nodes), (self._krpc6, self._nodes6)]:
+				if krpc:
+					krpc.shutdown()
+					router.shutdown()
 			raise
-			tmp = {b'ip': encode_connection(listen_connection), b'r': {b'id': self._node.id}}
-		self._node.connection = decode_connection(tmp[b'ip'])
-		self._bootstrap_node = self._nodes.register_node(bootstrap_connection, tmp[b'r'][b'id'])
-		# BEP #0042 Enable security extension
-		local_id = bytearray(self._node.id)
-		bep42_value = encode_uint32(bep42_prefix(self._node.connection[0], local_id[-1], local_id[0]))
-		self._node.set_id(bep42_value[:3] + self._node.id[3:])
-		assert(valid_id(self._node.id, self._node.connection))
-		self._nodes.protect_nodes([self._node.id])
+		if self._krpc6: # the node continues without IPv6 if the IPv6 bootstrap fails
+			try:
+				bootstrap(self._krpc6, self._nodes6, self._node6, bootstrap_connection6)
+			except Exception:
+				self._log.exception('IPv6 bootstrap failed - continuing without IPv6')
+				self._krpc6.shutdown()
+				self._nodes6.shutdown()
+				(self._krpc6, self._nodes6, self._node6) = (None, None, None)
 
 		# Start maintainance threads
 		self._threads = ThreadManager(self._log.getChild('maintainance'))
 
-		# Periodically ping nodes in the routing table
-		def _check_nodes(N, last_ping = 15 * 60, timeout = 5):
-			def get_unpinged(n):
-				return time.time() - n.last_ping > last_ping
-			check_nodes = list(self._nodes.get_nodes(N, expression = get_unpinged))
-			if not check_nodes:
-				return
-			self._log.debug('Starting cleanup of known nodes')
-			node_result_list = []
-			for node in check_nodes:
-				node.last_ping = time.time()
-				node_result_list.append((node, node.id, self.ping(node.connection, self._node.id)))
-			t_end = time.time() + timeout
-			for (node, node_id, async_result) in node_result_list:
-				result = self._eval_dht_response(node, async_result, timeout = max(0, t_end - time.time()))
-				if result and (node.id != result.get(b'id')): # remove nodes with changing identities
-					self._nodes.remove_node(node, force = True)
-		self._threads.start_continuous_thread(_check_nodes, thread_interval = setup['check_t'], N = setup['check_N'])
-
-		# Try to discover a random node to populate routing table
-		def _discover_nodes():
-			self._log.debug('Starting discovery of random node')
-			for idx, entry in enumerate(self.dht_find_node(os.urandom(20), timeout = 1)):
-				if idx > 10:
-					break
-		self._threads.start_continuous_thread(_discover_nodes, thread_interval = setup['discover_t'])
+		# Periodically ping questionable nodes and refresh stale buckets
+		self._bucket_refresh = {}
+		self._metric_maintenance = {}
+		for kind in ['ping', 'refresh']:
+			self._metric_maintenance[kind] = self._metrics.counter('dht_maintenance_packets_total',
+				'Queries sent to maintain the routing table', **dict(metric_labels, kind = kind))
+		self._threads.start_continuous_thread(self._maintain_nodes, thread_interval = setup['maintain_t'],
+			N = setup['maintain_N'], refresh_t = setup['refresh_t'])
+		if self._nodes6:
+			self._threads.start_continuous_thread(self._maintain_nodes, thread_interval = setup['maintain_t'],
+				N = setup['maintain_N'], refresh_t = setup['refresh_t'], family = socket.AF_INET6)
+
+		# Populate the buckets close to the own id
+		if setup['bootstrap_lookup']:
+			self._threads.start_thread('bootstrap lookup', True, self._bootstrap_lookup, self._node, t_start)
+			if self._node6:
+				self._threads.start_thread('bootstrap lookup', True, self._bootstrap_lookup, self._node6)
+		for idx in range(setup['identities'] - 1):
+			self.add_identity()
 
 
 	def get_external_connection(self):
 		return self._node.connection
 
+	def get_external_connection6(self):
+		""" Return the discovered external IPv6 connection (None without IPv6 support) """
+		if self._node6:
+			return self._node6.connection
+
+	def add_identity(self, node_id = None):
+		""" Host an additional (BEP #0042 valid) node id - returns the new node id
+			Incoming queries are answered by the id closest to their target,
+			all ids share the socket and the routing table of this node """
+		node = DHT_Node(self._node.connection, bep42_id(node_id or os.urandom(20), self._node.connection))
+		node.values = self._node.values # announced peers are shared between all ids
+		self._nodes.protect_nodes([node.id])
+		with self._node_lock:
+			self._identities = self._identities + [node]
+			self._identity_lookups.append(node)
+			if len(self._identity_lookups) == 1: # the lookups of all added ids run one after another
+				self._threads.start_thread('identity lookups', True, self._run_identity_lookups)
+		return node.id
+
+	def get_identities(self):
+		return list(map(lambda node: node.id, self._identities))
+
+	def set_tracer(self, tracer):
+		""" Record the latency of the stages of sampled incoming packets with the given StageTracer
+			(None disables the tracing) - in addition to the KRPC stages, queries are split into
+			dispatch, register_node, get_nodes and encode_nodes """
+		self._tracer = tracer
+		for krpc in filter(None, [self._krpc, self._krpc6]):
+			krpc.set_tracer(tracer)
+
+	def set_capture(self, capture):
+		""" Record the KRPC datagrams of the node with the given CaptureWriter (None stops the capture) """
+		for krpc in filter(None, [self._krpc, self._krpc6]):
+			krpc.set_capture(capture)
+
+	def set_lookup_recorder(self, recorder):
+		""" Record the queries of each lookup with the given LookupRecorder (None stops the recording) """
+		self._lookup_recorder = recorder
+
+	def start_profiler(self, profiler = None):
+		""" Profile the thread handling the incoming IPv4 packets (see KRPCPeer.start_profiler) """
+		self._krpc.start_profiler(profiler)
+
+	def stop_profiler(self):
+		return self._krpc.stop_profiler()
+
+	def get_query_stats(self):
+		""" Return number of calls and latency histogram of each handled KRPC method """
+		return dict((method, {'calls': self._query_calls[method].get(), 'latency': self._query_latency[method]})
+			for method in self._reply_handler)
+
+	def get_metrics(self):
+		""" Return the metrics registry with the statistics of this node """
+		return self._metrics
+
 	def shutdown(self):
 		""" This function allows to cleanly shutdown the DHT. """
 		self._log.info('shutting down DHT')
 		self._threads.shutdown() # Trigger shutdown of maintainance threads
 		self._krpc.shutdown() # Stop listening for incoming connections
 		self._nodes.shutdown()
+		if self._krpc6:
+			self._krpc6.shutdown()
+			self._nodes6.shutdown()
 		self._threads.join() # Trigger shutdown of maintainance threads
 
 	# Handle remote queries
@@ -256,87 +714,251 @@ class DHT(object):
 			self._log.debug('handling query from %r: %r' % (source_connection, rec))
 		try:
 			remote_args_dict = rec[b'a']
+			handler = self._reply_handler.get(rec[b'q'])
+		except (KeyError, TypeError):
+			raise KRPCQueryError(krpc_error_protocol, 'Malformed query')
+		if not isinstance(remote_args_dict, dict):
+			raise KRPCQueryError(krpc_error_protocol, 'Malformed query arguments')
+		if not handler:
+			raise KRPCQueryError(krpc_error_method, 'Method Unknown')
+		callback_kwargs = handler.get_kwargs(remote_args_dict)
+		tracer = self._tracer
+		if tracer:
+			tracer.mark('dispatch')
+		try:
+			t_start = time.time()
 			if b'id' in remote_args_dict:
-				self._nodes.register_node(source_connection, remote_args_dict[b'id'], rec.get(b'v'))
-			query = rec[b'q']
-			callback = self._reply_handler[query]
-			callback_kwargs = {}
-			for arg in inspect.getargspec(callback).args[2:]:
-				arg_bytes = arg.encode('ascii')
-				if arg_bytes in remote_args_dict:
-					callback_kwargs[arg] = remote_args_dict[arg_bytes]
+				node = self._get_router(source_connection).register_node(source_connection, remote_args_dict[b'id'], rec.get(b'v'))
+				if node:
+					node.last_query = get_time()
+			if tracer:
+				tracer.mark('register_node')
 
 			def send_dht_reply(**kwargs):
 				# BEP #0042 - require ip field in answer
 				return send_krpc_reply(kwargs, {b'ip': encode_connection(source_connection)})
 			send_dht_reply.connection = source_connection
-			callback(self, send_dht_reply, **callback_kwargs)
+			handler.fun(self, send_dht_reply, **callback_kwargs)
+			self._query_calls[handler.method].inc()
+			self._query_latency[handler.method].observe(time.time() - t_start)
 		except Exception:
 			self._log.exception('Error while processing request %r' % rec)
 
+	# Ping all bootstrap nodes at the same time - returns the external connection reported by the first answer
+	def _bootstrap(self, krpc, router, sender_id, bootstrap_connection, timeout):
+		bootstrap_result_list = []
+		for connection in bootstrap_connection:
+			try:
+				bootstrap_result_list.append(krpc.send_krpc_query(connection, b'ping', id = sender_id))
+			except socket.error: # unable to resolve host name
+				self._log.warning('Unable to contact bootstrap node %s:%d' % tuple(connection))
+		processed = set()
+		def register_bootstrap_node(async_result):
+			if async_result in processed:
+				return
+			processed.add(async_result)
+			try:
+				result = async_result.get_result(0)
+				router.register_node(async_result.get_source(), result[b'r'][b'id'], result.get(b'v'))
+				return decode_connection(result[b'ip'])
+			except Exception: # no or invalid answer from bootstrap node
+				pass
+		external_connection = None
+		for async_result in iter_async_results(bootstrap_result_list, timeout = timeout):
+			external_connection = register_bootstrap_node(async_result)
+			if external_connection:
+				break
+		if not external_connection:
+			raise AsyncTimeout('No answer from bootstrap nodes')
+		for async_result in bootstrap_result_list: # register the remaining bootstrap nodes once they answer
+			async_result.add_callback(register_bootstrap_node)
+		return external_connection
+
+	# Bootstrap lookups of the added identities - a single thread runs them one after another
+	def _run_identity_lookups(self):
+		while not self._threads.shutdown_in_progress():
+			with self._node_lock:
+				node = self._identity_lookups[0]
+			self._bootstrap_lookup(node)
+			with self._node_lock:
+				self._identity_lookups.pop(0)
+				if not self._identity_lookups:
+					break
+
+	# Search for the own id and record the time until the first response of this lookup
+	def _bootstrap_lookup(self, identity, t_start = None, timeout = 5):
+		responding_nodes = []
+		def process_bootstrap(node, result):
+			if result:
+				if not responding_nodes and t_start:
+					self._metric_startup.set(get_time() - t_start)
+				responding_nodes.append(node)
+			return []
+		for entry in self._iter_krpc_search(self.find_node, process_bootstrap, identity.id, timeout, retries = 1):
+			pass
+		if responding_nodes and t_start:
+			self._log.info('Bootstrap lookup finished after %.2fs with %d responses' %
+				(get_time() - t_start, len(responding_nodes)))
+
+	# Maintain the routing table with at most N queries:
+	#  * buckets without activity since refresh_t are refreshed by a find_node query
+	#    for a random id in the bucket sent to a node of the bucket
+	#    (each hosted id has its own view of the buckets in the shared routing table)
+	#  * questionable nodes are pinged - nodes failing to respond become bad and get replaced
+	def _maintain_nodes(self, N, refresh_t, timeout = 5, family = socket.AF_INET):
+		(router, identities) = (self._nodes, self._identities)
+		if family == socket.AF_INET6:
+			(router, identities) = (self._nodes6, [self._node6])
+		try:
+			nodes = router.get_nodes(sorter = None)
+		except RuntimeError: # empty routing table
+			return
+		now = get_time()
+
+		node_result_list = []
+		def send_query(node, sender, kind, query_fun, *args):
+			node.last_ping = get_time()
+			t_end = node.last_ping + self._get_query_timeout(node, timeout)
+			node_result_list.append((t_end, node, query_fun(node.connection, sender.id, *args)))
+			self._metric_maintenance[kind].inc()
+		for identity in identities:
+			buckets = {}
+			for node in nodes:
+				buckets.setdefault((node.id_cmp ^ identity.id_cmp).bit_length(), []).append(node)
+			for idx, bucket in sorted(buckets.items()):
+				if len(node_result_list) >= N:
+					break
+				last_change = max([self._bucket_refresh.get((identity.id, idx), 0)] + [n.last_response for n in bucket])
+				if (idx == 0) or (now - last_change < refresh_t):
+					continue
+				self._bucket_refresh[(identity.id, idx)] = now
+				distance = (1 << (idx - 1)) | random.getrandbits(idx)
+				distance &= (1 << idx) - 1 # random id with the same distance prefix
+				node = min(bucket, key = lambda n: (n.attempt, n.get_rtt()))
+				send_query(node, identity, 'refresh', self.find_node, encode_id(identity.id_cmp ^ distance))
+		def is_questionable(n):
+			return (n.get_state(now) == node_state_questionable) and (now - n.last_ping > timeout)
+		queried = set(node for (t_end, node, async_result) in node_result_list)
+		for node in sorted(filter(is_questionable, nodes), key = lambda n: n.last_ping):
+			if len(node_result_list) >= N:
+				break
+			if node not in queried:
+				send_query(node, self._get_identity(node.id, node.connection), 'ping', self.ping)
+		if not node_result_list:
+			return
+		self._log.debug('Starting maintenance of %d nodes' % len(node_result_list))
+
+		# The results are processed when they arrive and the remaining queries are expired after the
+		# last timeout - the job does not block a worker of the shared scheduler while waiting
+		(pending, pending_lock) = (set(range(len(node_result_list))), threading.Lock())
+		def process_result(idx):
+			with pending_lock:
+				if idx not in pending:
+					return
+				pending.remove(idx)
+			(t_end, node, async_result) = node_result_list[idx]
+			result = self._eval_dht_response(node, async_result, timeout = 0)
+			if result and (node.id != result.get(b'id')): # remove nodes with changing identities
+				router.remove_node(node, force = True)
+			self._register_nodes(result)
+		def expire_results():
+			for idx in sorted(pending):
+				process_result(idx)
+		for (idx, (t_end, node, async_result)) in enumerate(node_result_list):
+			async_result.add_callback(lambda async_result, idx = idx: process_result(idx))
+		self._threads.call_later(max(entry[0] for entry in node_result_list) - get_time(), expire_results)
+
+	# Return the routing table / KRPC peer for the address family of the connection
+	def _get_router(self, connection):
+		if self._nodes6 and (get_address_family(connection) == socket.AF_INET6):
+			return self._nodes6
+		return self._nodes
+
+	def _get_krpc(self, connection):
+		if self._krpc6 and (get_address_family(connection) == socket.AF_INET6):
+			return self._krpc6
+		return self._krpc
+
+	# Register the nodes (and nodes6) of a find_node / get_peers response - returns the registered nodes
+	def _register_nodes(self, result):
+		nodes = []
+		for node_id, node_connection in decode_nodes(result.get(b'nodes', b'')):
+			nodes.append(self._nodes.register_node(node_connection, node_id))
+		if self._nodes6:
+			for node_id, node_connection in decode_nodes6(result.get(b'nodes6', b'')):
+				nodes.append(self._nodes6.register_node(node_connection, node_id))
+		return nodes
+
+	# Return the hosted node closest to the given id (the IPv6 node id for queries from IPv6 nodes)
+	def _get_identity(self, target_id, connection = None):
+		if self._node6 and connection and (get_address_family(connection) == socket.AF_INET6):
+			return self._node6
+		identities = self._identities
+		if len(identities) == 1:
+			return identities[0]
+		target_id_cmp = decode_id(target_id)
+		return min(identities, key = lambda n: n.id_cmp ^ target_id_cmp)
+
+	# Timeout for a query to the given node - derived from the round trip time like the TCP RTO
+	def _get_query_timeout(self, node, max_timeout):
+		rtt = node.rtt
+		if rtt.srtt == None:
+			rtt = self._rtt
+		timeout = rtt.get_timeout(max_timeout, self._rtt_min_timeout)
+		return min(max_timeout, timeout * 2 ** min(node.attempt, 4)) # back off after failures
+
 	# Evaluate async KRPC result and notify the routing table about failures
 	def _eval_dht_response(self, node, async_result, timeout):
 		try:
 			result = async_result.get_result(timeout)
+			result_args = result[b'r']
 			node.version = result.get(b'v', node.version)
-			self._nodes.good_node(node)
-			return result[b'r']
+			rtt = async_result.get_rtt()
+			self._rtt.update(rtt)
+			self._get_router(node.connection).good_node(node, rtt)
+			return result_args
 		except AsyncTimeout: # The node did not reply
 			if self._log.isEnabledFor(logging.DEBUG):
 				self._log.debug('KRPC timeout %r' % node)
 		except KRPCError: # Some other error occured
 			if self._log.isEnabledFor(logging.INFO):
 				self._log.exception('KRPC Error %r' % node)
-		self._nodes.remove_node(node)
+		self._get_router(node.connection).remove_node(node)
 		async_result.discard_result()
 		return {}
 
-	# Iterate KRPC function on closest nodes - query_fun(connection, id, search_value)
-	def _iter_krpc_search(self, query_fun, process_fun, search_value, timeout, retries):
-		id_cmp = decode_id(search_value)
-		(returned, used_connections, discovered_nodes) = (set(), {}, set())
-		while not self._threads.shutdown_in_progress():
-			def above_retries(c):
-				return used_connections[c] > retries
-			blacklist_connections = set(filter(above_retries, used_connections))
-			def valid_node(n):
-				return n and (n.connection not in blacklist_connections)
-			discovered_nodes = set(filter(valid_node, discovered_nodes))
-			def not_blacklisted(n):
-				return n.connection not in blacklist_connections
-			def sort_by_id(n):
-				return n.id_cmp ^ id_cmp
-			close_nodes = set(self._nodes.get_nodes(N = 20, expression = not_blacklisted, sorter = sort_by_id))
-
-			if not close_nodes.union(discovered_nodes):
-				break
+	# Record the duration of a lookup until it is exhausted or closed
+	def _iter_timed(self, histogram, iterable):
+		t_start = get_time()
+		try:
+			for result in iterable:
+				yield result
+		finally:
+			histogram.observe(get_time() - t_start)
 
-			node_result_list = []
-			for node in close_nodes.union(discovered_nodes): # submit all queries at the same time
-				if node.pending > 3:
-					continue
-				if self._log.isEnabledFor(logging.DEBUG):
-					self._log.debug('asking %s' % repr(node))
-				async_result = query_fun(node.connection, self._node.id, search_value)
-				with self._node_lock:
-					node.pending += 1
-				node_result_list.append((node, async_result))
-				used_connections[node.connection] = used_connections.get(node.connection, 0) + 1
-
-
-			t_end = time.time() + timeout
-			for (node, async_result) in node_result_list: # sequentially retrieve results
-				if self._threads.shutdown_in_progress():
+	# Iterate KRPC function on closest nodes - query_fun(connection, id, search_value, [want])
+	# The queries of each round are submitted at the same time, their results are retrieved
+	# sequentially in the order of their timeouts (see DHT_Search)
+	def _iter_krpc_search(self, query_fun, process_fun, search_value, timeout, retries, rounds = None, stop = None):
+		search = DHT_Search(self, query_fun, process_fun, search_value, timeout, retries)
+		def is_stopped():
+			return self._threads.shutdown_in_progress() or (stop != None and stop())
+		try:
+			while not is_stopped():
+				node_result_list = search.start_round()
+				if node_result_list == None:
 					break
-				result = self._eval_dht_response(node, async_result, timeout = max(0, t_end - time.time()))
-				with self._node_lock:
-					node.pending -= 1
-				for node_id, node_connection in decode_nodes(result.get(b'nodes', b'')):
-					discovered_nodes.add(self._nodes.register_node(node_connection, node_id))
-				for tmp in process_fun(node, result):
-					if tmp not in returned:
-						returned.add(tmp)
+				if not node_result_list: # all close nodes are busy
+					self._threads.wait_shutdown(search.busy_wait)
+				for (t_end, node, async_result) in node_result_list: # sequentially retrieve results
+					if is_stopped():
+						break
+					for tmp in search.process_result(node, async_result, max(0, t_end - get_time())):
 						yield tmp
+		finally:
+			search.finish()
+			if rounds != None:
+				rounds.observe(search.round_count)
 
 	# syncronous query / async reply implementation of BEP #0005 (DHT Protocol) #
 	#############################################################################
@@ -349,91 +971,137 @@ class DHT(object):
 	#   (sync method)
 	def dht_ping(self, connection, timeout = 5):
 		try:
-			result = self.ping(connection, self._node.id).get_result(timeout)
+			result = self.ping(connection, self._get_identity(self._node.id, connection).id).get_result(timeout)
 			if result.get(b'r', {}).get(b'id'):
-				self._nodes.register_node(connection, result[b'r'][b'id'], result.get(b'v'))
+				self._get_router(connection).register_node(connection, result[b'r'][b'id'], result.get(b'v'))
 			return result.get(b'r', {})
 		except (AsyncTimeout, KRPCError):
 			pass
 	#   (verbatim, async KRPC method)
 	def ping(self, target_connection, sender_id):
-		return self._krpc.send_krpc_query(target_connection, b'ping', id = sender_id)
+		return self._get_krpc(target_connection).send_krpc_query(target_connection, b'ping', id = sender_id)
 	#   (reply method)
+	@dht_reply_handler(_reply_handler, b'ping')
 	def _ping(self, send_krpc_reply, id):
-		send_krpc_reply(id = self._node.id)
-	_reply_handler[b'ping'] = _ping
+		send_krpc_reply(id = self._get_identity(id, send_krpc_reply.connection).id)
 
 	# find_node methods
 	#   (sync method, iterating on close nodes)
-	def dht_find_node(self, search_id, timeout = 5, retries = 2):
+	def dht_find_node(self, search_id, timeout = 5, retries = 2, stop = None):
+		return self._iter_timed(self._lookup_latency[b'find_node'],
+			self._iter_krpc_search(self.find_node, self._process_find_node(search_id), search_id, timeout, retries,
+				self._lookup_rounds[b'find_node'], stop))
+	#   (lookup result processing - shared with the asyncio lookups)
+	def _process_find_node(self, search_id):
 		def process_find_node(node, result):
 			for node_id, node_connection in decode_nodes(result.get(b'nodes', b'')):
 				if node_id == search_id:
 					yield node_connection
-		return self._iter_krpc_search(self.find_node, process_find_node, search_id, timeout, retries)
+			for node_id, node_connection in decode_nodes6(result.get(b'nodes6', b'')):
+				if node_id == search_id:
+					yield node_connection
+		return process_find_node
 	#   (verbatim, async KRPC method)
-	def find_node(self, target_connection, sender_id, search_id):
-		return self._krpc.send_krpc_query(target_connection, b'find_node', id = sender_id, target = search_id)
+	def find_node(self, target_connection, sender_id, search_id, want = None):
+		if want: # (optional) list of address families (b'n4', b'n6') to return nodes for
+			return self._get_krpc(target_connection).send_krpc_query(target_connection, b'find_node',
+				id = sender_id, target = search_id, want = want)
+		return self._get_krpc(target_connection).send_krpc_query(target_connection, b'find_node',
+			id = sender_id, target = search_id)
 	#   (reply method)
-	def _find_node(self, send_krpc_reply, id, target):
-		id_cmp = decode_id(id)
+	@dht_reply_handler(_reply_handler, b'find_node')
+	def _find_node(self, send_krpc_reply, id, target, want = None):
+		send_krpc_reply(id = self._get_identity(target, send_krpc_reply.connection).id,
+			**self._get_close_nodes(target, 20, send_krpc_reply.connection, want))
+
+	# Return the nodes / nodes6 arguments of a find_node / get_peers reply (BEP #0032)
+	#  without want, only nodes of the address family of the querying node are returned
+	def _get_close_nodes(self, target, N, connection, want):
+		id_cmp = decode_id(target)
 		def select_valid(n):
-			return valid_id(n.id, n.connection)
-		def sort_by_id(n):
-			return n.id_cmp ^ id_cmp
-		send_krpc_reply(id = self._node.id, nodes = encode_nodes(self._nodes.get_nodes(N = 20,
-			expression = select_valid, sorter = sort_by_id)))
-	_reply_handler[b'find_node'] = _find_node
+			return n.is_valid()
+		if not isinstance(want, list):
+			want = [(get_address_family(connection) == socket.AF_INET6) and b'n6' or b'n4']
+		tracer = self._tracer
+		result = {}
+		if b'n4' in want:
+			nodes = self._nodes.get_close_nodes(id_cmp, N, select_valid, unique = True)
+			if tracer:
+				tracer.mark('get_nodes')
+			result['nodes'] = encode_nodes(nodes)
+			if tracer:
+				tracer.mark('encode_nodes')
+		if (b'n6' in want) and self._nodes6:
+			try:
+				result['nodes6'] = encode_nodes6(self._nodes6.get_close_nodes(id_cmp, N, select_valid, unique = True))
+			except RuntimeError: # no IPv6 nodes yet
+				result['nodes6'] = b''
+		return result
 
 	# get_peers methods
 	#   (sync method, iterating on close nodes)
-	def dht_get_peers(self, info_hash, timeout = 5, retries = 2):
+	def dht_get_peers(self, info_hash, timeout = 5, retries = 2, stop = None):
+		return self._iter_timed(self._lookup_latency[b'get_peers'],
+			self._iter_krpc_search(self.get_peers, self._process_get_peers(info_hash), info_hash, timeout, retries,
+				self._lookup_rounds[b'get_peers'], stop))
+	#   (lookup result processing - shared with the asyncio lookups)
+	def _process_get_peers(self, info_hash):
 		def process_get_peers(node, result):
 			if result.get(b'token'):
 				node.tokens[info_hash] = result[b'token'] # store token for subsequent announce_peer
-			for node_connection in map(decode_connection, result.get(b'values', b'')):
+			for node_connection in decode_values(result.get(b'values', [])):
 				yield node_connection
-		return self._iter_krpc_search(self.get_peers, process_get_peers, info_hash, timeout, retries)
+		return process_get_peers
 	#   (verbatim, async KRPC method)
-	def get_peers(self, target_connection, sender_id, info_hash):
-		return self._krpc.send_krpc_query(target_connection, b'get_peers', id = sender_id, info_hash = info_hash)
+	def get_peers(self, target_connection, sender_id, info_hash, want = None):
+		if want: # (optional) list of address families (b'n4', b'n6') to return nodes for
+			return self._get_krpc(target_connection).send_krpc_query(target_connection, b'get_peers',
+				id = sender_id, info_hash = info_hash, want = want)
+		return self._get_krpc(target_connection).send_krpc_query(target_connection, b'get_peers',
+			id = sender_id, info_hash = info_hash)
 	#   (reply method)
-	def _get_peers(self, send_krpc_reply, id, info_hash):
-		token = hmac.new(self._token_key, encode_ip(send_krpc_reply.connection[0]), hashlib.sha1).digest()
-		id_cmp = decode_id(id)
-		def select_valid(n):
-			return valid_id(n.id, n.connection)
-		def sort_by_id(n):
-			return n.id_cmp ^ id_cmp
-		reply_args = {'nodes': encode_nodes(self._nodes.get_nodes(N = 8, expression = select_valid, sorter = sort_by_id))}
-		if self._node.values.get(info_hash):
-			reply_args['values'] = list(map(encode_connection, self._node.values[info_hash]))
-		send_krpc_reply(id = self._node.id, token = token, **reply_args)
-	_reply_handler[b'get_peers'] = _get_peers
+	@dht_reply_handler(_reply_handler, b'get_peers')
+	def _get_peers(self, send_krpc_reply, id, info_hash, want = None):
+		token = hmac.new(self._token_key, encode_address(send_krpc_reply.connection[0]), hashlib.sha1).digest()
+		reply_args = self._get_close_nodes(info_hash, 8, send_krpc_reply.connection, want)
+		family = get_address_family(send_krpc_reply.connection)
+		def same_family(connection): # peers of the address family of the querying node
+			return get_address_family(connection) == family
+		values = list(filter(same_family, self._node.values.get(info_hash, [])))
+		if values:
+			reply_args['values'] = list(map(encode_connection, values))
+		send_krpc_reply(id = self._get_identity(info_hash, send_krpc_reply.connection).id, token = token, **reply_args)
 
 	# announce_peer methods
 	#   (sync method, announcing to all nodes giving tokens)
 	def dht_announce_peer(self, info_hash, implied_port = 1):
 		def has_info_hash_token(node):
 			return info_hash in node.tokens
-		for node in self._nodes.get_nodes(expression = has_info_hash_token):
-			yield self.announce_peer(node.connection, self._node.id, info_hash, self._node.connection[1],
+		nodes = self._nodes.get_nodes(expression = has_info_hash_token)
+		if self._nodes6:
+			try:
+				nodes.extend(self._nodes6.get_nodes(expression = has_info_hash_token))
+			except RuntimeError: # no IPv6 nodes
+				pass
+		for node in unique_connections(nodes): # a single announce to hosts with several ids
+			identity = self._get_identity(info_hash, node.connection)
+			yield self.announce_peer(node.connection, identity.id, info_hash, identity.connection[1],
 				node.tokens[info_hash], implied_port = implied_port)
 	#   (verbatim, async KRPC method)
 	def announce_peer(self, target_connection, sender_id, info_hash, port, token, implied_port = None):
 		req = {'id': sender_id, 'info_hash': info_hash, 'port': port, 'token': token}
 		if implied_port != None: # (optional) "1": port not reliable - remote should use source port
 			req['implied_port'] = implied_port
-		return self._krpc.send_krpc_query(target_connection, b'announce_peer', **req)
+		return self._get_krpc(target_connection).send_krpc_query(target_connection, b'announce_peer', **req)
 	#   (reply method)
+	@dht_reply_handler(_reply_handler, b'announce_peer')
 	def _announce_peer(self, send_krpc_reply, id, info_hash, port, token, implied_port = None):
-		local_token = hmac.new(self._token_key, encode_ip(send_krpc_reply.connection[0]), hashlib.sha1).digest()
+		local_token = hmac.new(self._token_key, encode_address(send_krpc_reply.connection[0]), hashlib.sha1).digest()
 		if (local_token == token) and valid_id(id, send_krpc_reply.connection): # Validate token and ID
 			if implied_port:
 				port = send_krpc_reply.connection[1]
 			self._node.values.setdefault(info_hash, []).append((send_krpc_reply.connection[0], port))
-			send_krpc_reply(id = self._node.id)
-	_reply_handler[b'announce_peer'] = _announce_peer
+			send_krpc_reply(id = self._get_identity(info_hash, send_krpc_reply.connection).id)
 
 
 if __name__ == '__main__':
@@ -446,6 +1114,12 @@ if __name__ == '__main__':
 	logging.getLogger('KRPCPeer.local').setLevel(logging.ERROR)
 	logging.getLogger('KRPCPeer.remote').setLevel(logging.ERROR)
 
+	# Metrics of an empty routing table
+	empty_metrics = MetricsRegistry()
+	empty_router = DHT_Router('empty', {}, metrics = empty_metrics)
+	assert('dht_router_node_states{state="good"} 0' in empty_metrics.get_prometheus_text())
+	empty_router.shutdown()
+
 	# Create a DHT swarm
 	setup = {}
 	bootstrap_connection = ('localhost', 10001)
@@ -453,21 +1127,46 @@ if __name__ == '__main__':
 	dht1 = DHT(('0.0.0.0', 10001), bootstrap_connection, setup)
 	dht2 = DHT(('0.0.0.0', 10002), bootstrap_connection, setup)
 	dht3 = DHT(('0.0.0.0', 10003), bootstrap_connection, setup)
-	dht4 = DHT(('0.0.0.0', 10004), ('localhost', 10003), setup)
+	dht4 = DHT(('0.0.0.0', 10004), [('localhost', 10003), ('localhost', 10002), ('localhost', 10009)], setup)
 	dht5 = DHT(('0.0.0.0', 10005), ('localhost', 10003), setup)
-	dht6 = DHT(('0.0.0.0', 10006), ('localhost', 10005), setup)
+	dht6 = DHT(('0.0.0.0', 10006), ('localhost', 10005), dict(setup, identities = 4))
+	# Dual-stack nodes (BEP #0032)
+	dht7 = DHT(('0.0.0.0', 10007), bootstrap_connection, setup, listen_connection6 = ('::1', 10007),
+		bootstrap_connection6 = ('::1', 10007))
+	dht8 = DHT(('0.0.0.0', 10008), bootstrap_connection, setup, listen_connection6 = ('::1', 10008),
+		bootstrap_connection6 = ('::1', 10007))
 
 	log.critical('starting "ping" test')
 	log.critical('ping: dht1 -> bootstrap = %r' % dht1.dht_ping(bootstrap_connection))
 	log.critical('ping: dht6 -> bootstrap = %r' % dht6.dht_ping(bootstrap_connection))
 
+	log.critical('starting "identities" test')
+	assert(len([thread for thread in threading.enumerate() if thread.name == 'identity lookups']) <= 1)
+	t_start = time.time()
+	while dht6._identity_lookups and (time.time() - t_start < 30): # lookups of the 3 added ids
+		time.sleep(0.1)
+	assert(not dht6._identity_lookups)
+	for node_id in dht6.get_identities():
+		log.critical('find_node: dht2 -> id(dht6) = %r' % list(dht2.dht_find_node(node_id, timeout = 1)))
+
+	log.critical('starting "tracing" test')
+	from metrics import StageTracer
+	dht3.set_tracer(StageTracer(dht3.get_metrics(), sample = 1))
+	dht3.start_profiler()
+	list(dht2.dht_find_node(dht3._node.id, timeout = 1))
+	dht3.set_tracer(None)
+	import pstats
+	pstats.Stats(dht3.stop_profiler()).sort_stats('cumulative').print_stats(5)
+	for stage in ['bdecode', 'dispatch', 'register_node', 'get_nodes', 'encode_nodes', 'send', 'total']:
+		histogram = dht3.get_metrics().histogram('krpc_stage_seconds', stage = stage)
+		log.critical('stage latency: dht3 %-15s count=%d p50=%r' % (stage, histogram.count, histogram.get_quantile(0.5)))
+
 	log.critical('starting "find_node" test')
 	for idx, node in enumerate(dht3.dht_find_node(dht1._node.id)):
 		log.critical('find_node: dht3 -> id(dht1) result #%d: %s:%d' % (idx, node[0], node[1]))
 		if idx > 10:
 			break
 
-	import binascii
 	info_hash = binascii.unhexlify('ae3fa25614b753118931373f8feae64f3c75f5cd') # Ubuntu 15.10 info hash
 
 	log.critical('starting "get_peers" test')
@@ -475,12 +1174,72 @@ if __name__ == '__main__':
 		log.critical('get_peers: dht5 -> info_hash result #%d: %r' % (idx, peer))
 
 	log.critical('starting "announce_peer" test')
+	announced = []
 	for idx, async_result in enumerate(dht5.dht_announce_peer(info_hash)):
 		log.critical('announce_peer: dht2 -> close_nodes(info_hash) #%d: %r' % (idx, async_result.get_result(1)))
+		announced.append(async_result.get_source())
+	assert(announced.count(('127.0.0.1', 10006)) <= 1) # dht6 hosts 4 ids, but is announced to once
+	assert(len(set(announced)) == len(announced))
+	close_nodes = list(decode_nodes(dht3._get_close_nodes(info_hash, 8, ('127.0.0.1', 10005), None)['nodes']))
+	assert(len(set(connection for (node_id, connection) in close_nodes)) == len(close_nodes))
 
 	log.critical('starting "get_peers" test')
 	for idx, peer in enumerate(dht1.dht_get_peers(info_hash)):
 		log.critical('get_peers: dht1 -> info_hash result #%d: %r' % (idx, peer))
 
-	for dht in [dht1, dht2, dht3, dht4, dht5, dht6]:
+	log.critical('starting "IPv6" test')
+	log.critical('external IPv6 connection: dht8 = %r' % (dht8.get_external_connection6(),))
+	log.critical('find_node: dht8 -> id6(dht7) = %r' % list(dht8.dht_find_node(dht7._node6.id, timeout = 1)))
+	list(dht7.dht_get_peers(info_hash, timeout = 1)) # collect tokens of IPv4 and IPv6 nodes
+	for async_result in dht7.dht_announce_peer(info_hash):
+		async_result.get_result(1)
+	log.critical('get_peers: dht8 -> info_hash = %r' % list(dht8.dht_get_peers(info_hash, timeout = 1)))
+	assert('dht_router_ids{family="ipv6"}' in dht8.get_metrics().get_prometheus_text())
+	assert('krpc_transactions_pending{family="ipv6"}' in dht8.get_metrics().get_prometheus_text())
+	assert(dht8.get_metrics().counter('krpc_received_packets_total', family = 'ipv6').get() > 0)
+	# The node continues with IPv4 if the IPv6 bootstrap fails
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	dht9 = DHT(('0.0.0.0', 10009), bootstrap_connection, dict(setup, bootstrap_timeout = 0.5),
+		listen_connection6 = ('::1', 10009), bootstrap_connection6 = ('::1', 10099))
+	logging.getLogger('DHT').setLevel(logging.INFO)
+	assert((dht9.get_external_connection6() == None) and dht9.dht_ping(bootstrap_connection))
+	dht9.shutdown()
+
+	log.critical('starting "shared metrics" test')
+	shared_metrics = MetricsRegistry()
+	dht10 = DHT(('0.0.0.0', 10010), bootstrap_connection, setup, metrics = shared_metrics, metric_labels = {'node': '10'})
+	dht11 = DHT(('0.0.0.0', 10011), bootstrap_connection, setup, metrics = shared_metrics, metric_labels = {'node': '11'})
+	try: # the gauges of the second node would be dropped without distinct labels
+		DHT(('0.0.0.0', 10012), bootstrap_connection, setup, metrics = shared_metrics, metric_labels = {'node': '11'})
+		assert(False)
+	except ValueError:
+		log.exception('expected metrics exception')
+	assert(('krpc_transactions_pending{node="10"}' in shared_metrics.get_prometheus_text()) and
+		('dht_router_ids{node="11"}' in shared_metrics.get_prometheus_text()))
+	dht10.shutdown()
+	dht11.shutdown()
+
+	log.critical('starting "unknown method" test')
+	try:
+		dht1._krpc.send_krpc_query(bootstrap_connection, b'unknown_method', id = dht1._node.id).get_result(1)
+	except KRPCError:
+		log.exception('expected KRPC error')
+
+	log.critical('starting "maintenance" test')
+	dead_node = dht1._nodes.register_node(('127.0.0.1', 10098), bep42_id(os.urandom(20), ('127.0.0.1', 10098)))
+	t_start = time.time()
+	dht1._maintain_nodes(20, refresh_t = 0, timeout = 0.5) # refresh all buckets
+	assert(time.time() - t_start < 0.2) # the results are not awaited by the job
+	time.sleep(1)
+	assert(dead_node.attempt > 0) # the query to the unreachable node has expired
+	assert(get_scheduler().lag_max < 1)
+
+	for method, stats in sorted(dht1.get_query_stats().items()):
+		log.critical('query stats: dht1 %s calls=%d p99=%r' % (method, stats['calls'], stats['latency'].get_quantile(0.99)))
+
+	log.critical('threads: %d for 8 DHT nodes' % threading.active_count())
+	for name, value in sorted(dht1.get_metrics().get_snapshot().items()):
+		log.critical('metrics: dht1 %s = %r' % (name, value))
+
+	for dht in [dht1, dht2, dht3, dht4, dht5, dht6, dht7, dht8]:
 		dht.shutdown()
@@ -0,0 +1,226 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys, time, threading, logging
+from utils import start_thread
+from tracker import TrackerException, parse_url, get_udp_tracker_client, get_http_tracker_client
+
+if sys.version_info[0] >= 3:
+	import queue
+else:
+	import Queue as queue
+
+# Concurrent peer discovery - the DHT search and the announces to all trackers are started at
+# the same time and the peers are yielded in the order of their arrival (each (ip, port) only once).
+class PeerDiscovery(object):
+	def __init__(self, dht = None, tracker_list = [], peer_id = None, port = 0,
+			udp_client = None, http_client = None):
+		""" dht is an (optional) DHT instance, tracker_list contains the announce urls (http, https, udp) """
+		self._log = logging.getLogger(self.__class__.__name__)
+		self._dht = dht
+		self._tracker_list = list(tracker_list)
+		self._peer_id = peer_id
+		self._port = port
+		self._udp_client = udp_client
+		self._http_client = http_client
+		self._stats_lock = threading.Lock()
+		self._stats = {} # source -> {'peers': new peers, 'duplicates': ..., 'first': time to first peer, 'error': ...}
+
+	def iter_peers(self, info_hash, max_peers = None, timeout = 60, source_timeout = 30, source_timeouts = {}):
+		""" Yield (peer connection, source) tuples - source is 'dht' or the tracker url
+			The iteration stops after max_peers peers, after timeout seconds or when all sources are done.
+			Each source is given source_timeout seconds (or the value for the source in source_timeouts). """
+		t_start = time.time()
+		(results, stop) = (queue.Queue(), threading.Event())
+		deadlines = {}
+		def get_deadline(source):
+			return min(t_start + timeout, t_start + source_timeouts.get(source, source_timeout))
+		for tracker_url in self._tracker_list:
+			deadlines[tracker_url] = get_deadline(tracker_url)
+			self._announce(tracker_url, info_hash, deadlines[tracker_url] - t_start, results)
+		if self._dht:
+			deadlines['dht'] = get_deadline('dht')
+			start_thread(self._search_dht, info_hash, deadlines['dht'], results, stop)
+		with self._stats_lock:
+			self._stats = dict((source, {'peers': 0, 'duplicates': 0, 'first': None, 'error': None}) for source in deadlines)
+		(returned, pending) = (set(), set(deadlines))
+		try:
+			while pending:
+				t_now = time.time()
+				for source in list(pending):
+					if deadlines[source] <= t_now:
+						pending.remove(source)
+						self._set_error(source, 'deadline reached')
+				if not pending:
+					break
+				try:
+					(source, peers) = results.get(timeout = min(deadlines[source] for source in pending) - t_now)
+				except queue.Empty:
+					continue
+				if source not in pending: # late result after the deadline of the source
+					continue
+				if isinstance(peers, Exception):
+					pending.remove(source)
+					self._set_error(source, peers)
+					continue
+				elif peers == None: # end of the DHT search
+					pending.remove(source)
+					continue
+				elif source != 'dht':
+					pending.remove(source)
+				for peer in peers:
+					peer = tuple(peer)
+					if peer in returned:
+						self._update_stats(source, 'duplicates', 1)
+						continue
+					returned.add(peer)
+					self._update_stats(source, 'peers', 1)
+					with self._stats_lock:
+						if self._stats[source]['first'] == None:
+							self._stats[source]['first'] = time.time() - t_start
+					yield (peer, source)
+					if (max_peers != None) and (len(returned) >= max_peers):
+						return
+		finally:
+			stop.set()
+
+	def get_peers(self, info_hash, max_peers = None, timeout = 60, source_timeout = 30, source_timeouts = {}):
+		""" Return the list of peers found by iter_peers """
+		return [peer for (peer, source) in self.iter_peers(info_hash, max_peers, timeout, source_timeout, source_timeouts)]
+
+	def get_stats(self):
+		""" Return {source: {'peers', 'duplicates', 'first', 'error'}} of the last (or current) iteration """
+		with self._stats_lock:
+			return dict((source, dict(stats)) for (source, stats) in self._stats.items())
+
+	# Private members #################################################
+
+	def _update_stats(self, source, key, value):
+		with self._stats_lock:
+			self._stats[source][key] += value
+
+	def _set_error(self, source, ex):
+		self._log.debug('peer source %s failed: %s' % (source, ex))
+		with self._stats_lock:
+			self._stats[source]['error'] = str(ex)
+
+	def _announce(self, tracker_url, info_hash, timeout, results):
+		def collect(async_result):
+			try:
+				results.put((tracker_url, async_result.get_result(0)['peers']))
+			except Exception as ex:
+				results.put((tracker_url, ex))
+		try:
+			scheme = parse_url(tracker_url).scheme
+			if scheme == 'udp':
+				client = self._udp_client or get_udp_tracker_client()
+				async_result = client.announce(tracker_url, info_hash, self._peer_id, port = self._port, timeout = timeout)
+			elif scheme in ['http', 'https']:
+				client = self._http_client or get_http_tracker_client()
+				async_result = client.announce(tracker_url, info_hash, self._peer_id, port = self._port, timeout = timeout)
+			else:
+				raise TrackerException('Unsupported tracker protocol: %s' % tracker_url)
+		except Exception as ex:
+			results.put((tracker_url, ex))
+		else:
+			async_result.add_callback(collect)
+
+	def _search_dht(self, info_hash, deadline, results, stop):
+		def is_stopped(): # checked by the lookup between its queries
+			return stop.is_set() or (time.time() > deadline)
+		try:
+			for peer in self._dht.dht_get_peers(info_hash, timeout = min(5, max(0, deadline - time.time())),
+					stop = is_stopped):
+				if is_stopped():
+					break
+				results.put(('dht', [peer]))
+			results.put(('dht', None))
+		except Exception as ex:
+			results.put(('dht', ex))
+
+
+if __name__ == '__main__':
+	import os, socket
+	from utils import encode_uint32, encode_uint64, decode_uint32, encode_connection
+	from tracker import UDPTrackerClient, udp_action_connect, udp_action_announce
+	from dht import DHT
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('KRPCPeer.remote').setLevel(logging.ERROR)
+	info_hash = os.urandom(20)
+
+	# Local UDP tracker with 20 peers - the first 10 peers are also announced in the DHT
+	tracker_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	tracker_sock.bind(('127.0.0.1', 0))
+	tracker_peers = [('127.0.0.1', 20000 + idx) for idx in range(20)]
+	def run_tracker():
+		while True:
+			(data, source) = tracker_sock.recvfrom(2048)
+			(action, tid) = (decode_uint32(data[8:12]), data[12:16])
+			if action == udp_action_connect:
+				resp = encode_uint64(12345)
+			elif action == udp_action_announce:
+				time.sleep(0.5)
+				resp = encode_uint32(1800) + encode_uint32(1) + encode_uint32(2) + \
+					b''.join(encode_connection(peer) for peer in tracker_peers)
+			tracker_sock.sendto(encode_uint32(action) + tid + resp, source)
+	start_thread(run_tracker)
+	tracker_url = 'udp://127.0.0.1:%d' % tracker_sock.getsockname()[1]
+	silent_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # tracker without responses
+	silent_sock.bind(('127.0.0.1', 0))
+	silent_url = 'udp://127.0.0.1:%d' % silent_sock.getsockname()[1]
+
+	# Local DHT swarm
+	bootstrap_connection = ('127.0.0.1', 10101)
+	dht_list = [DHT(('127.0.0.1', 10101 + idx), bootstrap_connection, {}) for idx in range(4)]
+	for peer in tracker_peers[:10]:
+		dht_list[1]._node.values.setdefault(info_hash, []).append(peer)
+
+	udp_client = UDPTrackerClient(retransmit_t = 0.2)
+	discovery = PeerDiscovery(dht_list[3], [tracker_url, silent_url, 'ftp://127.0.0.1/announce'],
+		os.urandom(20), 6881, udp_client = udp_client)
+	t_start = time.time()
+	peers = []
+	for (peer, source) in discovery.iter_peers(info_hash, timeout = 5, source_timeouts = {silent_url: 1}):
+		peers.append(peer)
+		if len(peers) == 1:
+			log.critical('first peer after %.2fs from %s' % (time.time() - t_start, source))
+	log.critical('%d peers after %.2fs - stats: %r' % (len(peers), time.time() - t_start, discovery.get_stats()))
+	assert(sorted(peers) == sorted(tracker_peers))
+	stats = discovery.get_stats()
+	assert(stats[silent_url]['error'] == 'deadline reached')
+	assert(stats['dht']['peers'] == 10)
+	assert(stats[tracker_url]['duplicates'] == 10)
+
+	thread_count = threading.active_count()
+	t_start = time.time()
+	peers = discovery.get_peers(info_hash, max_peers = 5)
+	log.critical('%d peers after %.2fs (max_peers = 5)' % (len(peers), time.time() - t_start))
+	assert(len(peers) == 5)
+	while (threading.active_count() > thread_count) and (time.time() - t_start < 2): # DHT lookup stops early
+		time.sleep(0.1)
+	assert(threading.active_count() <= thread_count)
+	udp_client.shutdown()
+	for dht in dht_list:
+		dht.shutdown()
@@ -22,35 +22,122 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import socket, threading, logging
-from bencode import bencode, bdecode, BTFailure
-from utils import client_version, AsyncResult, AsyncTimeout, encode_uint64, UDPSocket, ThreadManager
+import threading, logging, cProfile, collections
+from bencode import bencode, BencodeTemplate, bdecode_dict_with_spans, BTFailure
+from utils import client_version, AsyncResult, AsyncTimeout, encode_uint64, UDPSocket, ThreadManager, resolve_connection, get_time
+from metrics import MetricsRegistry
+from capture import capture_in, capture_out
 
 krpc_version = bytes(client_version[0] + bytearray([client_version[1], client_version[2]]))
 
+# KRPC error codes (BEP #0005)
+krpc_error_generic = 201
+krpc_error_server = 202
+krpc_error_protocol = 203
+krpc_error_method = 204
+
 class KRPCError(RuntimeError):
 	pass
 
+class KRPCQueryError(KRPCError):
+	""" Raised by query handlers to answer the query with a KRPC error message """
+	def __init__(self, code, message):
+		KRPCError.__init__(self, message)
+		self.code = code
+
+# Decoded KRPC message - the top level dictionary is decoded in a single pass (the payload a / r
+# precedes the envelope keys t / y, so it has to be walked anyway) and the positions of the
+# encoded values are kept to access them without re-encoding
+class KRPCMessage(dict):
+	def __init__(self, data):
+		(values, self._spans) = bdecode_dict_with_spans(data)
+		dict.__init__(self, values)
+		self._data = data
+
+	def get_raw(self, key):
+		""" Return the encoded value of the given key """
+		(start, end) = self._spans[key]
+		return self._data[start:end]
+
+
+# Encoded replies of recently answered queries - a retransmitted query (same source connection,
+# transaction id, method and encoded arguments) is answered by resending the reply
+class ReplyCache(object):
+	def __init__(self, size = 1000, timeout = 10):
+		self._size = size
+		self._timeout = timeout
+		self._entries = collections.OrderedDict() # key -> (time, data) in insertion order
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key):
+		entry = self._entries.get(key)
+		if entry and (get_time() - entry[0] < self._timeout):
+			return entry[1]
+
+	def put(self, key, data):
+		now = get_time()
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (now, data)
+			while self._entries: # remove the oldest entries beyond the size limit and expired entries
+				(oldest_key, (oldest_time, oldest_data)) = next(iter(self._entries.items()))
+				if (len(self._entries) <= self._size) and (now - oldest_time < self._timeout):
+					break
+				self._entries.pop(oldest_key)
+
+
 class KRPCPeer(object):
-	def __init__(self, connection, handle_query, cleanup_timeout = 60, cleanup_interval = 10):
+	def __init__(self, connection, handle_query, cleanup_timeout = 60, cleanup_interval = 10, metrics = None,
+			transport = None, reply_cache_size = 1000, reply_cache_timeout = 10, metric_labels = {}):
 		""" Start listening on the connection given by (addr, port)
 			Incoming messages are given to the handle_query function,
 			with arguments (send_krpc_response, rec).
 			send_krpc_response(**kwargs) is a function to send a reply,
-			rec contains the dictionary with the incoming message.
+			rec contains the dictionary with the incoming message
+			(a KRPCMessage, which also gives access to the encoded values).
+			Statistics are collected in the metrics registry (if given) - peers sharing a registry
+			need different metric_labels (eg. {'family': 'ipv6'}), which are added to all metrics.
+			The packets are sent and received with the given transport (default: UDPSocket(connection)),
+			an object with the attribute family and the methods sendto(data, connection), recvfrom(timeout),
+			get_queue_size() and close(). Transports with a set_receiver(fun) method deliver the
+			packets themselves by calling fun(data, source_connection) instead of being polled.
+			A cleanup_interval < 0 disables the removal of expired transactions.
+			The replies to the last reply_cache_size queries are kept for reply_cache_timeout seconds
+			to answer retransmitted queries without calling handle_query (size 0 disables the cache).
 		"""
 		self._log = logging.getLogger(self.__class__.__name__ + '.%s:%d' % connection)
 		self._log_msg = self._log.getChild('msg') # message handling
 		self._log_local = self._log.getChild('local') # local queries
 		self._log_remote = self._log.getChild('remote') # remote queries
-		self._sock = UDPSocket(connection)
+		self._sock = transport or UDPSocket(connection)
 
 		self._transaction = {}
 		self._transaction_id = 0
 		self._transaction_lock = threading.Lock()
+		self._templates = {} # message structure -> BencodeTemplate
 		self._handle_query = handle_query
+		self._reply_cache = None
+		if reply_cache_size > 0:
+			self._reply_cache = ReplyCache(reply_cache_size, reply_cache_timeout)
+		self._tracer = None
+		self._capture = None
+		self._profiler = None
+		self._profiler_request = None
+		self._profiler_switched = threading.Event()
+		try:
+			self._init_metrics(metrics or MetricsRegistry(), metric_labels)
+		except ValueError: # metrics already registered by another peer
+			if not transport:
+				self._sock.close()
+			raise
 		self._threads = ThreadManager(self._log)
-		self._threads.start_continuous_thread(self._listen)
+		if hasattr(self._sock, 'set_receiver'):
+			self._sock.set_receiver(self._handle_packet)
+		else:
+			self._threads.start_continuous_thread(self._listen)
 		self._threads.start_continuous_thread(self._cleanup_transactions,
 			thread_interval = cleanup_interval, timeout = cleanup_timeout)
 
@@ -60,7 +147,7 @@ class KRPCPeer(object):
 			Returns an AsyncResult (waitable) that will
 			eventually contain the peer response.
 		"""
-		target_connection = (socket.gethostbyname(target_connection[0]), target_connection[1])
+		target_connection = resolve_connection(target_connection, self._sock.family)
 		with self._transaction_lock:
 			while True: # Generate transaction id
 				self._transaction_id += 1
@@ -73,11 +160,37 @@ class KRPCPeer(object):
 				if self._log_local.isEnabledFor(logging.INFO):
 					self._log_local.info('KRPC request to %r:\n\t%r' % (target_connection, req))
 				self._transaction[local_transaction] = result
-				self._sock.sendto(bencode(req), target_connection)
+				template = self._get_template((b'q', method, tuple(sorted(kwargs))),
+					req, [(b't',)] + [(b'a', key) for key in kwargs])
+				self._sendto(template.encode(req), target_connection)
+				self._metric_queries.inc()
 			else:
 				result.set_result(AsyncTimeout('Shutdown in progress'))
 			return result
 
+	def set_tracer(self, tracer):
+		""" Record the latency of the stages of sampled packets with the given StageTracer
+			(None disables the tracing) - the stages are recv_queue, bdecode, transaction (responses),
+			handle_query and send (queries), send_queue and total """
+		self._tracer = tracer
+		if hasattr(self._sock, 'set_tracer'):
+			self._sock.set_tracer(tracer)
+
+	def set_capture(self, capture):
+		""" Record all received and sent datagrams with the given CaptureWriter (None stops the capture) """
+		self._capture = capture
+
+	def start_profiler(self, profiler = None):
+		""" Profile the thread handling the received packets with the given profiler (default: a new
+			cProfile.Profile) - any object with the methods enable() and disable() can be used. """
+		self._switch_profiler(profiler or cProfile.Profile())
+
+	def stop_profiler(self):
+		""" Stop the profiler and return it (eg. to print the statistics with pstats.Stats(profiler)) """
+		profiler = self._profiler
+		self._switch_profiler(None)
+		return profiler
+
 	def shutdown(self):
 		""" This function allows to cleanly shutdown the KRPCPeer. """
 		self._threads.shutdown()
@@ -89,6 +202,48 @@ class KRPCPeer(object):
 
 	# Private members #################################################
 
+	def _init_metrics(self, metrics, metric_labels):
+		self._metric_recv_packets = metrics.counter('krpc_received_packets_total', 'Received KRPC packets', **metric_labels)
+		self._metric_recv_bytes = metrics.counter('krpc_received_bytes_total', 'Received KRPC bytes', **metric_labels)
+		self._metric_sent_packets = metrics.counter('krpc_sent_packets_total', 'Sent KRPC packets', **metric_labels)
+		self._metric_sent_bytes = metrics.counter('krpc_sent_bytes_total', 'Sent KRPC bytes', **metric_labels)
+		self._metric_invalid = metrics.counter('krpc_invalid_packets_total', 'Received packets that could not be parsed',
+			**metric_labels)
+		self._metric_queries = metrics.counter('krpc_queries_total', 'Sent KRPC queries', **metric_labels)
+		self._metric_errors_sent = metrics.counter('krpc_error_replies_total', 'Sent KRPC error messages', **metric_labels)
+		self._metric_transaction_result = {}
+		for result in ['response', 'error', 'timeout']:
+			self._metric_transaction_result[result] = metrics.counter('krpc_transactions_total',
+				'Completed KRPC transactions', **dict(metric_labels, result = result))
+		self._metric_rtt = metrics.histogram('krpc_rtt_seconds', 'Round trip time of KRPC transactions', **metric_labels)
+		self._metric_reply_cache = {}
+		for result in ['hit', 'miss']:
+			self._metric_reply_cache[result] = metrics.counter('krpc_reply_cache_total',
+				'Queries answered from the reply cache (hit) or by the query handler (miss)', **dict(metric_labels, result = result))
+		metrics.gauge('krpc_reply_cache_entries', 'Number of replies in the reply cache',
+			fun = lambda: len(self._reply_cache or ()), **metric_labels)
+		metrics.gauge('krpc_transactions_pending', 'Number of pending KRPC transactions',
+			fun = lambda: len(self._transaction), **metric_labels)
+		metrics.gauge('krpc_recv_queue_depth', 'Number of packets in the receive queue',
+			fun = lambda: self._sock.get_queue_size()[0], **metric_labels)
+		metrics.gauge('krpc_send_queue_depth', 'Number of packets in the send queue',
+			fun = lambda: self._sock.get_queue_size()[1], **metric_labels)
+
+	def _get_template(self, key, x, fields):
+		# The KRPC messages of a peer only have a few different structures
+		template = self._templates.get(key)
+		if template == None:
+			template = self._templates.setdefault(key, BencodeTemplate(x, fields))
+		return template
+
+	def _sendto(self, data, connection):
+		capture = self._capture
+		if capture:
+			capture.write(capture_out, connection, data)
+		self._metric_sent_packets.inc()
+		self._metric_sent_bytes.inc(len(data))
+		self._sock.sendto(data, connection)
+
 	def _cleanup_transactions(self, timeout):
 		# Remove transactions older than 1min
 		with self._transaction_lock:
@@ -97,51 +252,108 @@ class KRPCPeer(object):
 				self._log.debug('Transactions: %d id=%d timeout=%d' % (len(self._transaction), self._transaction_id, len(timeout_transactions)))
 			for t in timeout_transactions:
 				self._transaction.pop(t).set_result(AsyncTimeout('Transaction %r: timeout' % t))
+				self._metric_transaction_result['timeout'].inc()
+
+	def _switch_profiler(self, profiler, timeout = 5):
+		# The profiler is switched by the listen thread - for transports delivering the packets themselves,
+		# the current thread is profiled
+		self._profiler_switched.clear()
+		self._profiler_request = profiler
+		if hasattr(self._sock, 'set_receiver'):
+			self._apply_profiler_request()
+		elif not self._profiler_switched.wait(timeout):
+			raise AsyncTimeout('Listen thread did not switch the profiler')
+
+	def _apply_profiler_request(self):
+		if self._profiler:
+			self._profiler.disable()
+		self._profiler = self._profiler_request
+		if self._profiler:
+			self._profiler.enable()
+		self._profiler_switched.set()
 
 	def _listen(self):
-		try:
-			recv_data = self._sock.recvfrom(timeout = 0.2)
-			if not recv_data:
-				return
-			(encoded_rec, source_connection) = recv_data
+		if self._profiler_request is not self._profiler:
+			self._apply_profiler_request()
+		recv_data = self._sock.recvfrom(timeout = 0.2)
+		if recv_data:
+			self._handle_packet(*recv_data)
+
+	def _handle_packet(self, encoded_rec, source_connection):
+		tracer = self._tracer
+		if tracer:
+			tracer.start()
+		try: # the trace is finished for invalid packets as well
+			capture = self._capture
+			if capture:
+				capture.write(capture_in, source_connection, encoded_rec)
 			try:
-				rec = bdecode(encoded_rec)
-			except BTFailure:
-				if self._log_msg.isEnabledFor(logging.ERROR):
-					self._log_msg.error('Error while parsing KRPC requests from %r:\n\t%r' % (source_connection, encoded_rec))
-				return
-		except Exception:
-			return self._log_msg.exception('Exception while handling KRPC requests from %r:\n\t%r' % (source_connection, encoded_rec))
-		try:
-			if rec[b'y'] in [b'r', b'e']: # Response / Error message
-				t = rec[b't']
-				if rec[b'y'] == b'e':
-					if self._log_local.isEnabledFor(logging.ERROR):
-						self._log_local.error('KRPC error message from %r:\n\t%r' % (source_connection, rec))
+				self._metric_recv_packets.inc()
+				self._metric_recv_bytes.inc(len(encoded_rec))
+				try:
+					rec = KRPCMessage(encoded_rec)
+					if tracer:
+						tracer.mark('bdecode')
+				except BTFailure:
+					self._metric_invalid.inc()
+					if self._log_msg.isEnabledFor(logging.ERROR):
+						self._log_msg.error('Error while parsing KRPC requests from %r:\n\t%r' % (source_connection, encoded_rec))
+					return
+			except Exception:
+				return self._log_msg.exception('Exception while handling KRPC requests from %r:\n\t%r' % (source_connection, encoded_rec))
+			try:
+				if rec[b'y'] in [b'r', b'e']: # Response / Error message
+					t = rec[b't']
+					if rec[b'y'] == b'e':
+						if self._log_local.isEnabledFor(logging.ERROR):
+							self._log_local.error('KRPC error message from %r:\n\t%r' % (source_connection, rec))
+						with self._transaction_lock:
+							if self._transaction.get(t):
+								rec = KRPCError('Error while processing transaction %r:\n\t%r\n\t%r' % (t, rec, self._transaction.get(t).get_source()))
+							else:
+								rec = KRPCError('Error while processing transaction %r:\n\t%r' % (t, rec))
+					else:
+						if self._log_local.isEnabledFor(logging.INFO):
+							self._log_local.info('KRPC answer from %r:\n\t%r' % (source_connection, rec))
 					with self._transaction_lock:
 						if self._transaction.get(t):
-							rec = KRPCError('Error while processing transaction %r:\n\t%r\n\t%r' % (t, rec, self._transaction.get(t).get_source()))
-						else:
-							rec = KRPCError('Error while processing transaction %r:\n\t%r' % (t, rec))
+							result = self._transaction.pop(t)
+							self._metric_rtt.observe(result.get_age())
+							self._metric_transaction_result[isinstance(rec, KRPCError) and 'error' or 'response'].inc()
+							result.set_result(rec, source = source_connection)
+							if tracer:
+								tracer.mark('transaction')
+						elif self._log_local.isEnabledFor(logging.DEBUG):
+							self._log_local.debug('Received response from %r without associated transaction:\n%r' % (source_connection, rec))
+				elif rec[b'y'] == b'q':
+					if self._log_remote.isEnabledFor(logging.INFO):
+						self._log_remote.info('KRPC request from %r:\n\t%r' % (source_connection, rec))
+					remote_transaction = rec.get(b't')
+					(cache_key, cached_reply) = (None, None)
+					if (self._reply_cache != None) and (b'q' in rec) and (b'a' in rec):
+						cache_key = (source_connection, remote_transaction, rec.get_raw(b'q'), rec.get_raw(b'a'))
+						cached_reply = self._reply_cache.get(cache_key)
+						self._metric_reply_cache[cached_reply and 'hit' or 'miss'].inc()
+					def custom_send_krpc_response(message, top_level_message = {}):
+						data = self._send_krpc_response(source_connection, remote_transaction, message, top_level_message, self._log_remote)
+						if cache_key:
+							self._reply_cache.put(cache_key, data)
+						return data
+					if cached_reply:
+						self._sendto(cached_reply, source_connection)
+					else:
+						try:
+							self._handle_query(custom_send_krpc_response, rec, source_connection)
+						except KRPCQueryError as ex:
+							self._send_krpc_error(source_connection, remote_transaction, ex.code, str(ex), self._log_remote)
 				else:
-					if self._log_local.isEnabledFor(logging.INFO):
-						self._log_local.info('KRPC answer from %r:\n\t%r' % (source_connection, rec))
-				with self._transaction_lock:
-					if self._transaction.get(t):
-						self._transaction.pop(t).set_result(rec, source = source_connection)
-					elif self._log_local.isEnabledFor(logging.DEBUG):
-						self._log_local.debug('Received response from %r without associated transaction:\n%r' % (source_connection, rec))
-			elif rec[b'y'] == b'q':
-				if self._log_remote.isEnabledFor(logging.INFO):
-					self._log_remote.info('KRPC request from %r:\n\t%r' % (source_connection, rec))
-				def custom_send_krpc_response(message, top_level_message = {}):
-					return self._send_krpc_response(source_connection, rec.pop(b't'), message, top_level_message, self._log_remote)
-				self._handle_query(custom_send_krpc_response, rec, source_connection)
-			else:
-				if self._log_msg.isEnabledFor(logging.ERROR):
-					self._log_msg.error('Unknown type of KRPC message from %r:\n\t%r' % (source_connection, rec))
-		except Exception:
-			self._log_msg.exception('Exception while handling KRPC requests from %r:\n\t%r' % (source_connection, rec))
+					if self._log_msg.isEnabledFor(logging.ERROR):
+						self._log_msg.error('Unknown type of KRPC message from %r:\n\t%r' % (source_connection, rec))
+			except Exception:
+				self._log_msg.exception('Exception while handling KRPC requests from %r:\n\t%r' % (source_connection, rec))
+		finally:
+			if tracer:
+				tracer.finish()
 
 	def _send_krpc_response(self, source_connection, remote_transaction, message, top_level_message = {}, log = None):
 		with self._transaction_lock:
@@ -151,7 +363,33 @@ class KRPCPeer(object):
 				log = self._log_local
 			if log.isEnabledFor(logging.INFO):
 				log.info('KRPC response to %r:\n\t%r' % (source_connection, resp))
-			self._sock.sendto(bencode(resp), source_connection)
+			if isinstance(message, dict):
+				template_key = (b'r', tuple(sorted(message)), tuple(sorted(top_level_message)))
+				fields = [(b'r', key) for key in message]
+			else:
+				template_key = (b'r', None, tuple(sorted(top_level_message)))
+				fields = [(b'r',)]
+			tracer = self._tracer
+			if tracer:
+				tracer.mark('handle_query')
+			template = self._get_template(template_key, resp,
+				fields + [(b't',)] + [(key,) for key in top_level_message])
+			data = template.encode(resp)
+			self._sendto(data, source_connection)
+			if tracer:
+				tracer.mark('send')
+			return data
+
+	def _send_krpc_error(self, source_connection, remote_transaction, code, message, log = None):
+		with self._transaction_lock:
+			resp = {b'y': b'e', b't': remote_transaction, b'v': krpc_version, b'e': [code, message]}
+			if log == None:
+				log = self._log_local
+			if log.isEnabledFor(logging.INFO):
+				log.info('KRPC error to %r:\n\t%r' % (source_connection, resp))
+			template = self._get_template((b'e',), resp, [(b't',), (b'e',)])
+			self._sendto(template.encode(resp), source_connection)
+			self._metric_errors_sent.inc()
 
 
 if __name__ == '__main__':
@@ -162,6 +400,48 @@ if __name__ == '__main__':
 		send_krpc_response(message = 'Hello %s!' % rec[b'a'][b'message']))
 	query = peer.send_krpc_query(('localhost', 1111), 'echo', message = 'World')
 	logging.getLogger().critical('result = %r' % query.get_result(2))
+	# Trace every packet and profile the listen thread
+	from metrics import StageTracer, StackSampler
+	registry = MetricsRegistry()
+	peer.set_tracer(StageTracer(registry, sample = 1))
+	for profiler in [None, StackSampler()]:
+		peer.start_profiler(profiler)
+		for idx in range(10):
+			peer.send_krpc_query(('localhost', 1111), 'echo', message = 'World').get_result(2)
+		profiler = peer.stop_profiler()
+	peer.set_tracer(None)
+	assert(profiler.get_stats()[0] > 0)
+	logging.getLogger().critical('stack samples: %r' % (profiler.get_function_stats(5),))
+	for stage in ['recv_queue', 'bdecode', 'transaction', 'handle_query', 'send', 'send_queue', 'total']:
+		assert(registry.histogram('krpc_stage_seconds', stage = stage).count >= 10)
+	# Invalid packets finish their trace as well
+	tracer = StageTracer(registry, sample = 1)
+	peer.set_tracer(tracer)
+	total_count = registry.histogram('krpc_stage_seconds', stage = 'total').count
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	peer._handle_packet(b'invalid', ('127.0.0.1', 1111))
+	logging.getLogger('KRPCPeer').setLevel(logging.DEBUG)
+	peer.set_tracer(None)
+	assert(registry.histogram('krpc_stage_seconds', stage = 'total').count == total_count + 1)
+	assert(tracer._local.trace == None)
+	# Retransmitted query - answered from the reply cache
+	import time
+	query = bencode({b'y': b'q', b't': b'zz', b'q': b'echo', b'a': {b'message': b'again'}})
+	for idx in range(3):
+		peer._sendto(query, ('127.0.0.1', 1111))
+	time.sleep(0.5)
+	assert(peer._metric_reply_cache['hit'].get() == 2)
+	# Peers sharing a registry are distinguished by their labels
+	peer_v6 = KRPCPeer(('127.0.0.1', 1112), handle_query = None, metrics = registry, metric_labels = {'family': 'ipv6'})
+	peer_v4 = KRPCPeer(('127.0.0.1', 1113), handle_query = None, metrics = registry)
+	try:
+		KRPCPeer(('127.0.0.1', 1114), handle_query = None, metrics = registry)
+		assert(False)
+	except ValueError:
+		logging.exception('expected metrics exception')
+	assert('krpc_transactions_pending{family="ipv6"} 0' in registry.get_prometheus_text())
+	peer_v4.shutdown()
+	peer_v6.shutdown()
 	query1 = peer.send_krpc_query(('localhost', 1111), 'echo', message = 'World')
 	peer.shutdown()
 	query2 = peer.send_krpc_query(('localhost', 1111), 'echo', message = 'World')
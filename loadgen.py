@@ -0,0 +1,261 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys, time, json, random, threading, logging
+from utils import AsyncTimeout, decode_connection
+from krpc import KRPCPeer, KRPCError
+from dht import bep42_id
+
+default_mix = {'ping': 1, 'find_node': 1, 'get_peers': 1, 'announce_peer': 0.2}
+
+def get_percentile(values, quantile):
+	""" Return the quantile of the sorted list of values (None for an empty list) """
+	if values:
+		return values[min(len(values) - 1, int(quantile * len(values)))]
+
+# Open-loop load generator for a single DHT node - the queries are sent at a fixed rate
+# independent of the responses. The latency of each query is measured from its scheduled
+# send time, so a generator falling behind does not hide the delays of the node.
+class LoadGenerator(object):
+	def __init__(self, target_connection, listen_connection = ('0.0.0.0', 0), sources = 1000, info_hashes = 100,
+			timeout = 5, seed = 0, external_connection = None):
+		""" Prepare the queries to the DHT node at target_connection - the queries are sent by
+			sources different (BEP #0042 valid) node ids and refer to info_hashes different torrents
+			The ids are derived from the external connection reported by the node (BEP #0042 ip field)
+			or from the given external_connection for nodes without this field """
+		self._log = logging.getLogger(self.__class__.__name__ + '.%s:%d' % target_connection)
+		self._target = target_connection
+		self._timeout = timeout
+		self._random = random.Random(seed)
+		self._krpc = KRPCPeer(listen_connection, handle_query = lambda send_krpc_response, rec, source_connection: None,
+			cleanup_timeout = timeout, cleanup_interval = 0.5)
+		self._lock = threading.Lock()
+		try:
+			self._setup(info_hashes, sources, external_connection)
+		except Exception:
+			self._krpc.shutdown()
+			raise
+
+	def _setup(self, info_hashes, sources, external_connection):
+		# The external connection is needed for valid ids - the token for announce_peer is bound to it
+		node_id = self._get_random_bytes(20)
+		response = self._krpc.send_krpc_query(self._target, b'ping', id = node_id).get_result(self._timeout)
+		self._connection = external_connection
+		if not external_connection:
+			if b'ip' not in response:
+				raise ValueError('%s:%d does not report the external connection (BEP #0042 ip field) - '
+					'it has to be given as external_connection' % self._target)
+			self._connection = decode_connection(response[b'ip'])
+		self._ids = [bep42_id(self._get_random_bytes(20), self._connection) for x in range(sources)]
+		self._info_hashes = [self._get_random_bytes(20) for x in range(info_hashes)]
+		response = self._krpc.send_krpc_query(self._target, b'get_peers',
+			id = self._ids[0], info_hash = self._info_hashes[0]).get_result(self._timeout)
+		self._token = response[b'r'][b'token']
+
+	def shutdown(self):
+		self._krpc.shutdown()
+
+	def run(self, rate, duration, mix = default_mix, interval = 1):
+		""" Send queries with the given mix of methods ({method: weight}) at rate queries per second
+			for duration seconds. Returns a report with the setup, the statistics of each interval
+			(by send time) and the total statistics - each with the number of sent queries, responses,
+			errors and lost queries, the response rate and loss and the latency percentiles """
+		methods = sorted(mix)
+		weights = [float(mix[method]) / sum(mix.values()) for method in methods]
+		n_intervals = int(max(1, -(-duration // interval)))
+		stats = [self._new_stats() for idx in range(n_intervals)]
+		method_stats = dict((method, self._new_stats()) for method in methods)
+		pending = [0]
+		total = int(rate * duration)
+		(t_start, send_lag_max) = (time.time(), 0)
+		for idx in range(total):
+			t_scheduled = t_start + idx / float(rate)
+			delay = t_scheduled - time.time()
+			if delay > 0.001:
+				time.sleep(delay)
+			else:
+				send_lag_max = max(send_lag_max, -delay)
+			method = self._choose(methods, weights)
+			entries = (stats[min(n_intervals - 1, int((t_scheduled - t_start) / interval))], method_stats[method])
+			for entry in entries:
+				entry['sent'] += 1
+			with self._lock:
+				pending[0] += 1
+			self._krpc.send_krpc_query(self._target, method.encode('ascii'), **self._get_arguments(method)).add_callback(
+				lambda async_result, t_scheduled = t_scheduled, entries = entries: self._record(async_result, t_scheduled, entries, pending))
+		t_sent = time.time()
+		t_end = t_sent + self._timeout + 2 # wait for the remaining responses and timeouts
+		while pending[0] and (time.time() < t_end):
+			time.sleep(0.1)
+		result = {'setup': {'target': '%s:%d' % self._target, 'rate': rate, 'duration': duration, 'interval': interval,
+				'mix': mix, 'sources': len(self._ids), 'timeout': self._timeout},
+			'send_rate': total / max(1e-9, t_sent - t_start), 'send_lag_max': send_lag_max,
+			'intervals': [], 'methods': {}}
+		for (idx, entry) in enumerate(stats):
+			result['intervals'].append(dict(self._get_summary(entry), t = idx * interval))
+		for method in methods:
+			result['methods'][method] = self._get_summary(method_stats[method])
+		result['total'] = self._get_summary(self._merge_stats(stats))
+		return result
+
+	def run_ramp(self, rates, duration, mix = default_mix, max_loss = 0.01):
+		""" Run the given rates one after the other - returns the reports and the highest rate with at most max_loss """
+		reports = []
+		max_rate = None
+		for rate in rates:
+			report = self.run(rate, duration, mix, interval = duration)
+			reports.append(report)
+			self._log.info('%d queries/s: loss %.3f, p99 %r' % (rate, report['total']['loss'], report['total']['p99']))
+			if report['total']['loss'] <= max_loss:
+				max_rate = rate
+		return {'reports': reports, 'max_rate': max_rate, 'max_loss': max_loss}
+
+	# Private members #################################################
+
+	def _get_random_bytes(self, n):
+		return bytes(bytearray(self._random.getrandbits(8) for x in range(n)))
+
+	def _choose(self, methods, weights):
+		value = self._random.random()
+		for (method, weight) in zip(methods, weights):
+			value -= weight
+			if value < 0:
+				return method
+		return methods[-1]
+
+	def _get_arguments(self, method):
+		node_id = self._random.choice(self._ids)
+		if method == 'find_node':
+			return {'id': node_id, 'target': self._get_random_bytes(20)}
+		elif method == 'get_peers':
+			return {'id': node_id, 'info_hash': self._random.choice(self._info_hashes)}
+		elif method == 'announce_peer':
+			return {'id': node_id, 'info_hash': self._random.choice(self._info_hashes),
+				'port': self._random.randint(1024, 65535), 'token': self._token}
+		return {'id': node_id}
+
+	def _new_stats(self):
+		return {'sent': 0, 'responses': 0, 'errors': 0, 'lost': 0, 'latency': []}
+
+	def _record(self, async_result, t_scheduled, entries, pending):
+		latency = time.time() - t_scheduled
+		try:
+			async_result.get_result(0)
+			kind = 'responses'
+		except AsyncTimeout:
+			kind = 'lost'
+		except KRPCError:
+			kind = 'errors'
+		with self._lock:
+			for entry in entries:
+				entry[kind] += 1
+				if kind != 'lost':
+					entry['latency'].append(latency)
+			pending[0] -= 1
+
+	def _merge_stats(self, stats_list):
+		result = self._new_stats()
+		for stats in stats_list:
+			for key in ['sent', 'responses', 'errors', 'lost', 'latency']:
+				result[key] += stats[key]
+		return result
+
+	def _get_summary(self, stats):
+		latency = sorted(stats['latency'])
+		result = dict((key, stats[key]) for key in ['sent', 'responses', 'errors', 'lost'])
+		result['response_rate'] = stats['responses'] / float(max(1, stats['sent']))
+		result['loss'] = stats['lost'] / float(max(1, stats['sent']))
+		for (name, quantile) in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)]:
+			result[name] = get_percentile(latency, quantile)
+		return result
+
+
+def parse_mix(value):
+	""" Parse a method mix given as "ping:1,find_node:2" """
+	return dict((method, float(weight)) for (method, weight) in (entry.split(':') for entry in value.split(',')))
+
+
+if __name__ == '__main__':
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	options = dict((arg[2:].split('=', 1) + [None])[:2] for arg in sys.argv[1:] if arg.startswith('--'))
+	(rate, duration) = (float(options.get('rate') or 500), float(options.get('duration') or 2))
+	mix = options.get('mix') and parse_mix(options['mix']) or default_mix
+	dht = None
+	if args: # HOST:PORT of the DHT node under test
+		(host, port) = args[0].rsplit(':', 1)
+		target_connection = (host, int(port))
+	else: # start a local DHT node bootstrapping from itself
+		from dht import DHT
+		target_connection = ('127.0.0.1', 16882)
+		dht = DHT(target_connection, target_connection, {'bootstrap_lookup': False})
+	external_connection = None
+	if options.get('external'): # HOST:PORT of the generator seen by the target
+		(host, port) = options['external'].rsplit(':', 1)
+		external_connection = (host, int(port))
+	generator = LoadGenerator(target_connection, sources = int(options.get('sources') or 1000),
+		external_connection = external_connection)
+	try:
+		if options.get('ramp'): # eg. --ramp=1000,2000,5000
+			report = generator.run_ramp([float(value) for value in options['ramp'].split(',')], duration, mix)
+		else:
+			report = generator.run(rate, duration, mix, interval = float(options.get('interval') or 1))
+	finally:
+		generator.shutdown()
+		if dht:
+			dht.shutdown()
+	if 'json' in options:
+		sys.stdout.write(json.dumps(report, indent = 1, sort_keys = True) + '\n')
+	elif 'ramp' in options:
+		for entry in report['reports']:
+			log.critical('rate=%6d send rate=%6d response rate=%.3f loss=%.3f p99=%r' % (entry['setup']['rate'],
+				entry['send_rate'], entry['total']['response_rate'], entry['total']['loss'], entry['total']['p99']))
+		log.critical('maximal rate with loss <= %r: %r' % (report['max_loss'], report['max_rate']))
+	else:
+		def format_summary(entry):
+			latency = tuple((entry[key] != None) and ('%.4f' % entry[key]) or '-' for key in ['p50', 'p90', 'p99', 'p999'])
+			return 'sent=%6d response rate=%.3f loss=%.3f p50=%s p90=%s p99=%s p999=%s' % ((entry['sent'],
+				entry['response_rate'], entry['loss']) + latency)
+		for entry in report['intervals']:
+			log.critical('t=%5.1fs %s' % (entry['t'], format_summary(entry)))
+		for (method, entry) in sorted(report['methods'].items()):
+			log.critical('%-13s %s' % (method, format_summary(entry)))
+		log.critical('total         %s' % format_summary(report['total']))
+	if not (args or options.get('ramp')):
+		assert(report['total']['response_rate'] > 0.9)
+		# Node without the BEP #0042 ip field - the external connection has to be given
+		target = KRPCPeer(('127.0.0.1', 16884), handle_query = lambda send_krpc_response, rec, source_connection:
+			send_krpc_response(message = {b'id': b'x' * 20, b'token': b'token'}))
+		try:
+			try:
+				LoadGenerator(('127.0.0.1', 16884), sources = 10, timeout = 1).shutdown()
+				assert(False)
+			except ValueError:
+				log.exception('expected load generator exception')
+			LoadGenerator(('127.0.0.1', 16884), sources = 10, timeout = 1, external_connection = ('127.0.0.1', 6881)).shutdown()
+		finally:
+			target.shutdown()
@@ -0,0 +1,247 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys, json, random, binascii, threading, logging
+from utils import get_time
+from loadgen import get_percentile
+
+# Traces of iterative DHT lookups - one JSON object per lookup and line with the method, the target,
+# the number of rounds and results, the time until the first result and the list of queries.
+# Each query records the round it was sent in, the node (id, connection and log2 distance to the
+# target), the send time and deadline, the outcome (response, timeout, error or pending if the lookup
+# was closed before), the RTT and the nodes learned from the response (count, new to the lookup and
+# the closest one). Nodes skipped because of too many pending queries are counted as busy.
+# All times are relative to the start of the lookup.
+
+def _hex(value):
+	return binascii.hexlify(value).decode('ascii')
+
+def _distance(id_hex, target_hex):
+	return int(id_hex, 16) ^ int(target_hex, 16)
+
+
+class LookupTrace(object):
+	def __init__(self, recorder, method, target):
+		self._recorder = recorder
+		self._t_start = get_time()
+		self._queries = {} # async result -> query record
+		self.record = {'method': method, 'target': _hex(target), 't_start': self._t_start,
+			'queries': [], 'busy': 0, 'results': 0, 't_first_result': None}
+
+	def busy(self):
+		self.record['busy'] += 1
+
+	def query(self, async_result, node, round_count, t_end):
+		t_now = get_time()
+		node_id = _hex(node.id)
+		query = {'round': round_count, 'id': node_id, 'connection': '%s:%d' % tuple(node.connection[:2]),
+			'distance': _distance(node_id, self.record['target']).bit_length(),
+			't_sent': t_now - self._t_start, 'timeout': t_end - t_now, 'status': 'pending'}
+		self._queries[async_result] = query
+		self.record['queries'].append(query)
+
+	def result(self, async_result, result, nodes, new_nodes, new_results):
+		query = self._queries.pop(async_result, None)
+		if query == None:
+			return
+		t_done = get_time() - self._t_start
+		query['t_done'] = t_done
+		if result:
+			query.update(status = 'response', rtt = async_result.get_rtt())
+		elif async_result.has_result():
+			query['status'] = 'error'
+		else:
+			query['status'] = 'timeout'
+		nodes = list(filter(None, nodes))
+		(query['nodes'], query['new_nodes'], query['results']) = (len(nodes), new_nodes, new_results)
+		target_cmp = int(self.record['target'], 16)
+		if nodes:
+			query['closest'] = _hex(min(nodes, key = lambda n: n.id_cmp ^ target_cmp).id)
+		if new_results:
+			self.record['results'] += new_results
+			if self.record['t_first_result'] == None:
+				self.record['t_first_result'] = t_done
+
+	def finish(self, round_count):
+		self.record.update(rounds = round_count, duration = get_time() - self._t_start)
+		self._recorder.write(self.record)
+
+
+class LookupRecorder(object):
+	def __init__(self, fp, sample = 1):
+		""" Write the traces of the lookups (see DHT.set_lookup_recorder) as JSON lines to the text
+			file object fp - only one out of sample lookups is traced """
+		self._fp = fp
+		self._lock = threading.Lock()
+		self._rate = 1.0 / sample
+		self._random = random.Random() # independent of the (seeded) global random generator
+		self.lookups = 0
+
+	def start_trace(self, method, target):
+		""" Return the LookupTrace for a new lookup (or None if it is not sampled) """
+		if self._random.random() < self._rate:
+			return LookupTrace(self, method, target)
+
+	def write(self, record):
+		line = json.dumps(record, sort_keys = True) + '\n'
+		with self._lock:
+			self._fp.write(line)
+			self.lookups += 1
+
+	def close(self):
+		with self._lock:
+			self._fp.close()
+
+
+def iter_lookup_traces(fp):
+	""" Iterate over the lookup records of a trace file object """
+	for line in fp:
+		if line.strip():
+			yield json.loads(line)
+
+
+def analyze_lookup(record):
+	""" Return the statistics of a single lookup:
+		hops_to_closest - round in which the closest responding node was queried (None without responses)
+		wasted - queries without response or without new results and without learning a node closer
+		         than all nodes known before (the nodes queried in the first round or learned earlier)
+		unused - queries whose response was not processed, since the lookup was closed before """
+	(target, queries) = (record['target'], record['queries'])
+	responses = [query for query in queries if query['status'] == 'response']
+	result = {'queries': len(queries), 'responses': len(responses), 'wasted': 0, 'hops_to_closest': None,
+		'timeouts': sum(1 for query in queries if query['status'] == 'timeout'), 'busy': record['busy'],
+		'unused': sum(1 for query in queries if query['status'] == 'pending'),
+		'rounds': record['rounds'], 'duration': record['duration'], 't_first_result': record['t_first_result']}
+	if responses:
+		result['hops_to_closest'] = min(responses, key = lambda query: _distance(query['id'], target))['round']
+	best = min([_distance(query['id'], target) for query in queries if query['round'] == 1] or [1 << 160])
+	for query in sorted(queries, key = lambda query: query.get('t_done', float('inf'))):
+		if query['status'] != 'response':
+			result['wasted'] += 1
+			continue
+		progress = False
+		if query.get('closest'):
+			distance = _distance(query['closest'], target)
+			if distance < best:
+				(best, progress) = (distance, True)
+		if not (progress or query['results']):
+			result['wasted'] += 1
+	return result
+
+
+def analyze_lookup_traces(records):
+	""" Return a report with the distributions of hops-to-closest, wasted queries and time-to-first-result
+		(and the number of queries, timeouts, rounds and the duration) over the given lookup records """
+	stats = [analyze_lookup(record) for record in records]
+	def summary(values):
+		values = sorted(value for value in values if value != None)
+		if not values:
+			return {'count': 0}
+		return {'count': len(values), 'mean': sum(values) / float(len(values)), 'p50': get_percentile(values, 0.5),
+			'p90': get_percentile(values, 0.9), 'p99': get_percentile(values, 0.99), 'max': values[-1]}
+	(queries, wasted, timeouts, unused) = [sum(entry[key] for entry in stats) for key in ['queries', 'wasted', 'timeouts', 'unused']]
+	hops = {}
+	for entry in stats:
+		if entry['hops_to_closest'] != None:
+			hops[entry['hops_to_closest']] = hops.get(entry['hops_to_closest'], 0) + 1
+	return {'lookups': len(stats), 'queries': queries, 'wasted': wasted, 'timeouts': timeouts, 'unused': unused,
+		'wasted_fraction': wasted / float(max(1, queries)), 'timeout_fraction': timeouts / float(max(1, queries)),
+		'busy': sum(entry['busy'] for entry in stats),
+		'queries_per_lookup': summary(entry['queries'] for entry in stats),
+		'wasted_per_lookup': summary(entry['wasted'] for entry in stats),
+		'hops_to_closest': summary(entry['hops_to_closest'] for entry in stats),
+		'hops_to_closest_counts': dict((str(hop), count) for (hop, count) in sorted(hops.items())),
+		'rounds': summary(entry['rounds'] for entry in stats),
+		'duration': summary(entry['duration'] for entry in stats),
+		't_first_result': summary(entry['t_first_result'] for entry in stats),
+		'with_results': sum(1 for entry in stats if entry['t_first_result'] != None)}
+
+
+def format_report(report):
+	""" Return the lines of a human readable summary of analyze_lookup_traces """
+	def format_summary(entry, unit = ''):
+		if not entry['count']:
+			return '-'
+		return 'mean=%.3g%s p50=%.3g%s p90=%.3g%s p99=%.3g%s max=%.3g%s' % tuple(sum([[entry[key], unit]
+			for key in ['mean', 'p50', 'p90', 'p99', 'max']], []))
+	return ['lookups: %d (%d with results) - %d queries, %d busy nodes skipped' % (report['lookups'],
+			report['with_results'], report['queries'], report['busy']),
+		'wasted queries: %d (%.1f%%), timeouts: %d (%.1f%%), unused (lookup closed before the response): %d' % (
+			report['wasted'], 100 * report['wasted_fraction'], report['timeouts'], 100 * report['timeout_fraction'], report['unused']),
+		'queries per lookup:   %s' % format_summary(report['queries_per_lookup']),
+		'wasted per lookup:    %s' % format_summary(report['wasted_per_lookup']),
+		'hops to closest:      %s %r' % (format_summary(report['hops_to_closest']), report['hops_to_closest_counts']),
+		'rounds:               %s' % format_summary(report['rounds']),
+		'duration:             %s' % format_summary(report['duration'], 's'),
+		'time to first result: %s' % format_summary(report['t_first_result'], 's')]
+
+
+if __name__ == '__main__':
+	logging.basicConfig()
+	log = logging.getLogger()
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	options = dict((arg[2:].split('=', 1) + [None])[:2] for arg in sys.argv[1:] if arg.startswith('--'))
+	if args: # analyze the given trace files
+		records = []
+		for filename in args:
+			with open(filename) as fp:
+				records.extend(iter_lookup_traces(fp))
+	else: # trace find_node lookups in a simulated swarm
+		if sys.version_info[0] >= 3:
+			from io import StringIO
+		else:
+			from StringIO import StringIO
+		from simnet import SimNetwork, create_swarm, fill_routing_tables
+		logging.getLogger('DHT').setLevel(logging.CRITICAL)
+		logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+		(count, lookups) = (int(options.get('nodes') or 300), int(options.get('lookups') or 200))
+		random.seed(0)
+		network = SimNetwork(latency = (0.01, 0.1), loss = float(options.get('loss') or 0.05), seed = 0)
+		with network:
+			nodes = create_swarm(network, count, join_lookup = False)
+			fill_routing_tables(network, nodes)
+			fp = options.get('save') and open(options['save'], 'w') or StringIO()
+			recorder = LookupRecorder(fp)
+			for (source, target) in [network.random.sample(nodes, 2) for x in range(lookups)]:
+				source.set_lookup_recorder(recorder)
+				for result in source.dht_find_node(target.get_identities()[0]):
+					if result == target.get_external_connection():
+						break # like an application, stop once the node is found
+				source.set_lookup_recorder(None)
+			for dht in nodes:
+				dht.shutdown()
+		if options.get('save'):
+			recorder.close()
+			fp = open(options['save'])
+		fp.seek(0)
+		records = list(iter_lookup_traces(fp))
+		fp.close()
+		assert(len(records) == lookups)
+		assert(all(record['rounds'] == max([0] + [query['round'] for query in record['queries']]) for record in records))
+	report = analyze_lookup_traces(records)
+	if 'json' in options:
+		sys.stdout.write(json.dumps(report, indent = 1, sort_keys = True) + '\n')
+	else:
+		for line in format_report(report):
+			log.critical(line)
@@ -0,0 +1,152 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os, sys, mmap, hashlib
+from bencode import bdecode_extra, bdecode_dict_spans, bdecode_dict_spans_extra, BTFailure
+
+# Implementation of BEP #0003 (Bittorrent - section: Metainfo files)
+# The metainfo is read from a memory mapped file (or a given buffer) - only the positions
+# of the dictionary values are determined when opening the file, the values itself are
+# decoded on access. The list of piece hashes is never copied.
+class Metainfo(object):
+	def __init__(self, data):
+		""" Read the metainfo from a bytes-like or mmap object (see also read_metainfo) """
+		self._data = data
+		self._view = memoryview(data)
+		self._spans = bdecode_dict_spans(self._data)
+		if b'info' not in self._spans:
+			raise BTFailure('invalid metainfo (info dictionary missing)')
+		(self._info_start, self._info_end) = self._spans[b'info']
+		self._info_spans = bdecode_dict_spans_extra(self._data, self._info_start)[0]
+		if b'pieces' not in self._info_spans:
+			raise BTFailure('invalid metainfo (pieces missing)')
+		(start, end) = self._info_spans[b'pieces']
+		if not self._data[start:start + 1].isdigit():
+			raise BTFailure('invalid metainfo (pieces is not a byte string)')
+		pieces_start = self._data.find(b':', start) + 1
+		if (end - pieces_start) % 20:
+			raise BTFailure('invalid metainfo (length of pieces is not a multiple of 20)')
+		self._pieces = self._view[pieces_start:end]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		""" Close the memory mapped file - views returned by get_pieces / get_piece_hash have to be released first """
+		if hasattr(self._view, 'release'): # not available in python 2
+			self._pieces.release()
+			self._view.release()
+		if isinstance(self._data, mmap.mmap):
+			self._data.close()
+
+	def get(self, key, default = None):
+		""" Return the decoded top-level value of the given key (eg. b'announce') """
+		if key not in self._spans:
+			return default
+		return bdecode_extra(self._data, self._spans[key][0])[0]
+
+	def get_info(self, key, default = None):
+		""" Return the value of the given key in the info dictionary - byte strings are returned as memoryview """
+		if key not in self._info_spans:
+			return default
+		return bdecode_extra(self._data, self._info_spans[key][0], zero_copy = True)[0]
+
+	def get_info_span(self):
+		""" Return the (start, end) positions of the encoded info dictionary """
+		return (self._info_start, self._info_end)
+
+	def get_info_hash(self):
+		""" Return the SHA-1 hash of the info dictionary as it is encoded in the metainfo """
+		return hashlib.sha1(self._view[self._info_start:self._info_end]).digest()
+
+	def get_pieces(self):
+		""" Return the concatenated piece hashes as memoryview """
+		return self._pieces
+
+	def get_piece_count(self):
+		return len(self._pieces) // 20
+
+	def get_piece_hash(self, idx):
+		return self._pieces[idx * 20:(idx + 1) * 20]
+
+	def iter_piece_hashes(self):
+		for pos in range(0, len(self._pieces), 20):
+			yield self._pieces[pos:pos + 20]
+
+	def get_files(self):
+		""" Return a list of (path, length) tuples - path is a list of byte strings """
+		name = bytes(self.get_info(b'name', b''))
+		if b'files' not in self._info_spans: # single file mode
+			return [([name], self.get_info(b'length'))]
+		files = bdecode_extra(self._data, self._info_spans[b'files'][0])[0]
+		return [([name] + entry[b'path'], entry[b'length']) for entry in files]
+
+def read_metainfo(filename):
+	""" Return the Metainfo of the given file - the file is memory mapped and has to be closed after use """
+	with open(filename, 'rb') as fp:
+		if sys.version_info[0] < 3: # mmap objects do not support memoryview in python 2
+			return Metainfo(fp.read())
+		return Metainfo(mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ))
+
+
+if __name__ == '__main__':
+	import logging, tempfile
+	from bencode import bencode
+	logging.basicConfig()
+	log = logging.getLogger()
+	pieces = os.urandom(20 * 1000)
+	info = {b'name': b'test', b'piece length': 2**18, b'pieces': pieces,
+		b'files': [{b'length': 123, b'path': [b'dir', b'file.bin']}, {b'length': 456, b'path': [b'file.txt']}]}
+	data = bencode({b'announce': b'http://localhost:6969/announce', b'info': info})
+	metainfo = Metainfo(data)
+	assert(metainfo.get_info_hash() == hashlib.sha1(bencode(info)).digest())
+	assert(metainfo.get(b'announce') == b'http://localhost:6969/announce')
+	assert(metainfo.get_piece_count() == 1000)
+	assert(metainfo.get_piece_hash(999) == pieces[-20:])
+	assert(b''.join(bytes(x) for x in metainfo.iter_piece_hashes()) == pieces)
+	assert(metainfo.get_files()[0] == ([b'test', b'dir', b'file.bin'], 123))
+	log.critical('info hash: %s' % hashlib.sha1(bencode(info)).hexdigest())
+	# Info dictionary with unsorted keys - the info hash has to be computed from the original data
+	info_raw = b'd6:pieces20:' + pieces[:20] + b'4:name4:test6:lengthi1ee'
+	metainfo = Metainfo(b'd4:info' + info_raw + b'e')
+	assert(metainfo.get_info_hash() == hashlib.sha1(info_raw).digest())
+	assert(metainfo.get_info_hash() != hashlib.sha1(bencode(metainfo.get(b'info'))).digest())
+	assert(metainfo.get_files() == [([b'test'], 1)])
+	# Memory mapped file
+	with tempfile.NamedTemporaryFile(suffix = '.torrent') as fp:
+		fp.write(data)
+		fp.flush()
+		with read_metainfo(fp.name) as metainfo:
+			assert(metainfo.get_info_hash() == hashlib.sha1(bencode(info)).digest())
+			assert(metainfo.get_piece_hash(0) == pieces[:20])
+	for test_data in [b'd4:infod4:name4:testee', b'd4:infod6:pieces3:abcee', b'de', b'd4:info', b'le',
+			b'd4:infod6:piecesi20ee4:spam20:' + pieces[:20] + b'e', b'd4:infod6:piecesl20:' + pieces[:20] + b'eee']:
+		try:
+			Metainfo(test_data)
+			assert(False)
+		except BTFailure:
+			log.exception('expected metainfo exception')
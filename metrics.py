@@ -0,0 +1,297 @@
+"""
+The MIT License
+
+Copyright (c) 2014-2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys, time, random, threading, collections, logging
+from utils import Histogram, ThreadManager
+
+if sys.version_info[0] >= 3:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+else:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# The metric objects are updated without locking - a lost update under heavy
+# contention is preferred over the cost of a lock on every packet
+class Counter(object):
+	kind = 'counter'
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, value = 1):
+		self.value += value
+
+	def get(self):
+		return self.value
+
+
+class Gauge(object):
+	kind = 'gauge'
+
+	def __init__(self, fun = None):
+		self.value = 0
+		self._fun = fun # evaluated when the gauge is read
+
+	def set(self, value):
+		self.value = value
+
+	def get(self):
+		if self._fun:
+			return self._fun()
+		return self.value
+
+
+class HistogramMetric(Histogram):
+	kind = 'histogram'
+
+	def get(self):
+		return {'count': self.count, 'sum': self.sum,
+			'buckets': list(zip(self.buckets + (float('inf'),), self.counts))}
+
+
+class MetricsRegistry(object):
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._metrics = {} # (name, labels) -> metric
+		self._help = {}
+
+	def counter(self, name, help = '', **labels):
+		return self._get_metric(Counter, name, help, labels)
+
+	def gauge(self, name, help = '', fun = None, **labels):
+		""" Gauges with a function are evaluated when read - registering the same gauge
+			again with another function raises a ValueError (use labels to distinguish them) """
+		return self._get_metric(lambda: Gauge(fun), name, help, labels, fun)
+
+	def histogram(self, name, help = '', buckets = Histogram.default_buckets, **labels):
+		return self._get_metric(lambda: HistogramMetric(buckets), name, help, labels)
+
+	def get_snapshot(self):
+		""" Return dictionary with the current values of all metrics """
+		result = {}
+		for (name, labels), metric in self._get_sorted_metrics():
+			result[name + _format_labels(labels)] = metric.get()
+		return result
+
+	def get_prometheus_text(self):
+		""" Return all metrics in the Prometheus text exposition format """
+		result = []
+		last_name = None
+		for (name, labels), metric in self._get_sorted_metrics():
+			if name != last_name:
+				if self._help.get(name):
+					result.append('# HELP %s %s' % (name, self._help[name]))
+				result.append('# TYPE %s %s' % (name, metric.kind))
+				last_name = name
+			if metric.kind == 'histogram':
+				total = 0
+				for limit, count in zip(metric.buckets + (float('inf'),), metric.counts):
+					total += count
+					le = (limit == float('inf')) and '+Inf' or repr(limit)
+					result.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', le),)), total))
+				result.append('%s_sum%s %r' % (name, _format_labels(labels), metric.sum))
+				result.append('%s_count%s %d' % (name, _format_labels(labels), metric.count))
+			else:
+				result.append('%s%s %r' % (name, _format_labels(labels), metric.get()))
+		return '\n'.join(result) + '\n'
+
+	# Private members #################################################
+
+	def _get_metric(self, factory, name, help, labels, fun = None):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			metric = self._metrics.get(key)
+			if metric == None:
+				metric = self._metrics.setdefault(key, factory())
+				if help:
+					self._help[name] = help
+			elif (fun != None) and (getattr(metric, '_fun', None) != fun): # the later function would be ignored
+				raise ValueError('Metric %s%s is already registered with another function' % (name, _format_labels(key[1])))
+			return metric
+
+	def _get_sorted_metrics(self):
+		with self._lock:
+			return sorted(self._metrics.items(), key = lambda item: item[0])
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	def escape(value): # label values in the Prometheus text format
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for (k, v) in labels)
+
+
+# Latency of the stages in the life of sampled packets - each stage is the time since the previous
+# mark of the same packet. Components hold None instead of a tracer while tracing is disabled.
+class StageTracer(object):
+	stage_buckets = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+	def __init__(self, registry, sample = 100):
+		""" Trace one out of sample packets - the stage latencies are recorded in the histogram
+			krpc_stage_seconds of the registry (labeled by stage) """
+		self._registry = registry
+		self._rate = 1.0 / sample
+		self._random = random.Random() # independent of the (seeded) global random generator
+		self._stages = {}
+		self._local = threading.local() # trace of the packet handled by the current thread
+
+	def is_sampled(self):
+		return self._random.random() < self._rate
+
+	def observe(self, stage, duration):
+		histogram = self._stages.get(stage)
+		if histogram == None:
+			histogram = self._stages.setdefault(stage, self._registry.histogram('krpc_stage_seconds',
+				'Latency of the stages of sampled KRPC packets', buckets = self.stage_buckets, stage = stage))
+		histogram.observe(duration)
+
+	def start(self):
+		""" Start a trace in the current thread (for sampled packets only) """
+		if self.is_sampled():
+			now = time.time()
+			self._local.trace = (now, now)
+		else:
+			self._local.trace = None
+
+	def mark(self, stage):
+		""" Record the time since the previous mark of the current trace as the given stage """
+		trace = getattr(self._local, 'trace', None)
+		if trace:
+			now = time.time()
+			self.observe(stage, now - trace[1])
+			self._local.trace = (trace[0], now)
+
+	def finish(self):
+		""" Record the total time of the current trace """
+		trace = getattr(self._local, 'trace', None)
+		if trace:
+			self.observe('total', time.time() - trace[0])
+			self._local.trace = None
+
+
+# Sampling profiler for a single thread - the stack of the thread is recorded in regular intervals
+# by a background thread. Like cProfile.Profile, it is enabled / disabled in the profiled thread.
+class StackSampler(object):
+	def __init__(self, interval = 0.001):
+		self._interval = interval
+		self._stacks = collections.Counter()
+		self._samples = 0
+		self._stop_event = threading.Event()
+		self._thread = None
+
+	def enable(self):
+		self._stop_event.clear()
+		self._thread = threading.Thread(name = 'stack sampler', target = self._sample, args = (threading.current_thread().ident,))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def disable(self):
+		self._stop_event.set()
+		if self._thread:
+			self._thread.join()
+
+	def get_stats(self, limit = 20):
+		""" Return the samples count and the most common stacks as [(fraction, [(file, line, function), ...]), ...] """
+		return (self._samples, [(count / float(max(1, self._samples)), list(stack))
+			for (stack, count) in self._stacks.most_common(limit)])
+
+	def get_function_stats(self, limit = 20):
+		""" Return [(fraction, function)] with the fraction of samples in which each function was on the stack """
+		counts = collections.Counter()
+		for (stack, count) in self._stacks.items():
+			for function in set('%s:%s' % (filename, name) for (filename, line, name) in stack):
+				counts[function] += count
+		return [(count / float(max(1, self._samples)), function) for (function, count) in counts.most_common(limit)]
+
+	def _sample(self, thread_id):
+		while not self._stop_event.wait(self._interval):
+			frame = sys._current_frames().get(thread_id)
+			if frame == None: # thread has finished
+				break
+			stack = []
+			while frame:
+				stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+				frame = frame.f_back
+			self._stacks[tuple(reversed(stack))] += 1
+			self._samples += 1
+
+
+# Local HTTP endpoint to scrape the metrics of a registry
+class MetricsServer(object):
+	def __init__(self, registry, connection = ('127.0.0.1', 9100)):
+		self._log = logging.getLogger(self.__class__.__name__ + '.%s:%d' % connection)
+		class MetricsRequestHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ['/', '/metrics']:
+					return self.send_error(404)
+				data = registry.get_prometheus_text().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+			def log_message(self, format, *args):
+				pass
+		self._server = HTTPServer(connection, MetricsRequestHandler)
+		self._threads = ThreadManager(self._log)
+		self._threads.start_thread('metrics server', True, self._server.serve_forever)
+
+	def get_connection(self):
+		return self._server.server_address
+
+	def shutdown(self):
+		self._server.shutdown()
+		self._server.server_close()
+		self._threads.join()
+
+
+if __name__ == '__main__':
+	logging.basicConfig()
+	log = logging.getLogger()
+	registry = MetricsRegistry()
+	registry.counter('test_total', 'Test counter', method = 'ping').inc(5)
+	registry.gauge('test_depth', 'Test gauge', fun = lambda: 42)
+	registry.histogram('test_seconds', 'Test histogram').observe(0.003)
+	assert(registry.counter('test_total', method = 'ping').get() == 5)
+	registry.gauge('test_depth') # reading an existing gauge
+	try:
+		registry.gauge('test_depth', fun = lambda: 23)
+		assert(False)
+	except ValueError:
+		log.exception('expected metrics exception')
+	registry.counter('test_total', path = 'C:\\tmp\n"x"').inc()
+	assert('test_total{path="C:\\\\tmp\\n\\"x\\""} 1' in registry.get_prometheus_text())
+	server = MetricsServer(registry, ('127.0.0.1', 0))
+	try:
+		if sys.version_info[0] >= 3:
+			from urllib.request import urlopen
+		else:
+			from urllib import urlopen
+		text = urlopen('http://%s:%d/metrics' % server.get_connection()).read().decode('utf-8')
+		assert('test_total{method="ping"} 5' in text)
+		assert('test_seconds_bucket{le="0.005"} 1' in text)
+		log.critical(text)
+		log.critical(registry.get_snapshot())
+	finally:
+		server.shutdown()
@@ -0,0 +1,390 @@
+"""
+The MIT License
+
+Copyright (c) 2015 Fred Stober
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import heapq, itertools, random, logging, bisect
+from utils import AsyncTimeout, Histogram, get_address_family, set_clock
+
+# Transport of a KRPC peer in a simulated network (see KRPCPeer) - packets are delivered by the network
+class SimTransport(object):
+	def __init__(self, network, connection, public_connection):
+		self.family = get_address_family(connection)
+		self.connection = connection
+		self.public_connection = public_connection # address seen by other peers
+		self._network = network
+		self._receiver = None
+		self._nat_peers = None
+		if public_connection != connection: # port restricted NAT - only answers are let through
+			self._nat_peers = set()
+
+	def set_receiver(self, fun):
+		self._receiver = fun
+
+	def sendto(self, data, connection):
+		self._network._send(self, data, connection)
+
+	def get_queue_size(self):
+		return (0, 0)
+
+	def close(self):
+		self._network._remove(self)
+
+
+# Scheduler of periodic jobs (see TimerScheduler) running on the virtual clock of a network
+class SimScheduler(object):
+	def __init__(self, network):
+		self._network = network
+		self._jobs = 0
+		self._running = False
+		self.lag = Histogram()
+		self.lag_max = 0
+
+	def add_job(self, job, delay):
+		self._jobs += 1
+		self._network.call_later(delay, self._run, job)
+
+	def cancel_jobs(self, manager):
+		pass # jobs of stopped thread managers are not scheduled again
+
+	def get_job_count(self):
+		return self._jobs
+
+	def get_worker_count(self):
+		return 0
+
+	# Private members #################################################
+
+	def _run(self, job):
+		self._jobs -= 1
+		if self._running: # a blocking job is waiting for packets - avoid nested jobs
+			return self.add_job(job, 1)
+		self._running = True
+		try:
+			reschedule = job.run()
+		finally:
+			self._running = False
+		if reschedule:
+			self.add_job(job, job.interval)
+
+
+# In-process network with latency, packet loss and NAT on a virtual clock - while the network is
+# started, the clock of the process is replaced, so waiting for a result processes the packets
+# and timers instead of sleeping. Periodic jobs of the components are executed on the virtual clock.
+# Everything runs in a single thread and is reproducible for the same seed (components must not
+# start their own threads - see sim_setup).
+class SimNetwork(object):
+	def __init__(self, latency = (0.01, 0.1), loss = 0, seed = 0):
+		""" latency is the (min, max) range of the one-way delay of a packet in seconds
+			or a function(source connection, target connection) returning the delay,
+			loss is the probability that a packet is dropped """
+		self.random = random.Random(seed)
+		self._latency = latency
+		self._loss = loss
+		self._now = 0.0
+		self._events = [] # (time, sequence number, function, arguments)
+		self._sequence = itertools.count()
+		self._transports = {} # public connection -> transport
+		self._previous_clock = None
+		self._scheduler = SimScheduler(self)
+		self.stats = {'sent': 0, 'bytes': 0, 'delivered': 0, 'lost': 0, 'filtered': 0, 'unreachable': 0}
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def start(self):
+		""" Use the virtual clock of the network """
+		self._previous_clock = set_clock(self)
+
+	def stop(self):
+		set_clock(self._previous_clock)
+
+	def create_transport(self, connection, nat_connection = None):
+		""" Return transport for the given connection - peers behind a NAT are reachable via nat_connection
+			by peers they sent a packet to before """
+		transport = SimTransport(self, connection, nat_connection or connection)
+		if transport.public_connection in self._transports:
+			raise ValueError('Connection %s:%d is already in use' % transport.public_connection)
+		self._transports[transport.public_connection] = transport
+		return transport
+
+	def time(self):
+		return self._now
+
+	def get_scheduler(self):
+		return self._scheduler
+
+	def wait(self, event, timeout = None):
+		""" Process packets and timers until the event is set or the timeout is reached """
+		t_end = None
+		if timeout != None:
+			t_end = self._now + timeout
+		events = self._events
+		while not event.is_set():
+			if not events or ((t_end != None) and (events[0][0] > t_end)):
+				if t_end != None:
+					self._now = max(self._now, t_end)
+				return event.is_set()
+			self._step()
+		return True
+
+	def call_later(self, delay, fun, *args):
+		heapq.heappush(self._events, (self._now + delay, next(self._sequence), fun, args))
+
+	def run(self, duration = None):
+		""" Process packets and timers for the given time (or until nothing is left to do) """
+		t_end = None
+		if duration != None:
+			t_end = self._now + duration
+		while self._events and ((t_end == None) or (self._events[0][0] <= t_end)):
+			self._step()
+		if t_end != None:
+			self._now = max(self._now, t_end)
+
+	# Private members #################################################
+
+	def _step(self):
+		(self._now, sequence, fun, args) = heapq.heappop(self._events)
+		fun(*args)
+
+	def _send(self, transport, data, connection):
+		self.stats['sent'] += 1
+		self.stats['bytes'] += len(data)
+		if transport._nat_peers != None:
+			transport._nat_peers.add(connection)
+		if self._loss and (self.random.random() < self._loss):
+			self.stats['lost'] += 1
+			return
+		if callable(self._latency):
+			delay = self._latency(transport.public_connection, connection)
+		else:
+			delay = self.random.uniform(*self._latency)
+		self.call_later(delay, self._deliver, data, transport.public_connection, connection)
+
+	def _deliver(self, data, source_connection, connection):
+		transport = self._transports.get(connection)
+		if not transport or not transport._receiver:
+			self.stats['unreachable'] += 1
+		elif (transport._nat_peers != None) and (source_connection not in transport._nat_peers):
+			self.stats['filtered'] += 1
+		else:
+			self.stats['delivered'] += 1
+			transport._receiver(data, source_connection)
+
+	def _remove(self, transport):
+		if self._transports.get(transport.public_connection) is transport:
+			self._transports.pop(transport.public_connection)
+
+
+# Latency function for SimNetwork with a fixed base delay per link (pair of connections, drawn from
+# the (min, max) range) and an exponentially distributed jitter per packet with a mean of jitter * base delay
+class LinkLatency(object):
+	def __init__(self, latency = (0.01, 0.3), jitter = 0.5, seed = 0):
+		self.random = random.Random(seed)
+		(self._latency, self._jitter) = (latency, jitter)
+		self._links = {} # (connection, connection) -> base delay
+
+	def __call__(self, source_connection, connection):
+		link = (min(source_connection, connection), max(source_connection, connection))
+		base = self._links.get(link)
+		if base == None:
+			base = self._links[link] = self.random.uniform(*self._latency)
+		if not self._jitter:
+			return base
+		return base * (1 + self.random.expovariate(1. / self._jitter))
+
+
+
+# DHT setup for simulations - no bootstrap lookup thread, no blocking maintenance jobs (they would
+# delay the simulated lookups) and smaller routing tables to fit many nodes into one process
+sim_setup = {'maintain_t': -1, 'bootstrap_lookup': False, 'report_t': -1, 'limit_t': 300, 'limit_N': 200,
+	'cleanup_t': 60}
+
+def create_swarm(network, count, nat_fraction = 0, setup = {}, metrics = None, join_lookup = True):
+	""" Start count DHT nodes with random public addresses - each node bootstraps from a random
+		reachable node and then searches for its own id (with join_lookup).
+		The metrics of the nodes in a shared registry are labeled with their listen connection (node="ip:port").
+		Returns the list of DHT nodes. """
+	from dht import DHT
+	log = logging.getLogger('SimNetwork')
+	rnd = network.random
+	(nodes, reachable, used_ips) = ([], [], set())
+	def get_ip():
+		while True:
+			ip = '%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+			if (ip not in used_ips) and not ip.startswith('10.') and not ip.startswith('127.'):
+				used_ips.add(ip)
+				return ip
+	for idx in range(count):
+		node_setup = dict(sim_setup, node_id = bytes(bytearray(rnd.getrandbits(8) for x in range(20))))
+		node_setup.update(setup)
+		connection = (get_ip(), 6881)
+		nat_connection = None
+		if reachable and (rnd.random() < nat_fraction):
+			nat_connection = (get_ip(), rnd.randint(1024, 65535))
+			connection = ('10.0.%d.%d' % (idx // 254 % 256, idx % 254 + 1), 6881)
+		for attempt in range(10): # the bootstrap ping might get lost
+			bootstrap_connection = connection # the first node bootstraps from itself
+			if reachable:
+				bootstrap_connection = rnd.choice(reachable).get_external_connection()
+			transport = network.create_transport(connection, nat_connection)
+			try:
+				dht = DHT(connection, bootstrap_connection, node_setup, metrics = metrics, transport = transport,
+					metric_labels = metrics and {'node': '%s:%d' % connection} or {})
+				break
+			except AsyncTimeout:
+				transport.close()
+		else:
+			raise AsyncTimeout('Unable to bootstrap node %d' % idx)
+		if join_lookup:
+			for result in dht.dht_find_node(dht.get_identities()[0], retries = 1): # same as the bootstrap lookup
+				pass
+		nodes.append(dht)
+		if not nat_connection:
+			reachable.append(dht)
+		if len(nodes) % 1000 == 0:
+			log.info('%d nodes started after %.1fs (virtual time) - %d packets sent' %
+				(len(nodes), network.time(), network.stats['sent']))
+	return nodes
+
+def fill_routing_tables(network, nodes, k = 8):
+	""" Register k random nodes of each distance bucket in the routing tables of the given DHT nodes -
+		a converged swarm without running the join lookups (nodes behind a NAT are not registered) """
+	from dht import decode_id, encode_id
+	def is_reachable(dht):
+		return network._transports[dht.get_external_connection()]._nat_peers == None
+	reachable = sorted((dht.get_identities()[0], dht.get_external_connection()) for dht in filter(is_reachable, nodes))
+	ids = [node_id for (node_id, connection) in reachable]
+	def get_range(start, bits): # positions of the ids in [start, start + 2^bits)
+		pos_start = bisect.bisect_left(ids, encode_id(start))
+		if (start + (1 << bits)) >> 160:
+			return (pos_start, len(ids))
+		return (pos_start, bisect.bisect_left(ids, encode_id(start + (1 << bits)), pos_start))
+	for dht in nodes:
+		id_cmp = decode_id(dht.get_identities()[0])
+		for bits in range(159, -1, -1):
+			# bucket with the nodes at distance [2^bits, 2^(bits + 1))
+			entries = reachable[slice(*get_range(((id_cmp >> bits) ^ 1) << bits, bits))]
+			if len(entries) > k:
+				entries = network.random.sample(entries, k)
+			(pos_start, pos_end) = get_range((id_cmp >> bits) << bits, bits) # nodes at distance < 2^bits
+			if pos_end - pos_start <= k + 1: # the remaining buckets hold at most k nodes together
+				entries = entries + reachable[pos_start:pos_end]
+			for (node_id, connection) in entries:
+				if node_id != dht.get_identities()[0]:
+					dht._nodes.register_node(connection, node_id)
+			if pos_end - pos_start <= k + 1:
+				break
+		dht._nodes.flush()
+
+
+if __name__ == '__main__':
+	import sys, time
+	logging.basicConfig()
+	log = logging.getLogger()
+	logging.getLogger('KRPCPeer').setLevel(logging.CRITICAL)
+	logging.getLogger('DHT').setLevel(logging.CRITICAL)
+	logging.getLogger('SimNetwork').setLevel(logging.INFO)
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	count = int((args + [1000])[0]) # number of nodes
+	join_lookup = '--no-join-lookup' not in sys.argv
+
+	def run_simulation(seed):
+		random.seed(seed) # used by the DHT
+		network = SimNetwork(latency = (0.01, 0.2), loss = 0.02, seed = seed)
+		with network:
+			t_start = time.time()
+			nodes = create_swarm(network, count, nat_fraction = 0.2, join_lookup = join_lookup)
+			if not join_lookup:
+				fill_routing_tables(network, nodes)
+			log.critical('%d nodes started after %.1fs (virtual: %.1fs) - packets: %r' %
+				(count, time.time() - t_start, network.time(), network.stats))
+			(found, first_time, packets) = (0, [], [])
+			(rounds_count, rounds_sum) = (0, 0)
+			for idx in range(20):
+				(source, target) = network.random.sample(nodes, 2)
+				target_id = target.get_identities()[0]
+				rounds = source.get_metrics().histogram('dht_lookup_rounds', method = 'find_node')
+				(rounds_count, rounds_sum) = (rounds_count - rounds.count, rounds_sum - rounds.sum)
+				(t_lookup, sent) = (network.time(), network.stats['sent'])
+				for result in source.dht_find_node(target_id):
+					if result == target.get_external_connection():
+						found += 1
+						first_time.append(network.time() - t_lookup)
+						break
+				packets.append(network.stats['sent'] - sent)
+				(rounds_count, rounds_sum) = (rounds_count + rounds.count, rounds_sum + rounds.sum)
+			log.critical('lookups: %d / 20 found the target after %.2fs (virtual, mean) - %.1f rounds and %.1f packets per lookup' %
+				(found, sum(first_time) / max(1, len(first_time)), rounds_sum / float(rounds_count),
+				sum(packets) / float(len(packets))))
+			for dht in nodes:
+				dht.shutdown()
+			return (network.stats, found, first_time, packets)
+
+	def run_timeout_comparison(seed, lookups = 100, churn = 0.2):
+		""" Compare the lookup durations with fixed query timeouts (rtt_min_timeout = lookup timeout)
+			and with timeouts from the RTT estimates - links have jittered delays and a part of the
+			nodes leaves the swarm without notice before the lookups """
+		from loadgen import get_percentile
+		result = {}
+		for (name, setup) in [('fixed', {'rtt_min_timeout': 5}), ('rtt', {})]:
+			random.seed(seed)
+			network = SimNetwork(latency = LinkLatency(seed = seed), loss = 0.02, seed = seed)
+			with network:
+				nodes = create_swarm(network, count, nat_fraction = 0.2, setup = setup, join_lookup = join_lookup)
+				if not join_lookup:
+					fill_routing_tables(network, nodes)
+				departed = network.random.sample(nodes, int(churn * count))
+				for dht in departed:
+					dht.shutdown()
+				nodes = [dht for dht in nodes if dht not in departed]
+				(found_time, durations) = ([], [])
+				for idx in range(lookups):
+					(source, target) = network.random.sample(nodes, 2)
+					t_lookup = network.time()
+					for entry in source.dht_find_node(target.get_identities()[0]):
+						if entry == target.get_external_connection():
+							found_time.append(network.time() - t_lookup)
+					durations.append(network.time() - t_lookup)
+				for dht in nodes:
+					dht.shutdown()
+			result[name] = {}
+			for (key, values) in [('found', found_time), ('finished', durations)]:
+				values.sort()
+				result[name][key] = dict((stat, get_percentile(values, quantile))
+					for (stat, quantile) in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1)])
+				log.critical('%s timeouts: %d / %d lookups %s after p50=%.2fs p90=%.2fs p99=%.2fs max=%.2fs (virtual)' % (
+					name, len(values), lookups, key, result[name][key]['p50'], result[name][key]['p90'],
+					result[name][key]['p99'], result[name][key]['max']))
+		return result
+
+	if '--rtt' in sys.argv:
+		result = run_timeout_comparison(seed = 42)
+		assert(result['rtt']['finished']['p50'] < result['fixed']['finished']['p50'])
+		sys.exit(0)
+	result = run_simulation(seed = 42)
+	if count <= 1000:
+		assert(result == run_simulation(seed = 42)) # deterministic
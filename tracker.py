@@ -22,126 +22,574 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import sys, socket, random
+import sys, time, socket, random, threading, logging, zlib
 from bencode import bdecode
-from utils import UDPSocket, encode_int32, decode_connection
-from utils import encode_ip, encode_uint64, encode_uint32, encode_uint16
-from utils import decode_ip, decode_uint64, decode_uint32
+from utils import UDPSocket, AsyncResult, AsyncTimeout, ThreadManager, resolve_connection, merge_async_results
+from utils import encode_ip, encode_uint64, encode_uint32, encode_uint16, encode_int32
+from utils import decode_ip, decode_uint64, decode_uint32, decode_connections, decode_connections6
+from metrics import MetricsRegistry
 
 class TrackerException(Exception):
 	pass
 
 if sys.version_info[0] >= 3:
-	import urllib.request, urllib.parse, urllib.error, urllib.parse
+	import urllib.parse, http.client as httplib, queue
 	def parse_url(url):
 		return urllib.parse.urlparse(url)
-	def open_url(tracker_url, query):
-		url = tracker_url + '?' + urllib.parse.urlencode(list(query.items()))
-		return urllib.request.urlopen(url)
+	def encode_query(query_list):
+		return urllib.parse.urlencode(query_list)
 else:
-	import urllib, urlparse
+	import urllib, urlparse, httplib, Queue as queue
 	def parse_url(url):
 		return urlparse.urlparse(url)
-	def open_url(tracker_url, query):
-		url = tracker_url + '?' + urllib.urlencode(query.items())
-		return urllib.urlopen(url)
-
-def decode_connections(data):
-	while len(data) >= 6:
-		c = decode_connection(data[0:6])
-		if c[1] >= 1024:
-			yield c
-		data = data[6:]
+	def encode_query(query_list):
+		return urllib.urlencode(query_list)
 
 # Implementation of BEP #0015 (UDP tracker protocol)
+udp_action_connect = 0
+udp_action_announce = 1
+udp_action_scrape = 2
+udp_action_error = 3
+udp_protocol_id = 0x41727101980
+udp_scrape_max = 74 # maximal number of info hashes per scrape request
+udp_event = {'empty': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# State of a pending request to an UDP tracker
+class UDPTrackerRequest(object):
+	def __init__(self, tracker, action, payload, deadline, info_hash_list = None):
+		self.tracker = tracker
+		self.action = action
+		self.payload = payload # request data after the connection id, action and transaction id
+		self.deadline = deadline
+		self.info_hash_list = info_hash_list # scrape requests
+		self.transaction_id = None
+		self.connection_id = None
+		self.attempt = 0
+		self.t_retransmit = None
+		self.result = AsyncResult(source = (action, tracker))
+
+
+# Client for many concurrent requests to UDP trackers - all requests share one socket
+# and are matched to the responses by their transaction id. The connection id of each
+# tracker is reused for connection_id_t seconds. Requests are retransmitted after
+# retransmit_t * 2^n seconds (n = 0..8) until their deadline is reached.
+class UDPTrackerClient(object):
+	def __init__(self, connection = ('0.0.0.0', 0), retransmit_t = 15, connection_id_t = 60, metrics = None, daemon = False):
+		self._log = logging.getLogger(self.__class__.__name__ + '.%s:%d' % connection)
+		self._sock = UDPSocket(connection, daemon)
+		self._retransmit_t = retransmit_t
+		self._connection_id_t = connection_id_t
+		self._lock = threading.Lock()
+		self._transaction = {} # transaction id -> request (including connect requests)
+		self._connection_ids = {} # tracker -> (connection id, time of the connect response)
+		self._connecting = {} # tracker -> requests waiting for a connection id
+		metrics = metrics or MetricsRegistry()
+		self._metric_requests = {}
+		for (action, label) in [(udp_action_connect, 'connect'), (udp_action_announce, 'announce'), (udp_action_scrape, 'scrape')]:
+			self._metric_requests[action] = metrics.counter('tracker_udp_requests_total', 'Requests sent to UDP trackers', action = label)
+		self._metric_retransmits = metrics.counter('tracker_udp_retransmits_total', 'Retransmitted UDP tracker requests')
+		self._metric_timeouts = metrics.counter('tracker_udp_timeouts_total', 'UDP tracker requests without response')
+		metrics.gauge('tracker_udp_pending', 'Number of pending UDP tracker requests', fun = lambda: len(self._transaction))
+		self._threads = ThreadManager(self._log, daemon = daemon)
+		self._threads.start_continuous_thread(self._listen)
+		self._threads.start_continuous_thread(self._retransmit, thread_interval = min(1, retransmit_t / 4.))
+
+	def announce(self, tracker_url, info_hash, peer_id, ip = '0.0.0.0', port = 0,
+			uploaded = 0, downloaded = 0, left = 0, event = 'started', num_want = -1, key = 0, timeout = 120):
+		""" Returns an AsyncResult with the dictionary {'interval', 'leechers', 'seeders', 'peers'} """
+		assert(len(info_hash) == 20)
+		assert(len(peer_id) == 20)
+		payload = info_hash + peer_id + encode_uint64(downloaded) + encode_uint64(left) + encode_uint64(uploaded) + \
+			encode_uint32(udp_event[event]) + encode_ip(ip) + encode_uint32(key) + encode_int32(num_want) + encode_uint16(port)
+		return self._request(tracker_url, udp_action_announce, payload, timeout)
+
+	def scrape(self, tracker_url, info_hash_list, timeout = 120):
+		""" Returns an AsyncResult with the dictionary {info_hash: {'seeders', 'completed', 'leechers'}}
+			Up to 74 info hashes are requested at the same time """
+		result_list = []
+		for idx in range(0, len(info_hash_list), udp_scrape_max):
+			batch = list(info_hash_list[idx:idx + udp_scrape_max])
+			result_list.append(self._request(tracker_url, udp_action_scrape, b''.join(batch), timeout, batch))
+		if len(result_list) == 1:
+			return result_list[0]
+		return merge_async_results(result_list, source = (udp_action_scrape, tracker_url))
+
+	def shutdown(self):
+		self._threads.shutdown()
+		with self._lock:
+			requests = list(self._transaction.values())
+			for waiting in self._connecting.values():
+				requests.extend(waiting)
+			(self._transaction, self._connecting) = ({}, {})
+		for request in requests:
+			request.result.set_result(AsyncTimeout('Shutdown in progress'))
+		self._sock.close()
+		self._threads.join()
+
+	# Private members #################################################
+
+	def _request(self, tracker_url, action, payload, timeout, info_hash_list = None):
+		url = parse_url(tracker_url)
+		tracker = resolve_connection((url.hostname, url.port), self._sock.family)
+		request = UDPTrackerRequest(tracker, action, payload, time.time() + timeout, info_hash_list)
+		with self._lock:
+			self._send_request(request)
+		return request.result
+
+	def _send_request(self, request): # with self._lock
+		(connection_id, t_connection_id) = self._connection_ids.get(request.tracker, (None, 0))
+		if time.time() - t_connection_id < self._connection_id_t:
+			return self._send(request, connection_id)
+		waiting = self._connecting.get(request.tracker)
+		if waiting == None: # start handshake
+			self._connecting[request.tracker] = [request]
+			self._send(UDPTrackerRequest(request.tracker, udp_action_connect, b'', request.deadline), udp_protocol_id)
+		else:
+			waiting.append(request)
+
+	def _send(self, request, connection_id): # with self._lock
+		if request.transaction_id == None:
+			while True:
+				request.transaction_id = random.randint(0, 2**32-1)
+				if request.transaction_id not in self._transaction:
+					break
+			self._transaction[request.transaction_id] = request
+		request.connection_id = connection_id
+		request.t_retransmit = time.time() + self._retransmit_t * 2 ** request.attempt
+		self._metric_requests[request.action].inc()
+		self._sock.sendto(encode_uint64(connection_id) + encode_uint32(request.action) +
+			encode_uint32(request.transaction_id) + request.payload, request.tracker)
+
+	def _fail(self, request, ex): # with self._lock
+		self._transaction.pop(request.transaction_id, None)
+		failed = [request]
+		if request.action == udp_action_connect:
+			failed = self._connecting.pop(request.tracker, [])
+		for failed_request in failed:
+			failed_request.result.set_result(ex)
+
+	def _retransmit(self):
+		now = time.time()
+		with self._lock:
+			for tracker, (connection_id, t_connection_id) in list(self._connection_ids.items()):
+				if now - t_connection_id >= self._connection_id_t:
+					self._connection_ids.pop(tracker)
+			for request in list(self._transaction.values()):
+				if request.t_retransmit > now:
+					continue
+				if (now > request.deadline) or (request.attempt >= 8):
+					self._metric_timeouts.inc()
+					self._fail(request, TrackerException('Tracker %s:%d did not answer' % request.tracker))
+					continue
+				request.attempt += 1
+				self._metric_retransmits.inc()
+				if request.action == udp_action_connect:
+					self._send(request, udp_protocol_id)
+				elif request.tracker in self._connection_ids:
+					self._send(request, self._connection_ids[request.tracker][0])
+				else: # connection id expired - the request waits for a new handshake
+					self._transaction.pop(request.transaction_id)
+					request.transaction_id = None
+					self._send_request(request)
+
+	def _listen(self):
+		recv_data = self._sock.recvfrom(timeout = 0.2)
+		if not recv_data:
+			return
+		(data, source_connection) = recv_data
+		if len(data) < 8:
+			return
+		action = decode_uint32(data[0:4])
+		with self._lock:
+			request = self._transaction.get(decode_uint32(data[4:8]))
+			if (request == None) or (request.tracker != source_connection):
+				return
+			if action == udp_action_error:
+				return self._fail(request, TrackerException(data[8:].decode('utf-8', 'replace')))
+			if (action != request.action) or (len(data) < 16):
+				return
+			self._transaction.pop(request.transaction_id)
+			if action == udp_action_connect:
+				connection_id = decode_uint64(data[8:16])
+				self._connection_ids[request.tracker] = (connection_id, time.time())
+				for waiting in self._connecting.pop(request.tracker, []):
+					self._send(waiting, connection_id)
+				return
+		if action == udp_action_announce:
+			if self._sock.family == socket.AF_INET6:
+				peers = decode_connections6(data[20:])
+			else:
+				peers = decode_connections(data[20:])
+			request.result.set_result({'interval': decode_uint32(data[8:12]), 'leechers': decode_uint32(data[12:16]),
+				'seeders': decode_uint32(data[16:20]), 'peers': list(peers)}, source = source_connection)
+		elif action == udp_action_scrape:
+			result = {}
+			for idx, info_hash in enumerate(request.info_hash_list):
+				entry = data[8 + 12 * idx:20 + 12 * idx]
+				if len(entry) == 12:
+					result[info_hash] = {'seeders': decode_uint32(entry[0:4]),
+						'completed': decode_uint32(entry[4:8]), 'leechers': decode_uint32(entry[8:12])}
+			request.result.set_result(result, source = source_connection)
+
+_udp_client = None
+_udp_client_lock = threading.Lock()
+
+def get_udp_tracker_client():
+	""" Return the UDP tracker client shared by all udp_get_peers calls """
+	global _udp_client
+	with _udp_client_lock:
+		if _udp_client == None:
+			_udp_client = UDPTrackerClient(daemon = True)
+		return _udp_client
+
 def udp_get_peers(tracker_url, info_hash, peer_id, ip = '0.0.0.0', port = 0,
 		uploaded = 0, downloaded = 0, left = 0, event = 'started', num_want = -1, key = 0):
-	event = {'empty': 0, 'completed': 1, 'started': 2, 'stopped': 3}[event]
-	url = parse_url(tracker_url)
-	conn = (socket.gethostbyname(url.hostname), url.port)
-	sock = UDPSocket(('0.0.0.0', 0))
+	return get_udp_tracker_client().announce(tracker_url, info_hash, peer_id, ip, port,
+		uploaded, downloaded, left, event, num_want, key).get_result()['peers']
 
-	def recv():
-		timeout = 5
-		while True:
-			try:
-				data, src = sock.recvfrom(timeout)
-			except:
-				data = None
-			if not data:
-				timeout *= 2
-				if timeout > 60:
-					break
+# Implementation of BEP #0003 (Bittorrent - section: HTTP Tracker protocol)
+# Client for concurrent requests to HTTP trackers - the requests are processed by a pool of
+# workers threads using persistent connections (one pool of idle connections per host).
+# Announce results are cached until the (min) interval given by the tracker has passed.
+class HTTPTrackerClient(object):
+	def __init__(self, workers = 4, timeout = 30, max_idle = 2, metrics = None, daemon = False, cleanup_interval = 60):
+		self._log = logging.getLogger(self.__class__.__name__)
+		self._timeout = timeout
+		self._max_idle = max_idle # idle connections kept per host
+		self._lock = threading.Lock()
+		self._idle = {} # (scheme, host, port) -> idle connections
+		self._cache = {} # (tracker_url, info_hash) -> (announce result, time of the next announce)
+		self._queue = queue.Queue()
+		self._metrics = metrics or MetricsRegistry()
+		self._stats = {} # tracker host -> (requests counter, failure counter, latency histogram)
+		self._threads = ThreadManager(self._log, daemon = daemon)
+		self._workers = workers
+		for idx in range(workers):
+			self._threads.start_thread('http tracker worker', daemon, self._worker)
+		self._threads.start_continuous_thread(self._cleanup_cache, thread_interval = cleanup_interval)
+
+	def announce(self, tracker_url, info_hash, peer_id, ip = '0.0.0.0', port = 0,
+			uploaded = 0, downloaded = 0, left = 0, event = 'started', force = False, timeout = None):
+		""" Returns an AsyncResult with the dictionary {'interval', 'complete', 'incomplete', 'peers'}
+			The cached result is returned until the announce interval of the tracker has passed
+			(except for 'stopped' / 'completed' events or with force)
+			The socket timeout of the request is given by timeout (default: timeout of the client) """
+		key = (tracker_url, info_hash)
+		if not force and (event not in ['stopped', 'completed']):
+			(cached, t_next) = self._get_cached(key)
+			if cached:
+				result = AsyncResult(source = tracker_url)
+				result.set_result(dict(cached, cached = True))
+				return result
+		query = [('info_hash', info_hash), ('peer_id', peer_id), ('ip', ip), ('port', port),
+			('uploaded', uploaded), ('downloaded', downloaded), ('left', left), ('compact', 1)]
+		if event:
+			query.append(('event', event))
+		def process_announce(decoded):
+			if not b'peers' in decoded:
+				raise TrackerException(decoded.get(b'failure reason', 'Unknown failure'))
+			peers = decoded[b'peers']
+			if isinstance(peers, list): # non-compact peer list
+				peers = [(entry[b'ip'].decode('ascii'), entry[b'port']) for entry in peers]
+			else:
+				peers = list(decode_connections(peers))
+			result = {'interval': decoded.get(b'interval', 1800), 'peers': peers, 'cached': False,
+				'complete': decoded.get(b'complete'), 'incomplete': decoded.get(b'incomplete')}
+			with self._lock:
+				self._cache[key] = (result, time.time() + decoded.get(b'min interval', result['interval']))
+			return result
+		return self._submit(tracker_url, query, process_announce, timeout)
+
+	def scrape(self, tracker_url, info_hash_list, timeout = None):
+		""" Returns an AsyncResult with the dictionary {info_hash: {'complete', 'downloaded', 'incomplete'}}
+			The scrape url is derived from the announce url (see BEP #0048) """
+		url = parse_url(tracker_url)
+		path_parts = url.path.rsplit('/', 1)
+		if (len(path_parts) != 2) or not path_parts[1].startswith('announce'):
+			raise TrackerException('Tracker %s does not support scrape requests' % tracker_url)
+		scrape_url = tracker_url.replace(url.path, path_parts[0] + '/scrape' + path_parts[1][len('announce'):], 1)
+		def process_scrape(decoded):
+			result = {}
+			for info_hash, entry in decoded.get(b'files', {}).items():
+				result[info_hash] = {'complete': entry.get(b'complete'), 'downloaded': entry.get(b'downloaded'),
+					'incomplete': entry.get(b'incomplete')}
+			return result
+		return self._submit(scrape_url, [('info_hash', info_hash) for info_hash in info_hash_list], process_scrape, timeout)
+
+	def get_announce_time(self, tracker_url, info_hash):
+		""" Return the time when the tracker allows the next announce (0 if unknown or already allowed) """
+		return self._get_cached((tracker_url, info_hash))[1]
+
+	def get_tracker_stats(self):
+		""" Return number of requests, failures and latency histogram of each tracker host """
+		return dict((host, {'requests': requests.get(), 'failures': failures.get(), 'latency': latency})
+			for (host, (requests, failures, latency)) in list(self._stats.items()))
+
+	def shutdown(self):
+		self._threads.shutdown()
+		for idx in range(self._workers):
+			self._queue.put(None) # wake up workers
+		self._threads.join()
+		while not self._queue.empty():
+			job = self._queue.get()
+			if job:
+				job[-1].set_result(AsyncTimeout('Shutdown in progress'))
+		with self._lock:
+			for connections in self._idle.values():
+				for conn in connections:
+					conn.close()
+			self._idle = {}
+
+	# Private members #################################################
+
+	def _submit(self, url, query, process_fun, timeout):
+		result = AsyncResult(source = url)
+		if self._threads.shutdown_in_progress():
+			result.set_result(AsyncTimeout('Shutdown in progress'))
+		else:
+			self._queue.put((url, query, process_fun, timeout or self._timeout, result))
+		return result
+
+	def _get_cached(self, key): # expired results are dropped
+		with self._lock:
+			(cached, t_next) = self._cache.get(key, (None, 0))
+			if cached and (time.time() >= t_next):
+				self._cache.pop(key)
+				return (None, 0)
+			return (cached, t_next)
+
+	def _cleanup_cache(self):
+		now = time.time()
+		with self._lock:
+			for key in [key for (key, (cached, t_next)) in self._cache.items() if now >= t_next]:
+				self._cache.pop(key)
+
+	def _get_stats(self, host):
+		stats = self._stats.get(host)
+		if stats == None:
+			stats = (self._metrics.counter('tracker_http_requests_total', 'Requests sent to HTTP trackers', tracker = host),
+				self._metrics.counter('tracker_http_failures_total', 'Failed HTTP tracker requests', tracker = host),
+				self._metrics.histogram('tracker_http_seconds', 'Latency of HTTP tracker requests', tracker = host))
+			stats = self._stats.setdefault(host, stats)
+		return stats
+
+	def _worker(self):
+		while not self._threads.shutdown_in_progress():
+			job = self._queue.get()
+			if job == None:
 				continue
+			(url, query, process_fun, timeout, result) = job
+			(requests, failures, latency) = self._get_stats(parse_url(url).netloc)
+			requests.inc()
+			t_start = time.time()
+			try:
+				value = process_fun(bdecode(self._request(url, query, timeout)))
+				latency.observe(time.time() - t_start)
+			except Exception as ex:
+				failures.inc()
+				if not isinstance(ex, TrackerException):
+					ex = TrackerException('Request to %s failed: %r' % (url, ex))
+				value = ex
+			result.set_result(value)
+
+	# Send HTTP GET request over an idle (or new) connection and return the response body
+	def _request(self, url, query, timeout):
+		url = parse_url(url)
+		key = (url.scheme, url.hostname, url.port)
+		path = url.path + '?' + '&'.join(filter(None, [url.query, encode_query(query)]))
+		for attempt in range(2):
+			conn = None
+			if attempt == 0: # the retry always uses a new connection
+				with self._lock:
+					idle = self._idle.get(key)
+					conn = idle and idle.pop()
+			reused = conn != None
+			if reused: # the idle connection may have been opened with a different timeout
+				conn.timeout = timeout
+				if conn.sock:
+					conn.sock.settimeout(timeout)
+			elif url.scheme == 'https':
+				conn = httplib.HTTPSConnection(url.hostname, url.port, timeout = timeout)
+			else:
+				conn = httplib.HTTPConnection(url.hostname, url.port, timeout = timeout)
 			try:
-				assert(len(data) >= 16)
-				action = decode_uint32(data[0:4])
-				remote_tid = decode_uint32(data[4:8])
-				return (action, remote_tid, data[8:])
-			except:
+				conn.request('GET', path, headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+				response = conn.getresponse()
+				data = response.read()
+			except (httplib.HTTPException, socket.error):
+				conn.close()
+				if reused: # the server closed the idle connection - the other idle ones are likely stale too
+					with self._lock:
+						for idle_conn in self._idle.pop(key, []):
+							idle_conn.close()
+					continue
 				raise
-		return (None, None, None)
-
-	def perform_announce():
-		cid = 0x41727101980
-
-		action_connect = 0
-		tid = random.randint(0, 2**32-1)
-		remote_tid = None
-		while remote_tid != tid:
-			req = encode_uint64(cid) + encode_uint32(action_connect) + encode_uint32(tid)
-			sock.sendto(req, conn)
-			(action, remote_tid, data) = recv()
-			if not data:
-				raise TrackerException('Tracker %s:%d did not answer to handshake' % conn)
-			remote_cid = decode_uint64(data[0:8])
-			if action != action_connect:
-				remote_tid = None
-
-		action_announce = 1
-		tid = random.randint(0, 2**32-1)
-		remote_tid = None
-		while remote_tid != tid:
-			assert(len(info_hash) == 20)
-			assert(len(peer_id) == 20)
-			req = encode_uint64(remote_cid) + encode_uint32(action_announce) + encode_uint32(tid) + \
-				info_hash + peer_id + \
-				encode_uint64(downloaded) + encode_uint64(left) + encode_uint64(uploaded) + \
-				encode_uint32(event) + encode_ip(ip) + encode_uint32(key) + encode_int32(num_want) + encode_uint16(port)
-			sock.sendto(req, conn)
-			(action, remote_tid, data) = recv()
-			if not data:
-				raise TrackerException('Tracker %s:%d did not answer to query' % conn)
-			if action != action_announce:
-				remote_tid = None
-
-		interval = decode_uint32(data[0:4])
-		num_leech = decode_uint32(data[4:8])
-		num_seed = decode_uint32(data[8:12])
-		return list(decode_connections(data[12:]))
+			if response.getheader('Connection', '').lower() == 'close':
+				conn.close()
+			else:
+				with self._lock:
+					idle = self._idle.setdefault(key, [])
+					if len(idle) < self._max_idle:
+						idle.append(conn)
+					else:
+						conn.close()
+			if response.status != 200:
+				raise TrackerException('HTTP error %d from %s' % (response.status, url.netloc))
+			if response.getheader('Content-Encoding', '').lower() == 'gzip':
+				data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+			return data
+		raise TrackerException('Request to %s failed' % url.netloc)
 
-	try:
-		return perform_announce()
-	finally:
-		sock.close()
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def get_http_tracker_client():
+	""" Return the HTTP tracker client shared by all http_get_peers calls """
+	global _http_client
+	with _http_client_lock:
+		if _http_client == None:
+			_http_client = HTTPTrackerClient(daemon = True)
+		return _http_client
 
-# Implementation of BEP #0003 (Bittorrent - section: HTTP Tracker protocol)
 def http_get_peers(tracker_url, info_hash, peer_id, ip = '0.0.0.0', port = 0,
 		uploaded = 0, downloaded = 0, left = 0, event = 'started'):
-	query = {b'info_hash': info_hash, b'peer_id': peer_id, b'ip': ip, b'port': port,
-		b'uploaded': uploaded, b'downloaded': downloaded, b'left': left, b'compact': 1}
-	if event:
-		query['event'] = event
-	handle = open_url(tracker_url, query)
-	if handle.getcode() == 200:
-		decoded = bdecode(handle.read())
-		if not b'peers' in decoded:
-			raise TrackerException(decoded.get(b'failure reason', 'Unknown failure'))
-		return list(decode_connections(decoded.get(b'peers', '')))
+	return get_http_tracker_client().announce(tracker_url, info_hash, peer_id, ip, port,
+		uploaded, downloaded, left, event).get_result()['peers']
 
 if __name__ == '__main__':
-	import os, binascii, logging
+	import os, binascii
+	from utils import start_thread, encode_connection
+	logging.basicConfig()
+	log = logging.getLogger()
 	peer_id = os.urandom(20)
+
+	# Local UDP tracker - answers connect, announce and scrape requests and drops every 5th packet
+	tracker_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	tracker_sock.bind(('127.0.0.1', 0))
+	tracker_url = 'udp://127.0.0.1:%d' % tracker_sock.getsockname()[1]
+	tracker_stats = {'packets': 0, udp_action_connect: 0, udp_action_announce: 0, udp_action_scrape: 0}
+	def run_tracker():
+		while True:
+			(data, source) = tracker_sock.recvfrom(2048)
+			(action, tid) = (decode_uint32(data[8:12]), data[12:16])
+			tracker_stats['packets'] += 1
+			if tracker_stats['packets'] % 5 == 0:
+				continue
+			tracker_stats[action] += 1
+			if action == udp_action_connect:
+				resp = encode_uint64(12345)
+			elif decode_uint64(data[0:8]) != 12345:
+				(action, resp) = (udp_action_error, b'invalid connection id')
+			elif action == udp_action_announce:
+				resp = encode_uint32(1800) + encode_uint32(1) + encode_uint32(2) + encode_connection(('10.0.0.1', 6881))
+			elif action == udp_action_scrape:
+				resp = b''.join(encode_uint32(3) + encode_uint32(4) + encode_uint32(5) for x in range(len(data[16:]) // 20))
+			tracker_sock.sendto(encode_uint32(action) + tid + resp, source)
+	start_thread(run_tracker)
+
+	client = UDPTrackerClient(retransmit_t = 0.1)
+	t_start = time.time()
+	info_hash_list = [os.urandom(20) for x in range(200)]
+	result_list = [client.announce(tracker_url, info_hash, peer_id) for info_hash in info_hash_list]
+	for result in result_list:
+		assert(result.get_result(10)['peers'] == [('10.0.0.1', 6881)])
+	scrape = client.scrape(tracker_url, info_hash_list).get_result(10)
+	assert(len(scrape) == 200)
+	assert(scrape[info_hash_list[0]] == {'seeders': 3, 'completed': 4, 'leechers': 5})
+	log.critical('%d announces and a scrape of %d info hashes in %.2fs - tracker stats: %r' %
+		(len(result_list), len(scrape), time.time() - t_start, tracker_stats))
+	client.shutdown()
+
+	# Local HTTP tracker - gzip compressed responses over persistent connections
+	import gzip, io
+	from bencode import bencode
+	from metrics import HTTPServer, BaseHTTPRequestHandler
+	if sys.version_info[0] >= 3:
+		from socketserver import ThreadingMixIn
+	else:
+		from SocketServer import ThreadingMixIn
+	class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+	http_stats = {'requests': 0, 'connections': 0}
+	class TrackerRequestHandler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+		def setup(self):
+			http_stats['connections'] += 1
+			BaseHTTPRequestHandler.setup(self)
+		def do_GET(self):
+			http_stats['requests'] += 1
+			info_hash_count = self.path.count('info_hash=')
+			if self.path.startswith('/scrape'):
+				files = dict((('%020d' % idx).encode('ascii'), {b'complete': 1, b'downloaded': 2, b'incomplete': 3})
+					for idx in range(info_hash_count))
+				data = bencode({b'files': files})
+			else:
+				data = bencode({b'interval': 1800, b'min interval': 60, b'complete': 1, b'incomplete': 2,
+					b'peers': encode_connection(('10.0.0.1', 6881))})
+			data_io = io.BytesIO()
+			with gzip.GzipFile(fileobj = data_io, mode = 'wb') as fp:
+				fp.write(data)
+			self.send_response(200)
+			self.send_header('Content-Encoding', 'gzip')
+			self.send_header('Content-Length', str(len(data_io.getvalue())))
+			self.end_headers()
+			self.wfile.write(data_io.getvalue())
+		def log_message(self, format, *args):
+			pass
+	http_server = ThreadingHTTPServer(('127.0.0.1', 0), TrackerRequestHandler)
+	start_thread(http_server.serve_forever)
+	tracker_url = 'http://127.0.0.1:%d/announce' % http_server.server_address[1]
+
+	client = HTTPTrackerClient(workers = 4)
+	t_start = time.time()
+	result_list = [client.announce(tracker_url, info_hash, peer_id) for info_hash in info_hash_list[:100]]
+	for result in result_list:
+		assert(result.get_result(10)['peers'] == [('10.0.0.1', 6881)])
+	assert(client.announce(tracker_url, info_hash_list[0], peer_id).get_result(10)['cached'])
+	assert(client.get_announce_time(tracker_url, info_hash_list[0]) > time.time() + 50)
+	with client._lock: # expired results are dropped when read or by the periodic cleanup
+		for key in list(client._cache)[:50]:
+			client._cache[key] = (client._cache[key][0], time.time() - 1)
+	client._cleanup_cache()
+	assert(len(client._cache) == len(result_list) - 50)
+	with client._lock:
+		key = next(iter(client._cache))
+		client._cache[key] = (client._cache[key][0], time.time() - 1)
+	assert(client.get_announce_time(*key) == 0)
+	assert(key not in client._cache)
+	scrape = client.scrape(tracker_url, info_hash_list[:10]).get_result(10)
+	assert(len(scrape) == 10)
+	log.critical('%d announces and a scrape in %.2fs - tracker stats: %r' %
+		(len(result_list), time.time() - t_start, http_stats))
+	class StaleConnection(object): # idle connection closed by the server (eg. after its keep-alive timeout)
+		(timeout, sock) = (None, None)
+		def request(self, *args, **kwargs):
+			raise socket.error('connection reset')
+		def close(self):
+			pass
+	with client._lock:
+		for key in client._idle:
+			client._idle[key] = [StaleConnection(), StaleConnection()]
+	assert(len(client.scrape(tracker_url, info_hash_list[:10]).get_result(10)) == 10)
+	assert(not any(isinstance(conn, StaleConnection) for idle in client._idle.values() for conn in idle))
+	silent_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # tracker without responses
+	silent_sock.bind(('127.0.0.1', 0))
+	silent_sock.listen(1)
+	t_start = time.time()
+	try:
+		client.announce('http://127.0.0.1:%d/announce' % silent_sock.getsockname()[1], info_hash_list[0], peer_id,
+			timeout = 0.5).get_result(10)
+		assert(False)
+	except TrackerException:
+		log.exception('expected tracker exception')
+	assert(time.time() - t_start < 5)
+	silent_sock.close()
+	for host, stats in client.get_tracker_stats().items():
+		log.critical('http tracker stats: %s requests=%d failures=%d p99=%r' %
+			(host, stats['requests'], stats['failures'], stats['latency'].get_quantile(0.99)))
+	client.shutdown()
+	http_server.shutdown()
+
 	info_hash = binascii.unhexlify('ae3fa25614b753118931373f8feae64f3c75f5cd') # Ubuntu 15.10 info hash
 	try:
 		print(http_get_peers('http://torrent.ubuntu.com:6969/announce', info_hash, peer_id))
@@ -22,7 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import sys, select, socket, struct, threading, time, collections, logging
+import sys, select, socket, struct, threading, time, collections, logging, bisect, heapq, itertools
 
 client_version = (b'XK', 0, 0x01) # eXperimental Klient 0.0.1
 
@@ -32,33 +32,103 @@ encode_uint32 = lambda value: struct.pack('!I', value)
 encode_uint64 = lambda value: struct.pack('!Q', value)
 encode_int32 = lambda value: struct.pack('!i', value)
 
+def encode_address(ip): # IPv4 or IPv6 address
+	if ':' in ip:
+		return encode_ip6(ip)
+	return encode_ip(ip)
+
 def encode_connection(con):
-	return encode_ip(con[0]) + encode_uint16(con[1])
+	return encode_address(con[0]) + encode_uint16(con[1])
+
+# Compact node / peer formats of BEP #5 and BEP #32 (IPv6)
+compact_node = struct.Struct('!20s4sH')
+compact_node6 = struct.Struct('!20s16sH')
+compact_connection = struct.Struct('!4sH')
+compact_connection6 = struct.Struct('!16sH')
 
-def encode_nodes(nodes):
-	result = b''
+def encode_nodes(nodes, fmt = compact_node, encode_ip = encode_ip):
+	pack = fmt.pack
+	result = []
 	for node in nodes:
-		result += bytes(bytearray(node.id).rjust(20, b'\0')) + encode_connection(node.connection)
-	return result
+		node_id = node.id
+		if len(node_id) != 20:
+			node_id = bytes(bytearray(node_id).rjust(20, b'\0'))
+		result.append(pack(node_id, encode_ip(node.connection[0]), node.connection[1]))
+	return b''.join(result)
+
+def encode_nodes6(nodes):
+	return encode_nodes(nodes, compact_node6, encode_ip6)
+
+def encode_ip6(value):
+	return socket.inet_pton(socket.AF_INET6, value)
 
 decode_ip = lambda value: socket.inet_ntoa(value)
 decode_uint16 = lambda value: struct.unpack('!H', value)[0]
 decode_uint32 = lambda value: struct.unpack('!I', value)[0]
 decode_uint64 = lambda value: struct.unpack('!Q', value)[0]
 
+def decode_ip6(value):
+	return socket.inet_ntop(socket.AF_INET6, value)
+
 def decode_connection(con):
+	if len(con) == 18: # IPv6
+		return (decode_ip6(con[0:16]), decode_uint16(con[16:18]))
 	return (decode_ip(con[0:4]), decode_uint16(con[4:6]))
 
-def decode_nodes(nodes):
+def get_address_family(connection):
+	if ':' in connection[0]:
+		return socket.AF_INET6
+	return socket.AF_INET
+
+def resolve_connection(connection, family = socket.AF_INET):
+	""" Return the (ip, port) tuple of the (host, port) tuple for the given address family """
+	if family == socket.AF_INET:
+		return (socket.gethostbyname(connection[0]), connection[1])
+	return socket.getaddrinfo(connection[0], connection[1], family, socket.SOCK_DGRAM)[0][4][:2]
+
+def iter_unpack(fmt, data):
+	""" Iterate over the complete entries of the given struct.Struct in data - without copying data """
 	try:
-		while nodes:
-			node_id = struct.unpack('20s', nodes[:20])[0]
-			node_connection = decode_connection(nodes[20:26])
-			if node_connection[1] >= 1024: # discard invalid port numbers
-				yield (node_id, node_connection)
-			nodes = nodes[26:]
-	except Exception:
-		pass # catch malformed nodes
+		data = memoryview(data)
+	except TypeError: # catch malformed data
+		return iter([])
+	data = data[:len(data) - len(data) % fmt.size] # skip truncated entry
+	if hasattr(fmt, 'iter_unpack'): # python >= 3.4
+		return fmt.iter_unpack(data)
+	return (fmt.unpack_from(data, pos) for pos in range(0, len(data), fmt.size))
+
+def decode_nodes(nodes, packed = False, fmt = compact_node, decode_ip = decode_ip):
+	""" Iterate over the (node id, (ip, port)) tuples in the compact node info
+		With packed, the ip is returned in its binary form (eg. for use as dictionary key) """
+	for (node_id, ip, port) in iter_unpack(fmt, nodes):
+		if port >= 1024: # discard invalid port numbers
+			yield (node_id, (packed and ip or decode_ip(ip), port))
+
+def decode_nodes6(nodes, packed = False):
+	return decode_nodes(nodes, packed, compact_node6, decode_ip6)
+
+def decode_connections(data, packed = False, fmt = compact_connection, decode_ip = decode_ip):
+	""" Iterate over the (ip, port) tuples in the compact peer info string """
+	for (ip, port) in iter_unpack(fmt, data):
+		if port >= 1024:
+			yield (packed and ip or decode_ip(ip), port)
+
+def decode_connections6(data, packed = False):
+	return decode_connections(data, packed, compact_connection6, decode_ip6)
+
+def decode_values(values, packed = False):
+	""" Iterate over the (ip, port) tuples in a list of compact IPv4 / IPv6 peer infos """
+	unpack = compact_connection.unpack
+	unpack6 = compact_connection6.unpack
+	if not isinstance(values, list): # catch malformed values
+		return
+	for value in values:
+		if len(value) == 6:
+			(ip, port) = unpack(value)
+			yield (packed and ip or decode_ip(ip), port)
+		elif len(value) == 18:
+			(ip, port) = unpack6(value)
+			yield (packed and ip or decode_ip6(ip), port)
 
 def start_thread(fun, *args, **kwargs):
 	thread = threading.Thread(name = repr(fun), target=fun, args=args, kwargs=kwargs)
@@ -67,28 +137,113 @@ def start_thread(fun, *args, **kwargs):
 	return thread
 
 
+# Fixed-bucket histogram - the bucket limits are inclusive upper bounds
+class Histogram(object):
+	default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+		0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, buckets = default_buckets):
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1) # last entry: values above the largest bucket
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def get_quantile(self, q):
+		""" Return the upper bucket limit containing the q-quantile (None if empty) """
+		if not self.count:
+			return None
+		rank = q * self.count
+		total = 0
+		for idx, count in enumerate(self.counts):
+			total += count
+			if total >= rank:
+				if idx < len(self.buckets):
+					return self.buckets[idx]
+				break
+		return float('inf')
+
+
+# Time source of the protocol components - simulations replace it by a virtual clock (see simnet.py)
+class SystemClock(object):
+	def time(self):
+		return time.time()
+
+	def wait(self, event, timeout = None):
+		""" Wait until the event is set or the timeout is reached - returns the state of the event """
+		return event.wait(timeout)
+
+	def get_scheduler(self):
+		""" Return the scheduler of the periodic jobs started on this clock """
+		global _scheduler
+		with _scheduler_lock:
+			if _scheduler == None:
+				_scheduler = TimerScheduler()
+			return _scheduler
+
+_clock = SystemClock()
+
+def set_clock(clock):
+	""" Replace the clock used by async results and the DHT - returns the previous clock """
+	global _clock
+	(previous, _clock) = (_clock, clock)
+	return previous
+
+def get_time():
+	return _clock.time()
+
+def wait_event(event, timeout = None):
+	return _clock.wait(event, timeout)
+
+
 class AsyncTimeout(RuntimeError):
 	pass
 
 
 class AsyncResult(object):
+	_callback_lock = threading.Lock()
+
 	def __init__(self, source = None):
 		self._event = threading.Event()
 		self._value = None
 		self._source = source
-		self._time = time.time()
+		self._time = get_time()
+		self._time_result = None
+		self._callbacks = []
 
 	def get_age(self):
-		return time.time() - self._time
+		return get_time() - self._time
+
+	def get_rtt(self):
+		""" Return the time between the creation of the holder and the arrival of the result """
+		if self._time_result != None:
+			return self._time_result - self._time
 
 	def discard_result(self):
 		self._time = 0
 
 	def set_result(self, result, source = None):
+		self._time_result = get_time()
 		self._value = result
 		if source != None:
 			self._source = source
 		self._event.set()
+		with self._callback_lock:
+			(callbacks, self._callbacks) = (self._callbacks, None)
+		for fun in callbacks or []:
+			fun(self)
+
+	def add_callback(self, fun):
+		""" Call fun(async_result) once the result is available """
+		with self._callback_lock:
+			if self._callbacks != None:
+				self._callbacks.append(fun)
+				return
+		fun(self)
 
 	def has_result(self):
 		return self._event.is_set()
@@ -97,29 +252,170 @@ class AsyncResult(object):
 		return self._source
 
 	def get_result(self, timeout = None):
-		if not self._event.wait(timeout):
+		if not wait_event(self._event, timeout):
 			raise AsyncTimeout
 		if isinstance(self._value, Exception):
 			raise self._value
 		return self._value
 
 
+def merge_async_results(async_result_list, source = None):
+	""" Return an async result holder with the merged dictionaries of all results (or the first exception) """
+	result = AsyncResult(source)
+	(merged, lock, remaining) = ({}, threading.Lock(), [len(async_result_list)])
+	def collect(async_result):
+		try:
+			value = async_result.get_result(0)
+		except Exception as ex:
+			value = ex
+		with lock:
+			if remaining[0] <= 0: # already finished
+				return
+			if isinstance(value, Exception):
+				remaining[0] = 0
+			else:
+				merged.update(value)
+				remaining[0] -= 1
+				if remaining[0]:
+					return
+				value = merged
+		result.set_result(value)
+	for async_result in async_result_list:
+		async_result.add_callback(collect)
+	return result
+
+def iter_async_results(async_result_list, timeout = None):
+	""" Yield the async results in the order of their arrival until the timeout is reached """
+	(done, event) = (collections.deque(), threading.Event())
+	def notify(async_result):
+		done.append(async_result)
+		event.set()
+	for async_result in async_result_list:
+		async_result.add_callback(notify)
+	if timeout != None:
+		t_end = get_time() + timeout
+	for idx in range(len(async_result_list)):
+		while not done:
+			if timeout != None:
+				if not wait_event(event, max(0, t_end - get_time())):
+					return
+			elif not wait_event(event):
+				return
+			event.clear()
+		yield done.popleft()
+
+
+# Periodic job of a thread manager executed by the timer scheduler (jobs without interval run once)
+class ScheduledJob(object):
+	def __init__(self, manager, fun, interval, on_except, args, kwargs):
+		(self.manager, self.fun, self.interval) = (manager, fun, interval)
+		(self.on_except, self.args, self.kwargs) = (on_except, args, kwargs)
+
+	def run(self):
+		""" Run the job - returns True if the job should be scheduled again """
+		manager = self.manager
+		if not manager._enter_job():
+			return False
+		try:
+			self.fun(*self.args, **self.kwargs)
+		except Exception:
+			if 'log' in self.on_except:
+				manager._log.exception('Exception in maintainance thread')
+			if 'continue' not in self.on_except:
+				return False
+		finally:
+			manager._leave_job()
+		return (self.interval != None) and not manager.shutdown_in_progress()
+
+
+# Heap based scheduler running the periodic jobs of all thread managers on a small worker pool
+class TimerScheduler(object):
+	def __init__(self, workers = 4):
+		self._condition = threading.Condition()
+		self._heap = [] # (time due, sequence number, job)
+		self._sequence = itertools.count()
+		self._workers = []
+		self._workers_max = workers
+		self.lag = Histogram() # delay between the time a job was due and its execution
+		self.lag_max = 0
+
+	def add_job(self, job, delay):
+		with self._condition:
+			if not self._workers:
+				for idx in range(self._workers_max):
+					thread = threading.Thread(name = 'scheduler worker %d' % idx, target = self._worker)
+					thread.daemon = True
+					thread.start()
+					self._workers.append(thread)
+			heapq.heappush(self._heap, (time.time() + delay, next(self._sequence), job))
+			self._condition.notify()
+
+	def cancel_jobs(self, manager):
+		with self._condition:
+			self._heap = [entry for entry in self._heap if entry[2].manager is not manager]
+			heapq.heapify(self._heap)
+
+	def get_job_count(self):
+		return len(self._heap)
+
+	def get_worker_count(self):
+		return len(self._workers)
+
+	# Private members #################################################
+
+	def _worker(self):
+		while True:
+			with self._condition:
+				while not self._heap or (self._heap[0][0] > time.time()):
+					if self._heap:
+						self._condition.wait(self._heap[0][0] - time.time())
+					else:
+						self._condition.wait()
+				(t_due, sequence, job) = heapq.heappop(self._heap)
+			lag = time.time() - t_due
+			self.lag.observe(lag)
+			self.lag_max = max(self.lag_max, lag)
+			if job.run():
+				self.add_job(job, job.interval)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+	""" Return the timer scheduler shared by all thread managers """
+	return _clock.get_scheduler()
+
+
 class ThreadManager(object):
-	def __init__(self, log):
+	def __init__(self, log, scheduler = None, daemon = False):
 		self._log = log
+		self._daemon = daemon # continuous threads do not keep the process alive
 		self._threads = []
 		self._shutdown_event = threading.Event()
+		self._scheduler = scheduler
+		self._jobs_running = 0
+		self._jobs_condition = threading.Condition()
 
 	def shutdown_in_progress(self):
 		return self._shutdown_event.is_set()
 
+	def wait_shutdown(self, timeout = None):
+		""" Wait up to timeout seconds (on the clock of the process) - returns True once the shutdown is triggered """
+		return wait_event(self._shutdown_event, timeout)
+
 	def shutdown(self):
 		self._shutdown_event.set() # Trigger shutdown of threads
+		if self._scheduler:
+			self._scheduler.cancel_jobs(self)
 
 	def join(self, timeout = 60):
 		self.shutdown()
 		for thread in self._threads:
 			thread.join(timeout)
+		t_end = time.time() + timeout
+		with self._jobs_condition: # wait for running scheduled jobs
+			while self._jobs_running and (time.time() < t_end):
+				self._jobs_condition.wait(max(0, t_end - time.time()))
 
 	def start_thread(self, name, daemon, fun, *args, **kwargs):
 		thread = threading.Thread(name = name, target=fun, args=args, kwargs=kwargs)
@@ -128,11 +424,40 @@ class ThreadManager(object):
 		self._threads.append(thread)
 		return thread
 
+	def call_later(self, delay, fun, *args, **kwargs):
+		""" Run fun once after delay seconds on the shared timer scheduler """
+		if not self._scheduler:
+			self._scheduler = get_scheduler()
+		self._scheduler.add_job(ScheduledJob(self, fun, None, ['log'], args, kwargs), max(0, delay))
+
 	def start_continuous_thread(self, fun, thread_interval = 0, *args, **kwargs):
-		if thread_interval >= 0:
-			self.start_thread('continuous thread:' + repr(fun), False,
+		""" Run fun periodically - jobs with an interval > 0 are executed by the shared timer scheduler,
+			jobs without interval (eg. blocking on sockets) get their own thread """
+		if thread_interval > 0:
+			on_except = kwargs.pop('on_except', ['log', 'continue'])
+			thread_waitfirst = kwargs.pop('thread_waitfirst', False)
+			if not self._scheduler:
+				self._scheduler = get_scheduler()
+			job = ScheduledJob(self, fun, thread_interval, on_except, args, kwargs)
+			self._scheduler.add_job(job, thread_waitfirst and thread_interval or 0)
+		elif thread_interval == 0:
+			self.start_thread('continuous thread:' + repr(fun), self._daemon,
 				self._continuous_thread_wrapper, fun, thread_interval = thread_interval, *args, **kwargs)
 
+	# Private members #################################################
+
+	def _enter_job(self):
+		with self._jobs_condition:
+			if self.shutdown_in_progress():
+				return False
+			self._jobs_running += 1
+			return True
+
+	def _leave_job(self):
+		with self._jobs_condition:
+			self._jobs_running -= 1
+			self._jobs_condition.notify_all()
+
 	def _continuous_thread_wrapper(self, fun, on_except = ['log', 'continue'], thread_waitfirst = False, thread_interval = 0, *args, **kwargs):
 		if thread_waitfirst:
 			self._shutdown_event.wait(thread_interval)
@@ -147,10 +472,38 @@ class ThreadManager(object):
 			self._shutdown_event.wait(thread_interval)
 
 
+# Reentrant lock recording the time spent waiting for it in the given histogram
+class TimedLock(object):
+	def __init__(self, histogram):
+		self._lock = threading.RLock()
+		self._histogram = histogram
+
+	def acquire(self, blocking = True):
+		if not blocking:
+			return self._lock.acquire(False)
+		t_start = time.time()
+		self._lock.acquire()
+		self._histogram.observe(time.time() - t_start)
+		return True
+
+	def release(self):
+		self._lock.release()
+
+	def __enter__(self):
+		return self.acquire()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+
+# Queue entry of a packet sampled by the tracer of a NetworkSocket - t_queued is set when it is queued
+class TracedQueueEntry(tuple):
+	pass
+
 class NetworkSocket(object):
-	def __init__(self, name):
+	def __init__(self, name, daemon = False):
 		self._log = logging.getLogger(self.__class__.__name__).getChild(name)
-		self._threads = ThreadManager(self._log)
+		self._threads = ThreadManager(self._log, daemon = daemon)
 		self._lock = threading.Lock()
 
 		self._send_event = threading.Event()
@@ -159,14 +512,23 @@ class NetworkSocket(object):
 
 		self._recv_event = threading.Event()
 		self._recv_queue = collections.deque()
+		self._tracer = None
 
 		self._force_show_info = False
 		self._threads.start_continuous_thread(self._info_thread, thread_interval = 0.5)
 		self._threads.start_continuous_thread(self._send_thread)
 		self._threads.start_continuous_thread(self._recv_thread)
 
+	def set_tracer(self, tracer):
+		""" Record the time sampled packets spend in the queues as stages recv_queue / send_queue
+			of the given StageTracer (None disables the tracing) """
+		self._tracer = tracer
+
 	# Non-blocking send
 	def sendto(self, *args):
+		if self._tracer and self._tracer.is_sampled():
+			args = TracedQueueEntry(args)
+			args.t_queued = time.time()
 		self._send_queue.append(args)
 		with self._lock: # set send flag
 			self._send_event.set()
@@ -177,11 +539,17 @@ class NetworkSocket(object):
 		if self._recv_event.wait(timeout):
 			if self._recv_queue:
 				result = self._recv_queue.pop()
+				if type(result) == TracedQueueEntry:
+					self._trace_queue('recv_queue', result)
 			with self._lock:
 				if not self._recv_queue and not self._threads.shutdown_in_progress():
 					self._recv_event.clear()
 		return result
 
+	def get_queue_size(self):
+		""" Return the number of packets in the (receive, send) queues """
+		return (len(self._recv_queue), len(self._send_queue))
+
 	def close(self):
 		with self._lock:
 			self._threads.shutdown()
@@ -206,7 +574,9 @@ class NetworkSocket(object):
 		if self._send_event.wait(0.1):
 			if self._send_queue:
 				if self._send(*self._send_queue[0]):
-					self._send_queue.popleft()
+					entry = self._send_queue.popleft()
+					if type(entry) == TracedQueueEntry:
+						self._trace_queue('send_queue', entry)
 					self._send_try = 0
 				elif self._send_try > send_tries:
 					self._send_queue.popleft()
@@ -221,9 +591,17 @@ class NetworkSocket(object):
 	def _send(self, *args):
 		raise NotImplemented
 
+	def _trace_queue(self, stage, entry):
+		tracer = self._tracer
+		if tracer:
+			tracer.observe(stage, time.time() - entry.t_queued)
+
 	def _recv_thread(self):
 		tmp = self._recv()
 		if tmp:
+			if self._tracer and self._tracer.is_sampled():
+				tmp = TracedQueueEntry(tmp)
+				tmp.t_queued = time.time()
 			self._recv_queue.append(tmp)
 			with self._lock:
 				self._recv_event.set()
@@ -236,11 +614,14 @@ class NetworkSocket(object):
 
 
 class UDPSocket(NetworkSocket):
-	def __init__(self, connection):
-		self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	def __init__(self, connection, daemon = False):
+		self.family = get_address_family(connection)
+		self._sock = socket.socket(self.family, socket.SOCK_DGRAM)
+		if self.family == socket.AF_INET6: # allow an IPv4 socket on the same port
+			self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
 		self._sock.setblocking(0)
 		self._sock.bind(connection)
-		NetworkSocket.__init__(self, '%s:%d' % connection)
+		NetworkSocket.__init__(self, '%s:%d' % connection, daemon)
 
 	def _send(self, *args):
 		select.select([], [self._sock], [], 0.1)
@@ -253,7 +634,8 @@ class UDPSocket(NetworkSocket):
 	def _recv(self):
 		select.select([self._sock], [], [], 0.1)
 		try:
-			return self._sock.recvfrom(64*1024)
+			(data, connection) = self._sock.recvfrom(64*1024)
+			return (data, connection[:2]) # strip IPv6 flow info and scope id
 		except socket.error:
 			pass
 